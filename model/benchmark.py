@@ -0,0 +1,676 @@
+#!/usr/bin/env python
+'''
+    Benchmarks the hot paths on synthetic ASAP-like data, on CPU.
+    Results are written as JSON so runs can be compared across commits:
+        python benchmark.py -o base.json
+        python benchmark.py -o new.json --compare base.json
+'''
+
+import os
+import sys
+import json
+import argparse
+import logging
+import platform
+import subprocess
+import tempfile
+import difflib
+from collections import OrderedDict
+from time import perf_counter
+import numpy as np
+# pytorch imports
+import torch
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+# User imports
+from src.dataset import ASAPDataset, ASAPDataLoader, tsv_encoding
+from src.tokenizers import TOKENIZERS, get_tokenizer
+from src.vocab import Vocabulary
+from src.pos_tagging import POSTagger
+from src.model import Model, EnsembleModel, StackedEnsemble
+from src.evaluation import predict
+from src.precision import bf16_autocast, finite
+from src.custom_layers import Attention, Conv1DWithMasking
+from src.qwk import quadratic_weighted_kappa
+from src.scores import score_scaler
+from src.synthetic import SyntheticASAP
+import src.distributed as D
+import src.utils as U
+
+logger = logging.getLogger(__name__)
+
+SUITES = OrderedDict()
+MODEL_CONFIGS = [('reg', 'mot'), ('breg', 'mot')] + \
+    [(t, a) for t in ['regp', 'bregp'] for a in ['mot', 'attsum', 'attmean']]
+ENSEMBLE_SIZES = [2, 4, 8]
+
+
+def suite(name):
+    def decorator(fn):
+        SUITES[name] = fn
+        return fn
+    return decorator
+
+
+def timeit(fn, repeat=5, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        begin = perf_counter()
+        fn()
+        times.append(perf_counter() - begin)
+    times = np.array(times)
+    return {'mean_s': float(times.mean()),
+            'median_s': float(np.median(times)),
+            'min_s': float(times.min()),
+            'repeat': repeat}
+
+
+def model_args(**kwargs):
+    '''
+        Namespace with train.py's defaults, overridden by kwargs.
+    '''
+    args = argparse.Namespace(
+        model_type='regp', recurrent_unit='lstm', emb_dim=50, cnn_dim=0,
+        cnn_window_size=3, rnn_dim=300, batch_size=32, vocab_size=4000,
+        aggregation='mot', dropout_prob=0.5, skip_init_bias=False,
+        emb_path=None, pos=False, features=[], cuda=False, loss='mse',
+        algorithm='rmsprop', clip_norm=10.0
+        )
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+class BenchmarkContext:
+    def __init__(self, args):
+        self.args = args
+        self.scales = args.scales
+        self.repeat = args.repeat
+        self.data_dir = args.data_dir or tempfile.mkdtemp(prefix='asap-bench-')
+        self.generator = SyntheticASAP(seed=args.seed)
+        self.results = []
+        self._files = {}
+        self._datasets = {}
+
+    def tsv(self, scale):
+        if scale not in self._files:
+            path = os.path.join(self.data_dir, 'synthetic_%d.tsv' % scale)
+            if not os.path.exists(path):
+                self.generator.write_tsv(path, scale)
+            self._files[scale] = path
+        return self._files[scale]
+
+    def dataset(self, scale, **kwargs):
+        key = (scale, tuple(sorted(kwargs.items())))
+        if key not in self._datasets:
+            self._datasets[key] = ASAPDataset(self.tsv(scale), vocab_size=4000, maxlen=self.args.maxlen, **kwargs)
+            self._datasets[key].make_scores_model_friendly()
+        return self._datasets[key]
+
+    def batches(self, scale, n_batches, batch_size, **kwargs):
+        dataset = self.dataset(scale, **kwargs)
+        batches = []
+        for batch in ASAPDataLoader(dataset, dataset.maxlen, batch_size):
+            batches.append(batch)
+            if len(batches) == n_batches:
+                break
+        return dataset, batches
+
+    def add(self, suite_name, name, params, stats):
+        record = OrderedDict([('suite', suite_name), ('name', name), ('params', params)])
+        record.update(stats)
+        self.results.append(record)
+        logger.info('%s/%s %s: %s' % (suite_name, name, json.dumps(params, sort_keys=True),
+                                      ', '.join('%s=%.5g' % (k, v) for k, v in stats.items() if isinstance(v, float))))
+
+
+@suite('dataset')
+def bench_dataset(ctx):
+    for scale in ctx.scales:
+        path = ctx.tsv(scale)
+        stats = timeit(lambda: ASAPDataset(path, vocab_size=4000), repeat=max(1, ctx.repeat // 2), warmup=0)
+        stats['essays_per_sec'] = scale / stats['median_s']
+        dataset = ctx.dataset(scale)
+        arrays = [dataset.tokens, dataset.offsets, dataset.ids, dataset.y, dataset.prompts]
+        stats['storage_mb'] = sum(a.nbytes for a in arrays) / 2.**20
+        stats['bytes_per_token'] = sum(a.nbytes for a in arrays) / float(max(len(dataset.tokens), 1))
+        ctx.add('dataset', 'construct', {'essays': scale}, stats)
+
+
+def read_essays(path, limit=None):
+    essays = []
+    with open(path, 'r', encoding=tsv_encoding) as f:
+        next(f)
+        for line in f:
+            essays.append(line.strip('\r\n').split('\t')[2])
+            if limit is not None and len(essays) == limit:
+                break
+    return essays
+
+
+@suite('tokenize')
+def bench_tokenize(ctx):
+    '''
+        Essays/sec of every tokenizer and token level agreement with nltk
+        (matched tokens / tokens, aligned with difflib) on --tokenize-tsv
+        (e.g. training_set_rel3.tsv) or the synthetic essays.
+    '''
+    path = ctx.args.tokenize_tsv or ctx.tsv(max(ctx.scales))
+    essays = read_essays(path, limit=ctx.args.tokenize_essays)
+    n_tokens = None
+    reference = None
+    for name in TOKENIZERS:
+        tokenizer = get_tokenizer(name)
+        # Timed on lower cased text, like the vocab is built.
+        stats = timeit(lambda: [tokenizer.words(essay.lower()) for essay in essays], repeat=ctx.repeat)
+        stats['essays_per_sec'] = len(essays) / stats['median_s']
+        tokens = [tokenizer.words(essay) for essay in essays]
+        if reference is None:
+            reference = tokens
+            n_tokens = float(sum(len(t) for t in tokens))
+            base = stats['median_s']
+        matched = sum(sum(block.size for block in difflib.SequenceMatcher(None, ref, tok, autojunk=False).get_matching_blocks())
+                      for ref, tok in zip(reference, tokens))
+        stats['token_agreement'] = matched / max(n_tokens, 1.)
+        stats['essay_agreement'] = float(np.mean([ref == tok for ref, tok in zip(reference, tokens)]))
+        stats['speedup'] = base / stats['median_s']
+        ctx.add('tokenize', name, {'essays': len(essays), 'tsv': os.path.basename(path)}, stats)
+
+
+@suite('vocab')
+def bench_vocab(ctx):
+    '''
+        Tokens/sec of encoding the tokenized essays: the old per token
+        float()/dict loop vs Vocabulary.encode (cold cache, then warm),
+        with the check that the indices are identical.
+    '''
+    path = ctx.args.tokenize_tsv or ctx.tsv(max(ctx.scales))
+    tokenizer = get_tokenizer('regex')
+    essays = [tokenizer.words(essay) for essay in read_essays(path, limit=ctx.args.tokenize_essays)]
+    n_tokens = float(sum(len(words) for words in essays))
+    vocab = ctx.dataset(max(ctx.scales)).vocab
+    params = {'essays': len(essays), 'tokens': int(n_tokens), 'vocab': len(vocab), 'tsv': os.path.basename(path)}
+    index = dict(vocab.items())
+
+    def per_token():
+        ret = []
+        for words in essays:
+            indices = []
+            for word in words:
+                try:
+                    float(word)
+                    indices.append(index['<num>'])
+                except ValueError:
+                    indices.append(index.get(word, index['<unk>']))
+            ret.append(indices)
+        return ret
+    stats = timeit(per_token, repeat=ctx.repeat)
+    reference = per_token()
+    stats['tokens_per_sec'] = n_tokens / stats['median_s']
+    ctx.add('vocab', 'per_token', params, stats)
+    fresh = Vocabulary(vocab.words)
+    begin = perf_counter()
+    encoded = [fresh.encode(words) for words in essays]
+    cold = perf_counter() - begin
+    stats = timeit(lambda: [fresh.encode(words) for words in essays], repeat=ctx.repeat)
+    stats.update({'cold_s': cold, 'cold_tokens_per_sec': n_tokens / cold,
+                  'tokens_per_sec': n_tokens / stats['median_s'],
+                  'identical': float(all(e.tolist() == r for e, r in zip(encoded, reference)))})
+    ctx.add('vocab', 'encode', params, stats)
+
+
+@suite('pos')
+def bench_pos(ctx):
+    '''
+        Sentence by sentence PerceptronTagger.tag vs the batched,
+        memoized POSTagger (cold cache, then warm), with the check that
+        the tags are identical.
+    '''
+    path = ctx.args.tokenize_tsv or ctx.tsv(max(ctx.scales))
+    tokenizer = get_tokenizer('nltk')
+    sentences = [s for essay in read_essays(path, limit=ctx.args.tokenize_essays) for s in tokenizer.sentences(essay)]
+    params = {'sentences': len(sentences), 'tsv': os.path.basename(path)}
+    reference_tagger = POSTagger().tagger
+
+    def per_sentence():
+        return [[tag for _, tag in reference_tagger.tag(s)] for s in sentences]
+    stats = timeit(per_sentence, repeat=max(1, ctx.repeat // 2))
+    reference = per_sentence()
+    stats['sentences_per_sec'] = len(sentences) / stats['median_s']
+    ctx.add('pos', 'per_sentence', params, stats)
+    for workers in [1, min(4, os.cpu_count() or 1)]:
+        tagger = POSTagger(workers=workers)
+        begin = perf_counter()
+        tags = tagger.tag_sentences(sentences)
+        cold = perf_counter() - begin
+        lexicon = tagger.stats['lexicon']
+        stats = timeit(lambda: tagger.tag_sentences(sentences), repeat=ctx.repeat)
+        stats.update({'cold_s': cold, 'sentences_per_sec': len(sentences) / cold,
+                      'identical': float(tags == reference),
+                      'lexicon_fraction': lexicon / float(len(sentences))})
+        ctx.add('pos', 'batched', dict(params, workers=workers), stats)
+
+
+@suite('loader')
+def bench_loader(ctx):
+    for scale in ctx.scales:
+        dataset = ctx.dataset(scale)
+        for batch_size in [32, 128]:
+            def epoch():
+                for _ in ASAPDataLoader(dataset, dataset.maxlen, batch_size):
+                    pass
+            stats = timeit(epoch, repeat=ctx.repeat)
+            stats['essays_per_sec'] = scale / stats['median_s']
+            ctx.add('loader', 'epoch', {'essays': scale, 'batch_size': batch_size}, stats)
+
+
+def run_model(model, batches, train=False, bf16=False):
+    for xs, ys, ps, padding_mask, lens, extras in batches:
+        with bf16_autocast(bf16):
+            youts = model(xs, mask=padding_mask, lens=lens, pos=extras.pos, features=extras.features)
+        if train:
+            loss = F.mse_loss(youts.float().squeeze(1), ys)
+            model.zero_grad()
+            loss.backward()
+
+
+@suite('model')
+def bench_model(ctx):
+    scale = min(ctx.scales)
+    dataset, batches = ctx.batches(scale, ctx.args.batches, ctx.args.batch_size)
+    n_essays = sum(len(batch[0]) for batch in batches)
+    imv = [float(np.mean(dataset.y))]
+    for model_type, aggregation in MODEL_CONFIGS:
+        params = {'type': model_type, 'aggregation': aggregation, 'essays': n_essays,
+                  'batch_size': ctx.args.batch_size, 'cnn_dim': ctx.args.cnn_dim}
+        torch.manual_seed(ctx.args.seed)
+        try:
+            model = Model(model_args(model_type=model_type, aggregation=aggregation, cnn_dim=ctx.args.cnn_dim), dataset.vocab, imv)
+            model.eval()
+            with torch.no_grad():
+                stats = timeit(lambda: run_model(model, batches), repeat=ctx.repeat)
+            stats['essays_per_sec'] = n_essays / stats['median_s']
+            ctx.add('model', 'forward', params, stats)
+            model.train()
+            stats = timeit(lambda: run_model(model, batches, train=True), repeat=ctx.repeat)
+            stats['essays_per_sec'] = n_essays / stats['median_s']
+            ctx.add('model', 'forward_backward', params, stats)
+        except Exception as e:
+            # Recorded so the other configs still run, main() exits non zero.
+            logger.exception('model %s/%s failed' % (model_type, aggregation))
+            ctx.add('model', 'error', params, {'error': repr(e)})
+
+
+class LegacyAttention(Attention):
+    '''
+        Attention pooling as it was before masking: two tensordots, a
+        softmax over a size 1 dimension and an expanded weight tensor.
+    '''
+    def forward(self, x, mask=None, lens=None, dim=1):
+        temp = self.attention_fn(U.tensordot(x, self.att_W))
+        w = F.softmax(U.tensordot(temp, self.att_V), dim=2)
+        w = w.expand(*w.size()[:-1], self.input_size)
+        s = (x * w).sum(dim=dim)
+        if self.op == 'attsum':
+            return s
+        return s / lens.unsqueeze(1).expand(*s.size()).float()
+
+
+@suite('attention')
+def bench_attention(ctx):
+    '''
+        Current vs legacy attention pooling on padded batches where essay
+        lengths are uniform in [T/4, T].
+    '''
+    rng = np.random.RandomState(ctx.args.seed)
+    hidden = 600  # bregp with the default rnn_dim
+    for max_len in [500, 1000, 2000]:
+        lens = torch.from_numpy(np.sort(rng.randint(max_len // 4, max_len + 1, size=ctx.args.batch_size))[::-1].copy())
+        lens[0] = max_len
+        mask = (torch.arange(max_len).unsqueeze(0) < lens.unsqueeze(1)).float()
+        x = torch.randn(ctx.args.batch_size, max_len, hidden) * mask.unsqueeze(2)
+        for op in ['attsum', 'attmean']:
+            params = {'batch_size': ctx.args.batch_size, 'max_len': max_len, 'hidden': hidden, 'op': op}
+            torch.manual_seed(ctx.args.seed)
+            new = Attention(hidden, attention_fn=torch.tanh, op=op)
+            old = LegacyAttention(hidden, attention_fn=torch.tanh, op=op)
+            old.load_state_dict(new.state_dict())
+            for name, layer in [('masked_bmm', new), ('legacy', old)]:
+                with torch.no_grad():
+                    stats = timeit(lambda: layer(x, mask=mask, lens=lens), repeat=ctx.repeat)
+                ctx.add('attention', name + '_forward', params, stats)
+
+                def step():
+                    inp = x.clone().requires_grad_()
+                    layer(inp, mask=mask, lens=lens).sum().backward()
+                stats = timeit(step, repeat=ctx.repeat)
+                ctx.add('attention', name + '_forward_backward', params, stats)
+
+
+class LegacyConv1DWithMasking(Conv1DWithMasking):
+    '''
+        permute -> conv -> permute -> multiply by an expanded mask
+    '''
+    def forward(self, x, mask=None, channels_first=False):
+        res = self.conv(x.permute([0, 2, 1])).permute([0, 2, 1])
+        return res * mask.unsqueeze(2).expand(*res.size())
+
+
+@suite('cnn')
+def bench_cnn(ctx):
+    '''
+        Embedding -> CNN section in the current channels first layout vs
+        the legacy permute/expand layer.
+    '''
+    emb_dim, cnn_dim, window = 50, 100, 3
+    for max_len in [500, 1000, 2000]:
+        params = {'batch_size': ctx.args.batch_size, 'max_len': max_len, 'emb_dim': emb_dim, 'cnn_dim': cnn_dim}
+        emb = torch.randn(ctx.args.batch_size, max_len, emb_dim)
+        mask = torch.ones(ctx.args.batch_size, max_len)
+        torch.manual_seed(ctx.args.seed)
+        new = Conv1DWithMasking(emb_dim, cnn_dim, window, padding=(window - 1) // 2)
+        old = LegacyConv1DWithMasking(emb_dim, cnn_dim, window, padding=(window - 1) // 2)
+        old.load_state_dict(new.state_dict())
+        runs = [('channels_first', lambda inp: new(inp.transpose(1, 2), mask=mask, channels_first=True).transpose(1, 2)),
+                ('legacy', lambda inp: old(inp, mask=mask))]
+        for name, fn in runs:
+            def step():
+                inp = emb.clone().requires_grad_()
+                fn(inp).sum().backward()
+            stats = timeit(step, repeat=ctx.repeat)
+            ctx.add('cnn', name + '_forward_backward', params, stats)
+
+
+def _ddp_worker(rank, world_size, port, dataset, margs, epochs, out_file):
+    D.setup(rank, world_size, port)
+    torch.manual_seed(margs.seed)
+    model = DistributedDataParallel(Model(margs, dataset.vocab, [float(np.mean(dataset.y))]))
+    parameters = list(model.parameters())
+    optimizer = U.get_optimizer(margs, parameters)
+    model.train()
+    torch.distributed.barrier()
+    begin = perf_counter()
+    for epoch in range(epochs):
+        indices = D.shard_indices(dataset, rank, world_size, epoch)
+        for xs, ys, ps, padding_mask, lens, extras in ASAPDataLoader(dataset, dataset.maxlen, margs.batch_size, indices=indices):
+            youts = model(xs, mask=padding_mask, lens=lens, pos=extras.pos, features=extras.features)
+            loss = F.mse_loss(youts.squeeze(1), ys)
+            optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(parameters, margs.clip_norm)
+            optimizer.step()
+    torch.distributed.barrier()
+    if rank == 0:
+        with open(out_file, 'w') as f:
+            json.dump({'seconds': perf_counter() - begin}, f)
+    D.cleanup()
+
+
+@suite('ensemble')
+def bench_ensemble(ctx):
+    '''
+        Inference of 2, 4 and 8 member ensembles with the members run one
+        after the other, in threads, or fused into a StackedEnsemble, next
+        to the slowest single member.
+    '''
+    scale = min(ctx.scales)
+    dataset, batches = ctx.batches(scale, ctx.args.batches, ctx.args.batch_size)
+    n_essays = sum(len(batch[0]) for batch in batches)
+    imv = [float(np.mean(dataset.y))]
+    for model_type, aggregation in [('regp', 'mot'), ('bregp', 'attsum')]:
+        paths = []
+        member_s = 0.
+        for i in range(max(ENSEMBLE_SIZES)):
+            torch.manual_seed(ctx.args.seed + i)
+            member = Model(model_args(model_type=model_type, aggregation=aggregation, cnn_dim=ctx.args.cnn_dim), dataset.vocab, imv)
+            member.eval()
+            with torch.no_grad():
+                member_s = max(member_s, timeit(lambda: run_model(member, batches), repeat=ctx.repeat)['median_s'])
+            paths.append(os.path.join(ctx.data_dir, 'member_%s_%d.pt' % (model_type, i)))
+            torch.save(member, paths[-1])
+        for strategy, n_members in [(s, n) for s in ['mean', 'median'] for n in ENSEMBLE_SIZES]:
+            params = {'type': model_type, 'aggregation': aggregation, 'members': n_members, 'essays': n_essays,
+                      'batch_size': ctx.args.batch_size}
+            models = [('sequential', EnsembleModel(paths[:n_members], strategy, parallel=False)),
+                      ('threads', EnsembleModel(paths[:n_members], strategy, parallel=True)),
+                      ('stacked', StackedEnsemble(paths[:n_members], strategy))]
+            with torch.no_grad():
+                xs, ys, ps, padding_mask, lens, extras = batches[0]
+                reference = models[0][1].eval()(xs, mask=padding_mask, lens=lens, pos=extras.pos, features=extras.features)
+            for name, model in models:
+                model.eval()
+                with torch.no_grad():
+                    stats = timeit(lambda: run_model(model, batches), repeat=ctx.repeat)
+                    preds = model(xs, mask=padding_mask, lens=lens, pos=extras.pos, features=extras.features)
+                stats['essays_per_sec'] = n_essays / stats['median_s']
+                stats['slowest_member_s'] = member_s
+                stats['max_abs_diff'] = (preds - reference).abs().max().item()
+                ctx.add('ensemble', name, dict(params, strategy=strategy), stats)
+
+
+@suite('ddp')
+def bench_ddp(ctx):
+    '''
+        Training throughput with 1/2/4/8 gloo processes (as many as there
+        are cores). Every process keeps --batch-size, one epoch covers the
+        dataset once, efficiency = throughput / (world_size * throughput_1).
+    '''
+    scale = min(ctx.scales)
+    dataset = ctx.dataset(scale)
+    margs = model_args(batch_size=ctx.args.batch_size, cnn_dim=ctx.args.cnn_dim, seed=ctx.args.seed)
+    base = None
+    for world_size in [1, 2, 4, 8]:
+        if world_size > (os.cpu_count() or 1):
+            break
+        out_file = os.path.join(ctx.data_dir, 'ddp_%d.json' % world_size)
+        D.spawn(_ddp_worker, world_size, ctx.args.dist_port + world_size, dataset, margs, ctx.args.ddp_epochs, out_file)
+        with open(out_file, 'r') as f:
+            seconds = json.load(f)['seconds']
+        throughput = ctx.args.ddp_epochs * len(dataset) / seconds
+        if base is None:
+            base = throughput
+        ctx.add('ddp', 'train', {'essays': scale, 'world_size': world_size, 'batch_size': ctx.args.batch_size},
+                {'median_s': seconds, 'essays_per_sec': throughput,
+                 'speedup': throughput / base, 'efficiency': throughput / (base * world_size),
+                 'threads_per_worker': float(D.threads_per_worker(world_size))})
+
+
+def train_model(model, dataset, margs, epochs, bf16=False):
+    '''
+        train.py's loop on dataset, without the logging. Returns the number
+        of steps skipped for non finite gradients.
+    '''
+    parameters = list(model.parameters())
+    optimizer = U.get_optimizer(margs, parameters)
+    model.train()
+    skipped = 0
+    for epoch in range(epochs):
+        for xs, ys, ps, padding_mask, lens, extras in ASAPDataLoader(dataset, dataset.maxlen, margs.batch_size):
+            with bf16_autocast(bf16):
+                youts = model(xs, mask=padding_mask, lens=lens, pos=extras.pos, features=extras.features)
+            loss = F.mse_loss(youts.float().squeeze(1), ys)
+            optimizer.zero_grad()
+            loss.backward()
+            if finite(torch.nn.utils.clip_grad_norm_(parameters, margs.clip_norm)):
+                optimizer.step()
+            else:
+                skipped += 1
+    return skipped
+
+
+def mean_qwk(preds, dataset):
+    '''
+        Mean over the prompts of dataset of the QWK of raw outputs against
+        its (model friendly) scores.
+    '''
+    prompts = np.asarray(dataset.prompts)
+    pred_ys = score_scaler.to_ratings(np.asarray(preds), prompts)
+    true_ys = score_scaler.to_ratings(np.asarray(dataset.y), prompts)
+    kappas = []
+    for prompt in np.unique(prompts).tolist():
+        low, high = score_scaler.range(prompt)
+        rows = prompts == prompt
+        kappas.append(quadratic_weighted_kappa(pred_ys[rows], true_ys[rows], min_rating=low, max_rating=high))
+    return float(np.mean(kappas))
+
+
+@suite('bf16')
+def bench_bf16(ctx):
+    '''
+        bfloat16 autocast against float32 on CPU. Forward and
+        forward_backward throughput of the same weights, then the same
+        initial model trained --bf16-epochs on 80% of the essays in each
+        precision and scored on the other 20% in both: QWK, its delta to
+        the float32 run, and the largest prediction difference.
+    '''
+    scale = min(ctx.scales)
+    dataset, batches = ctx.batches(scale, ctx.args.batches, ctx.args.batch_size)
+    n_essays = sum(len(batch[0]) for batch in batches)
+    imv = [float(np.mean(dataset.y))]
+    order = np.random.RandomState(ctx.args.seed).permutation(len(dataset))
+    n_train = int(0.8 * len(dataset))
+    train_set, test_set = dataset.subset(order[:n_train]), dataset.subset(order[n_train:])
+    epochs = ctx.args.bf16_epochs
+    for model_type, aggregation in [('regp', 'mot'), ('bregp', 'attsum')]:
+        params = {'type': model_type, 'aggregation': aggregation, 'essays': n_essays,
+                  'batch_size': ctx.args.batch_size, 'cnn_dim': ctx.args.cnn_dim}
+        margs = model_args(model_type=model_type, aggregation=aggregation, cnn_dim=ctx.args.cnn_dim,
+                           batch_size=ctx.args.batch_size)
+        try:
+            torch.manual_seed(ctx.args.seed)
+            model = Model(margs, dataset.vocab, imv)
+            fp32_s = {}
+            for name, train in [('forward', False), ('forward_backward', True)]:
+                for bf16 in [False, True]:
+                    model.train(train)
+                    with torch.set_grad_enabled(train):
+                        stats = timeit(lambda: run_model(model, batches, train=train, bf16=bf16), repeat=ctx.repeat)
+                    stats['essays_per_sec'] = n_essays / stats['median_s']
+                    if bf16:
+                        stats['speedup'] = fp32_s[name] / stats['median_s']
+                    else:
+                        fp32_s[name] = stats['median_s']
+                    ctx.add('bf16', '%s_%s' % ('bf16' if bf16 else 'fp32', name), params, stats)
+            train_params = dict(params, epochs=epochs, essays=len(train_set), test_essays=len(test_set))
+            fp32_qwk = None
+            for bf16 in [False, True]:
+                torch.manual_seed(ctx.args.seed)
+                model = Model(margs, dataset.vocab, imv)
+                begin = perf_counter()
+                skipped = train_model(model, train_set, margs, epochs, bf16=bf16)
+                seconds = perf_counter() - begin
+                preds = predict(model, test_set, ctx.args.batch_size)
+                bf16_preds = predict(model, test_set, ctx.args.batch_size, bf16=True)
+                qwk = mean_qwk(bf16_preds if bf16 else preds, test_set)
+                stats = {'median_s': seconds, 'essays_per_sec': epochs * len(train_set) / seconds,
+                         'skipped_steps': float(skipped), 'qwk': qwk,
+                         'qwk_fp32_inference': mean_qwk(preds, test_set),
+                         'qwk_bf16_inference': mean_qwk(bf16_preds, test_set),
+                         'max_abs_pred_diff': float(np.abs(bf16_preds - preds).max())}
+                if bf16:
+                    stats['qwk_delta'] = qwk - fp32_qwk
+                else:
+                    fp32_qwk = qwk
+                ctx.add('bf16', '%s_train' % ('bf16' if bf16 else 'fp32'), train_params, stats)
+        except Exception as e:
+            # Recorded so the other configs still run, main() exits non zero.
+            logger.exception('bf16 %s/%s failed' % (model_type, aggregation))
+            ctx.add('bf16', 'error', params, {'error': repr(e)})
+
+
+@suite('qwk')
+def bench_qwk(ctx):
+    rng = np.random.RandomState(ctx.args.seed)
+    for scale in ctx.scales:
+        for low, high in [(2, 12), (0, 60)]:
+            a = rng.randint(low, high + 1, size=scale)
+            b = np.clip(a + rng.randint(-2, 3, size=scale), low, high)
+            stats = timeit(lambda: quadratic_weighted_kappa(a, b, min_rating=low, max_rating=high), repeat=ctx.repeat)
+            ctx.add('qwk', 'quadratic_weighted_kappa', {'essays': scale, 'range': [low, high]}, stats)
+        prompts = rng.randint(1, 9, size=scale)
+        preds = rng.rand(scale).astype(np.float32)
+        stats = timeit(lambda: score_scaler.to_ratings(preds, prompts), repeat=ctx.repeat)
+        ctx.add('qwk', 'to_ratings', {'essays': scale}, stats)
+
+
+def metadata(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([
+        ('commit', commit),
+        ('python', sys.version.split()[0]),
+        ('torch', torch.__version__),
+        ('numpy', np.__version__),
+        ('platform', platform.platform()),
+        ('processor', platform.processor()),
+        ('threads', torch.get_num_threads()),
+        ('seed', args.seed),
+        ('suites', args.suites)
+        ])
+
+
+def compare(results, baseline_file):
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)
+
+    def key(r):
+        return (r['suite'], r['name'], json.dumps(r['params'], sort_keys=True))
+    old = {key(r): r for r in baseline['results'] if 'median_s' in r}
+    print('%-10s %-26s %-60s %10s %10s %8s' % ('suite', 'name', 'params', 'old(s)', 'new(s)', 'ratio'))
+    for r in results:
+        if 'median_s' not in r or key(r) not in old:
+            continue
+        before = old[key(r)]['median_s']
+        print('%-10s %-26s %-60s %10.5f %10.5f %8.3f' % (r['suite'], r['name'], json.dumps(r['params'], sort_keys=True)[:60],
+                                                       before, r['median_s'], r['median_s'] / before))
+
+
+def main(args):
+    U.set_logger()
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    ctx = BenchmarkContext(args)
+    logger.info('Synthetic data in ' + ctx.data_dir)
+    for name in args.suites:
+        logger.info('Running suite ' + name)
+        SUITES[name](ctx)
+    output = OrderedDict([('meta', metadata(args)), ('results', ctx.results)])
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1)
+    logger.info('Wrote %d results to %s' % (len(ctx.results), args.output))
+    if args.compare:
+        compare(ctx.results, args.compare)
+    failed = [r for r in ctx.results if 'error' in r]
+    if len(failed) > 0:
+        logger.error('%d benchmarks failed: %s' % (len(failed), ', '.join('%s %s' % (r['suite'], json.dumps(r['params'], sort_keys=True)) for r in failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks dataset/loader/model/metric hot paths on synthetic data')
+    parser.add_argument('-o', '--output', type=str, default='benchmark.json', help='JSON file to write the results to')
+    parser.add_argument('--suites', type=str, nargs='+', default=[s for s in SUITES if s != 'ddp'], choices=list(SUITES.keys()), help='Suites to run (default: all but ddp)')
+    parser.add_argument('--scales', type=int, nargs='+', default=[200, 1000, 5000], help='Number of essays for each scale')
+    parser.add_argument('--data-dir', dest='data_dir', type=str, default=None, help='Where to put/reuse the synthetic TSVs (default: a temp dir)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed repetitions per measurement')
+    parser.add_argument('--batches', type=int, default=10, help='Batches per model measurement')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=32, help='Batch size for the model suite')
+    parser.add_argument('-c', '--cnndim', dest='cnn_dim', type=int, default=0, help='CNN dimension for the model suite')
+    parser.add_argument('--maxlen', type=int, default=0, help='Maximum essay length (0 means no limit)')
+    parser.add_argument('--ddp-epochs', dest='ddp_epochs', type=int, default=1, help='Epochs per measurement in the ddp suite')
+    parser.add_argument('--bf16-epochs', dest='bf16_epochs', type=int, default=3, help='Training epochs per precision in the bf16 suite')
+    parser.add_argument('--dist-port', dest='dist_port', type=int, default=29500, help='Base port for the ddp suite process groups')
+    parser.add_argument('--tokenize-tsv', dest='tokenize_tsv', type=str, default=None, help='ASAP TSV for the tokenize suite (default: synthetic essays)')
+    parser.add_argument('--tokenize-essays', dest='tokenize_essays', type=int, default=2000, help='Essays used by the tokenize suite')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads (0 keeps the default)')
+    parser.add_argument('--seed', type=int, default=1234, help='Random seed')
+    parser.add_argument('--compare', type=str, default=None, help='Earlier JSON output to compare against')
+    args = parser.parse_args()
+
+    main(args)
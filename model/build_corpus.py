@@ -0,0 +1,35 @@
+import argparse
+import logging
+from src.corpus import ASAPCorpus
+from src.tokenizers import TOKENIZERS
+from src.profiling import profiler
+import src.utils as U
+
+logger = logging.getLogger(__name__)
+
+
+def main(args):
+    U.set_logger()
+    profiler.enable()
+    corpus = ASAPCorpus(args.input_file, pos=args.pos, tokenizer=args.tokenizer, pos_workers=args.pos_workers)
+    corpus.add_folds(args.fold_dir, n_folds=args.n_folds)
+    corpus.save(args.output)
+    profiler.report(0, prefix='corpus/')
+    logger.info('Saved corpus to ' + args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tokenizes the ASAP training file once and stores the folds as essay indices (use with train.py --corpus --fold)')
+    parser.add_argument('-i', '--input-file', dest='input_file', required=True, type=str, metavar='<str>',
+                    help='Input TSV file (training_set_rel3.tsv)')
+    parser.add_argument('-f', '--fold-dir', dest='fold_dir', default='../data', type=str, metavar='<str>',
+                    help='Directory with the fold_k/{train,dev,test}_ids.txt files (default=../data)')
+    parser.add_argument('-o', '--output', required=True, type=str, metavar='<str>',
+                    help='Where to save the corpus (pickle)')
+    parser.add_argument('--n-folds', dest='n_folds', default=5, type=int, metavar='<int>', help='Number of folds (default=5)')
+    parser.add_argument("--pos", dest="pos", action='store_true', help="Also POS tag the essays (needed to train with --pos)")
+    parser.add_argument("--pos-workers", dest="pos_workers", type=int, metavar='<int>', default=1, help="Processes for POS tagging with --pos (default=1)")
+    parser.add_argument("--tokenizer", dest="tokenizer", type=str, metavar='<str>', default='nltk', help="Tokenizer backend (%s) (default=nltk)" % '|'.join(TOKENIZERS.keys()))
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,103 @@
+import os
+import argparse
+import itertools
+import logging
+from time import perf_counter
+import numpy as np
+import torch
+from src.dataset import ASAPDataset, LONG_ESSAYS, long_essays_from_args
+from src.features import FEATURES, features_from_args
+from src.evaluation import checkpoint_vocab, qwk
+from src.model import vote, VOTING_STRATEGIES
+from src.prediction_cache import PredictionCache
+import src.utils as U
+
+logger = logging.getLogger(__name__)
+
+
+def checkpoints(paths):
+    '''
+        Files as is, directories expanded to the files in them.
+    '''
+    ret = []
+    for path in paths:
+        if os.path.isdir(path):
+            ret.extend(sorted(os.path.join(path, f) for f in os.listdir(path)))
+        else:
+            ret.append(path)
+    return ret
+
+
+def ensembles(n_models, sizes, strategies):
+    '''
+        (members, strategy) for every subset of the requested sizes. With
+        supervisor, the last member is the supervisor, so every member of
+        a triple gets a turn.
+    '''
+    for size in sizes:
+        for members in itertools.combinations(range(n_models), size):
+            for strategy in strategies:
+                if strategy == 'supervisor':
+                    if size != 3:
+                        continue
+                    for supervisor in members:
+                        yield tuple(m for m in members if m != supervisor) + (supervisor,), strategy
+                else:
+                    yield members, strategy
+
+
+def main(args):
+    U.set_logger()
+    paths = checkpoints(args.models)
+    # The vocab the members were trained with (all of them share it).
+    vocab = checkpoint_vocab(paths)
+    test_dataset = ASAPDataset(args.test_path, vocab=vocab, pos=args.pos, prompt_id=args.prompt, maxlen=args.maxlen, vocab_size=args.vocab_size, features=args.features, tokenizer=args.tokenizer, **long_essays_from_args(args))
+    cache = PredictionCache(args.cache_dir)
+    # n_essays * n_models
+    preds = torch.from_numpy(np.stack([cache.predictions(path, test_dataset, args.batch_size, cuda=args.cuda) for path in paths], axis=1))
+
+    start = perf_counter()
+    scores = []
+    for members, strategy in ensembles(len(paths), args.sizes or [len(paths)], args.strategies):
+        voted = vote(preds[:, list(members)], strategy).view(-1).numpy()
+        scores.append((qwk(voted, test_dataset, args.prompt), members, strategy))
+    logger.info('Scored %d ensembles in %.3fs' % (len(scores), perf_counter() - start))
+
+    for i, path in enumerate(paths):
+        print('Single model %d: QWK %.4f %s' % (i, qwk(preds[:, i].numpy(), test_dataset, args.prompt), path))
+    scores.sort(key=lambda score: score[0], reverse=True)
+    for rank, (score, members, strategy) in enumerate(scores[:args.top]):
+        print('Rank : %d Score: %f : %s of %s' % (rank, score, strategy, ' '.join(os.path.basename(paths[m]) for m in members)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluates ensembles of saved models from cached predictions')
+    parser.add_argument('-m', '--models', required=True, type=str, nargs='+', metavar='<str>',
+                    help='Model paths, or directories of models')
+    parser.add_argument('-t', '--test-path', dest="test_path", required=True, type=str, metavar='<str>',
+                    help='Path to the test dataset')
+    parser.add_argument('--prompt', dest="prompt", type=int, required=True,
+                    help='Prompt id')
+    parser.add_argument('--cache-dir', dest="cache_dir", type=str, default='prediction_cache', metavar='<str>',
+                    help='Prediction cache directory (default=prediction_cache)')
+    parser.add_argument('--strategies', type=str, nargs='+', default=list(VOTING_STRATEGIES), choices=VOTING_STRATEGIES,
+                    help='Voting strategies to evaluate')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None,
+                    help='Ensemble sizes to search over (default: all the models)')
+    parser.add_argument('--top', type=int, default=10, help='Number of ensembles to print')
+    parser.add_argument("--maxlen", dest="maxlen", type=int, metavar='<int>', default=0, help="Maximum allowed number of words during training. '0' means no limit (default=0)")
+    parser.add_argument("--long-essays", dest="long_essays", type=str, metavar='<str>', default='drop', choices=LONG_ESSAYS, help="What to do with essays over --maxlen words, must match the training (drop|truncate|window) (default=drop)")
+    parser.add_argument("--window-size", dest="window_size", type=int, metavar='<int>', default=0, help="Words per window with --long-essays window. '0' means --maxlen (default=0)")
+    parser.add_argument("--window-stride", dest="window_stride", type=int, metavar='<int>', default=0, help="Words between window starts with --long-essays window. '0' means half a window (default=0)")
+    parser.add_argument("-v", "--vocab-size", dest="vocab_size", type=int, metavar='<int>', default=4000, help="Vocab size (default=4000)")
+    parser.add_argument('-b', '--batch_size', default=64, type=int, help='Batch size for models that are not cached yet')
+    parser.add_argument("--pos", dest="pos", action='store_true', help="Use part of speech tagging in the training")
+    parser.add_argument("--variety", dest="variety", action='store_true', help="Variety of words in output layer")
+    parser.add_argument("--punct-count", dest="punct", action='store_true', help="Variety of words in output layer")
+    parser.add_argument("--features", dest="features", type=str, nargs='*', metavar='<str>', default=[], help="Essay level features fed to the output layer (%s)" % '|'.join(FEATURES.keys()))
+    parser.add_argument("--tokenizer", dest="tokenizer", type=str, metavar='<str>', default='nltk', help="Tokenizer backend (nltk|regex), must match the one used in training (default=nltk)")
+    parser.add_argument('--cuda', dest='cuda', action='store_true', help='Run uncached models on GPU')
+    args = parser.parse_args()
+    args.features = features_from_args(args)
+
+    main(args)
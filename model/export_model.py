@@ -0,0 +1,62 @@
+import argparse
+import logging
+import numpy as np
+from src.dataset import ASAPDataset
+from src.features import FEATURES, features_from_args
+from src.evaluation import load_model, predict, qwk
+from src.export import export_model
+import src.utils as U
+
+logger = logging.getLogger(__name__)
+
+
+def timed_predict(model, dataset, args):
+    predict(model, dataset, args.batch_size)  # Warm up (and let the JIT optimize).
+    timings = []
+    for _ in range(args.repeat):
+        preds = predict(model, dataset, args.batch_size, timings=timings)
+    return preds, len(dataset) * args.repeat / sum(timings)
+
+
+def main(args):
+    U.set_logger()
+    model = load_model(args.model)
+    scripted = export_model(model, args.output, freeze=not args.no_freeze)
+    if args.test_path is None:
+        return
+    # Check the exported module against the python model.
+    # Encoded with the vocab the model was trained with.
+    test_dataset = ASAPDataset(args.test_path, vocab=model.vocab, pos=args.pos, prompt_id=args.prompt, maxlen=args.maxlen, vocab_size=args.vocab_size, features=args.features, tokenizer=args.tokenizer)
+    eager_preds, eager_speed = timed_predict(model, test_dataset, args)
+    scripted_preds, scripted_speed = timed_predict(scripted, test_dataset, args)
+    print('eager:    QWK %.4f, %.1f essays/sec' % (qwk(eager_preds, test_dataset, args.prompt), eager_speed))
+    print('scripted: QWK %.4f, %.1f essays/sec' % (qwk(scripted_preds, test_dataset, args.prompt), scripted_speed))
+    print('max |pred delta|: %g' % np.abs(eager_preds - scripted_preds).max())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports the scoring path of a saved model with TorchScript')
+    parser.add_argument('-m', '--model', required=True, type=str, metavar='<str>',
+                    help='Model path')
+    parser.add_argument('-o', '--output', required=True, type=str, metavar='<str>',
+                    help='Where to save the scripted model (load it with torch.jit.load)')
+    parser.add_argument('--no-freeze', dest='no_freeze', action='store_true', help='Do not freeze the scripted module')
+    parser.add_argument('-t', '--test-path', dest="test_path", type=str, metavar='<str>',
+                    help='(Optional) Dataset to check the exported model against the original on')
+    parser.add_argument('--prompt', dest="prompt", type=int, default=None,
+                    help='(Required with -t) Prompt id')
+    parser.add_argument("--maxlen", dest="maxlen", type=int, metavar='<int>', default=0, help="Maximum allowed number of words during training. '0' means no limit (default=0)")
+    parser.add_argument("-v", "--vocab-size", dest="vocab_size", type=int, metavar='<int>', default=4000, help="Vocab size (default=4000)")
+    parser.add_argument('-b', '--batch_size', default=64, type=int, help='Batch size to use for testing')
+    parser.add_argument('--repeat', default=3, type=int, help='Timed passes over the test set')
+    parser.add_argument("--pos", dest="pos", action='store_true', help="Use part of speech tagging in the training")
+    parser.add_argument("--variety", dest="variety", action='store_true', help="Variety of words in output layer")
+    parser.add_argument("--punct-count", dest="punct", action='store_true', help="Variety of words in output layer")
+    parser.add_argument("--features", dest="features", type=str, nargs='*', metavar='<str>', default=[], help="Essay level features fed to the output layer (%s)" % '|'.join(FEATURES.keys()))
+    parser.add_argument("--tokenizer", dest="tokenizer", type=str, metavar='<str>', default='nltk', help="Tokenizer backend (nltk|regex), must match the one used in training (default=nltk)")
+    args = parser.parse_args()
+    args.features = features_from_args(args)
+    if args.test_path is not None and args.prompt is None:
+        parser.error('-t needs --prompt, QWK is per prompt')
+
+    main(args)
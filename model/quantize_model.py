@@ -0,0 +1,79 @@
+import argparse
+import logging
+import numpy as np
+import torch
+from src.dataset import ASAPDataset
+from src.features import FEATURES, features_from_args
+from src.evaluation import load_model, predict, qwk
+from src.quantization import quantize_model, model_size
+import src.utils as U
+
+logger = logging.getLogger(__name__)
+
+
+def benchmark(model, dataset, args):
+    '''
+        Returns predictions, and timings over args.repeat passes
+    '''
+    preds = predict(model, dataset, args.batch_size)  # Warm up.
+    timings = []
+    for _ in range(args.repeat):
+        predict(model, dataset, args.batch_size, timings=timings)
+    seconds = sum(timings) / args.repeat
+    return preds, {
+        'batch_ms': 1000. * np.median(timings),
+        'essays_per_sec': len(dataset) / seconds,
+        'size_mb': model_size(model) / 2**20
+        }
+
+
+def main(args):
+    U.set_logger()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    model = load_model(args.model)
+    # Encoded with the vocab the model was trained with.
+    test_dataset = ASAPDataset(args.test_path, vocab=model.vocab, pos=args.pos, prompt_id=args.prompt, maxlen=args.maxlen, vocab_size=args.vocab_size, features=args.features, tokenizer=args.tokenizer)
+
+    qmodel = quantize_model(model, embeddings=args.embeddings)
+    float_preds, float_stats = benchmark(model, test_dataset, args)
+    int8_preds, int8_stats = benchmark(qmodel, test_dataset, args)
+    float_qwk = qwk(float_preds, test_dataset, args.prompt)
+    int8_qwk = qwk(int8_preds, test_dataset, args.prompt)
+
+    print('%-8s %10s %10s %14s %10s' % ('', 'QWK', 'batch ms', 'essays/sec', 'size MB'))
+    for name, score, stats in [('float32', float_qwk, float_stats), ('int8', int8_qwk, int8_stats)]:
+        print('%-8s %10.4f %10.2f %14.1f %10.2f' % (name, score, stats['batch_ms'], stats['essays_per_sec'], stats['size_mb']))
+    print('QWK delta: %+.4f, max |pred delta|: %.4f, speedup: %.2fx' % (
+        int8_qwk - float_qwk, np.abs(int8_preds - float_preds).max(),
+        int8_stats['essays_per_sec'] / float_stats['essays_per_sec']))
+    if args.output:
+        torch.save(qmodel, args.output)
+        print('Saved quantized model to', args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantizes a saved model to int8 and compares it with the float model on a held out fold')
+    parser.add_argument('-m', '--model', required=True, type=str, metavar='<str>',
+                    help='Model path')
+    parser.add_argument('-t', '--test-path', dest="test_path", required=True, type=str, metavar='<str>',
+                    help='Path to the held out dataset')
+    parser.add_argument('--prompt', dest="prompt", type=int, required=True,
+                    help='Prompt id')
+    parser.add_argument('-o', '--output', type=str, default=None, metavar='<str>',
+                    help='Where to torch.save the quantized model')
+    parser.add_argument('--embeddings', action='store_true', help='Also quantize the embedding table to 8 bits')
+    parser.add_argument("--maxlen", dest="maxlen", type=int, metavar='<int>', default=0, help="Maximum allowed number of words during training. '0' means no limit (default=0)")
+    parser.add_argument("-v", "--vocab-size", dest="vocab_size", type=int, metavar='<int>', default=4000, help="Vocab size (default=4000)")
+    parser.add_argument('-b', '--batch_size', default=64, type=int, help='Batch size to use for testing')
+    parser.add_argument('--repeat', default=3, type=int, help='Timed passes over the test set')
+    parser.add_argument('--threads', default=0, type=int, help='torch threads (0 keeps the default)')
+    parser.add_argument("--pos", dest="pos", action='store_true', help="Use part of speech tagging in the training")
+    parser.add_argument("--variety", dest="variety", action='store_true', help="Variety of words in output layer")
+    parser.add_argument("--punct-count", dest="punct", action='store_true', help="Variety of words in output layer")
+    parser.add_argument("--features", dest="features", type=str, nargs='*', metavar='<str>', default=[], help="Essay level features fed to the output layer (%s)" % '|'.join(FEATURES.keys()))
+    parser.add_argument("--tokenizer", dest="tokenizer", type=str, metavar='<str>', default='nltk', help="Tokenizer backend (nltk|regex), must match the one used in training (default=nltk)")
+    args = parser.parse_args()
+    args.features = features_from_args(args)
+
+    main(args)
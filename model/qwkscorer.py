@@ -1,120 +1,83 @@
 import argparse
-import torch
-from src.dataset import ASAPDataset, ASAPDataLoader
-import numpy as np
-from src.qwk import quadratic_weighted_kappa
-import pdb
+from src.dataset import ASAPDataset, LONG_ESSAYS, long_essays_from_args
+from src.features import FEATURES, features_from_args
+from src.evaluation import checkpoint_vocab, load_model, predict, qwk
+from src.prediction_cache import PredictionCache
 import os
-import torch.nn
 
-    # train
-    train_dataset = ASAPDataset(args.train_path, vocab_file=args.out_dir + '/vocab.pkl', pos=args.pos, prompt_id=args.prompt, maxlen=args.maxlen, vocab_size=args.vocab_size)
-    vocab = train_dataset.vocab
-    # scores are already dataset friendly
+
+def main(args):
+    if args.bf16 and args.cuda:
+        raise RuntimeError('--bf16 is the CPU autocast path, drop --cuda')
+    files = os.listdir(args.model)
+    paths = [os.path.join(args.model, file) for file in files]
+    # Every prompt is read and encoded once (with the vocab the models were
+    # trained with, which they all have to share), models are scored on
+    # per prompt views.
+    vocab = checkpoint_vocab(paths)
     # test
-    test_dataset = ASAPDataset(args.test_path, vocab=vocab, pos=args.pos, prompt_id=args.prompt, maxlen=args.maxlen, vocab_size=args.vocab_size)
-    # Scores are already dataset friendly
-    # dev
-    dev_dataset = ASAPDataset(args.dev_path, vocab=vocab, pos=args.pos, prompt_id=args.prompt, maxlen=args.maxlen, vocab_size=args.vocab_size)
+    test_dataset = ASAPDataset(args.test_path, vocab=vocab, pos=args.pos, maxlen=args.maxlen, vocab_size=args.vocab_size, features=args.features, tokenizer=args.tokenizer, **long_essays_from_args(args))
     # Scores are already dataset friendly
+    prompts = args.prompt or sorted(test_dataset.prompt_index().keys())
 
-    score =[]
-    files = os.listdir(args.model)
-    for file in files:
-        path = os.path.join(args.model,file)
+    # Cached outputs are float32 runs, bfloat16 ones are neither read nor stored.
+    cache = PredictionCache(args.cache_dir) if args.cache_dir and not args.bf16 else None
+    score = {prompt: [] for prompt in prompts}
+    for path in paths:
         print("processing this file:" + path)
-        model = torch.load(path, map_location=lambda storage, location: storage)
-        model.eval()
-        if isinstance(model, torch.nn.DataParallel):
-            model = model.module
-        if args.cuda:
-            model.cuda()
-        else:
-            print('in cpu')
-            model.cpu()
-        if isinstance(model, torch.nn.DataParallel) and not(args.cuda):
-            model.args.cuda = False
-        # model.cpu()
-
-        lhs, rhs = ASAPDataset.asap_ranges[args.prompt]
-        num_ratings = rhs - lhs + 1
-        loader = ASAPDataLoader(test_dataset, train_dataset.maxlen, args.batch_size)
-        true_ys = []
-        pred_ys = []
-        #pdb.set_trace()
-        batch = -1
-        for xs, ys, ps, padding_mask, lens, bounds in loader:
-            batch += 1
-            print('Starting batch', batch)
-            xs.cpu()
-            ys.cpu()
-            #pdb.set_trace()
-            if args.pos:
-                indexes = test_dataset.tags_x[bounds[0]:bounds[1]]
-            else:
-                indexes = None
-            if args.variety:
-                variety = test_dataset.unique_x[bounds[0]:bounds[1]]
-                if args.cuda:
-                    variety = variety.cuda()
-                else:
-                    variety = variety.cpu()
-            else:
-                variety = None
-            if args.punct:
-                punct = test_dataset.punct_x[bounds[0]:bounds[1]]
-                if args.cuda:
-                    punct = punct.cuda()
-                else:
-                    punct = punct.cpu()
-            else:
-                punct = None
-
-            pred = model(xs,
-                         mask=padding_mask,
-                         lens=lens,
-                         pos=indexes,
-                         variety=variety,
-                         punct=punct)
-            #pdb.set_trace()
-            true_ys.append(ys.data)
-            pred_ys.append(pred.detach().squeeze().data)
-            #pdb.set_trace()
-        #pdb.set_trace()
-
-        true_ys = torch.cat(true_ys).cpu().numpy().squeeze()
-        pred_ys = np.rint(torch.cat(pred_ys).cpu().numpy().squeeze() * (rhs - lhs) + lhs)
-        score.append(quadratic_weighted_kappa(pred_ys, true_ys, min_rating=lhs, max_rating=rhs))
-        print("Quadratic kappa: {}".format(quadratic_weighted_kappa(pred_ys, true_ys, min_rating=lhs, max_rating=rhs)))
+        model = None
+        for prompt in prompts:
+            view = test_dataset.for_prompt(prompt)
+            preds = cache.get(path, view) if cache is not None else None
+            if preds is None:
+                if model is None:
+                    model = load_model(path, cuda=args.cuda)
+                preds = predict(model, view, args.batch_size, cuda=args.cuda, bf16=args.bf16)
+                if cache is not None:
+                    cache.put(path, view, preds)
+            score[prompt].append(qwk(preds, view, prompt))
+            print("Prompt {}: Quadratic kappa: {}".format(prompt, score[prompt][-1]))
 
-    sortedscore =sorted(score, reverse=True)
-    for count in range(min(10,len(score))):
-        val = score.index(sortedscore[count])
-        print('Rank : %d Score: %f : Name: %s'%(count,sortedscore[count], files[val]))
+    for prompt in prompts:
+        if len(prompts) > 1:
+            print('Prompt %d' % prompt)
+        sortedscore =sorted(score[prompt], reverse=True)
+        for count in range(min(10,len(sortedscore))):
+            val = score[prompt].index(sortedscore[count])
+            print('Rank : %d Score: %f : Name: %s'%(count,sortedscore[count], files[val]))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Evaluates a saved model')
     parser.add_argument('-m', '--model', required=True, type=str, metavar='<str>',
                     help='Model path')
-    parser.add_argument('-r', '--train', dest="train_path", required=True, type=str, metavar='<str>',
-                    help='Path to the training dataset (needed for vocabs)')
+    parser.add_argument('-r', '--train', dest="train_path", type=str, metavar='<str>',
+                    help='(Ignored, the vocab is read from the saved models)')
     parser.add_argument('-t', '--test-path', dest="test_path" , required=True, type=str, metavar='<str>',
                     help='Path to the test dataset')
-    parser.add_argument('-d', '--dev-path', dest="dev_path", required=True, type=str, metavar='<str>',
-                    help='Path to the development ids')
+    parser.add_argument('-d', '--dev-path', dest="dev_path", required=False, type=str, metavar='<str>',
+                    help='(Unused) Path to the development ids')
     #parser.add_argument('-p', '--pos', dest="pos", action="store_true",
     #                help='Whether to use POS in the model (the model must be trained with pos)')
-    parser.add_argument('--prompt', dest="prompt", type=int, required=True,
-                    help='Prompt id')
+    parser.add_argument('--prompt', dest="prompt", type=int, nargs='*', default=None,
+                    help='Prompt id(s) to rank the models on (default: every prompt in the test set)')
     # Maxlen and vocab size
     parser.add_argument("--maxlen", dest="maxlen", type=int, metavar='<int>', default=0, help="Maximum allowed number of words during training. '0' means no limit (default=0)")
+    parser.add_argument("--long-essays", dest="long_essays", type=str, metavar='<str>', default='drop', choices=LONG_ESSAYS, help="What to do with essays over --maxlen words, must match the training (drop|truncate|window) (default=drop)")
+    parser.add_argument("--window-size", dest="window_size", type=int, metavar='<int>', default=0, help="Words per window with --long-essays window. '0' means --maxlen (default=0)")
+    parser.add_argument("--window-stride", dest="window_stride", type=int, metavar='<int>', default=0, help="Words between window starts with --long-essays window. '0' means half a window (default=0)")
     parser.add_argument("-v", "--vocab-size", dest="vocab_size", type=int, metavar='<int>', default=4000, help="Vocab size (default=4000)")
     parser.add_argument('-b', '--batch_size', default=64, type=int, help='Batch size to use for testing. CANT BUY MOAR RAM')
     parser.add_argument("--pos", dest="pos", action='store_true', help="Use part of speech tagging in the training")
     parser.add_argument("--variety", dest="variety", action='store_true', help="Variety of words in output layer")
     parser.add_argument("--punct-count", dest="punct", action='store_true', help="Variety of words in output layer")
+    parser.add_argument("--features", dest="features", type=str, nargs='*', metavar='<str>', default=[], help="Essay level features fed to the output layer (%s)" % '|'.join(FEATURES.keys()))
+    parser.add_argument("--tokenizer", dest="tokenizer", type=str, metavar='<str>', default='nltk', help="Tokenizer backend (nltk|regex), must match the one used in training (default=nltk)")
     parser.add_argument('--cuda', type=bool, default=False, help='cuda')    
+    parser.add_argument('--cache-dir', dest="cache_dir", type=str, default=None, metavar='<str>',
+                    help='(Optional) Prediction cache directory, models already scored on this test set are not run again')
+    parser.add_argument('--bf16', dest='bf16', action='store_true', help='Run the models in bfloat16 mixed precision (CPU autocast, no --cuda)')
     args = parser.parse_args()
+    args.features = features_from_args(args)
 
     main(args)
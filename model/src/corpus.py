@@ -0,0 +1,108 @@
+'''
+    The whole ASAP training file (training_set_rel3.tsv) tokenized (and
+    POS tagged) once, with the fold splits of data/fold_k/*_ids.txt kept as
+    index arrays. A fold's train/dev/test datasets are built from the
+    stored tokens, so a 5 fold run tokenizes every essay once instead of
+    once per fold and split file.
+'''
+
+# general imports
+import os
+import pickle
+import logging
+from collections import namedtuple, OrderedDict
+import numpy as np
+# User imports
+from .dataset import ASAPDataset, tsv_encoding
+from .profiling import profiler
+from .tokenizers import get_tokenizer
+
+logger = logging.getLogger(__name__)
+
+#   vocab_words: tokens of the lower cased essay (what the vocab is built from)
+#   words: tokens of the essay (what is encoded)
+#   tags: POS_DICT encoded tags of words, None without pos
+CorpusEssay = namedtuple('CorpusEssay', ['id', 'prompt', 'score', 'vocab_words', 'words', 'tags'])
+
+SPLITS = ('train', 'dev', 'test')
+
+
+class ASAPCorpus:
+    def __init__(self, tsv_file, pos=False, tokenizer='nltk', score_index=6, pos_workers=1):
+        self.tsv_file = tsv_file
+        self.pos = pos
+        self.tokenizer_name = get_tokenizer(tokenizer).name
+        self.essays = []
+        self.folds = OrderedDict()  # fold -> split -> positions in self.essays
+        # Only the tokenizing helpers of ASAPDataset are used.
+        helper = ASAPDataset.__new__(ASAPDataset)
+        helper.tokenizer = get_tokenizer(tokenizer)
+        logger.info('Tokenizing ' + tsv_file)
+        rows, essay_sentences = [], []
+        with open(tsv_file, 'r', encoding=tsv_encoding) as f:
+            next(f)  # Header
+            for line in f:
+                tokens = line.strip('\r\n').split('\t')
+                content = tokens[2]
+                with profiler.timer('tokenize'):
+                    vocab_words = helper.tokenize(content.lower())
+                    sentences = helper.tokenizer.sentences(content)
+                    words = helper._merged_tokens(sentences)
+                rows.append((int(tokens[0]), int(tokens[1]), float(tokens[score_index]), vocab_words, words))
+                if pos:
+                    essay_sentences.append(sentences)
+        tags = helper.tag_essays(essay_sentences, workers=pos_workers) if pos else [None] * len(rows)
+        self.essays = [CorpusEssay(*row, tags=tagged) for row, tagged in zip(rows, tags)]
+        self.positions = {essay.id: i for i, essay in enumerate(self.essays)}
+        logger.info('  %d essays' % len(self.essays))
+
+    def add_folds(self, fold_dir, n_folds=5):
+        '''
+            Reads fold_dir/fold_k/{train,dev,test}_ids.txt for k < n_folds.
+        '''
+        for fold in range(n_folds):
+            self.folds[fold] = OrderedDict()
+            for split in SPLITS:
+                self.folds[fold][split] = self.read_ids(os.path.join(fold_dir, 'fold_%d' % fold, '%s_ids.txt' % split))
+            logger.info('  fold %d: %s' % (fold, ', '.join('%d %s' % (len(self.folds[fold][s]), s) for s in SPLITS)))
+
+    def read_ids(self, id_file):
+        '''
+            Positions of the essays listed in id_file, in its order.
+        '''
+        positions = []
+        with open(id_file, 'r') as f:
+            for line in f:
+                essay_id = line.strip('\r\n').split('\t')[0]
+                if essay_id == '':
+                    continue
+                if int(essay_id) not in self.positions:
+                    raise KeyError('Essay %s of %s is not in %s' % (essay_id, id_file, self.tsv_file))
+                positions.append(self.positions[int(essay_id)])
+        return np.asarray(positions, dtype=np.int64)
+
+    def dataset(self, fold, split, vocab=None, vocab_size=-1, maxlen=-1, prompt_id=-1, features=(), pos=None,
+                long_essays='drop', window_size=0, window_stride=0):
+        '''
+            ASAPDataset of one split of a fold, what reading the
+            fold_k/<split>.tsv file preprocess_data.py writes would give.
+        '''
+        if pos is None:
+            pos = self.pos
+        if pos and not self.pos:
+            raise RuntimeError('The corpus was built without --pos')
+        essays = [self.essays[i] for i in self.folds[fold][split]]
+        return ASAPDataset.from_essays(essays, '%s#fold_%d/%s' % (self.tsv_file, fold, split),
+                                       maxlen=maxlen, vocab_size=vocab_size, vocab=vocab,
+                                       prompt_id=prompt_id, pos=pos, features=features,
+                                       tokenizer=self.tokenizer_name, long_essays=long_essays,
+                                       window_size=window_size, window_stride=window_stride)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
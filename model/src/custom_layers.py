@@ -22,8 +22,9 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.autograd import Variable
 from torch.distributions import Bernoulli
+from torch.nn.utils.rnn import PackedSequence
 # Custom imports
-from .utils import tensordot
+from .utils import tensordot, packed_batch_index
 
 class Conv1DWithMasking(torch.nn.Module):
     def __init__(self, *args, **kwargs):
@@ -33,29 +34,57 @@ class Conv1DWithMasking(torch.nn.Module):
         self.weight = self.conv.weight
         self.bias = self.conv.bias
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, channels_first=False):
+        '''
+            x: batch_size * max_seq_length * channels, or
+               batch_size * channels * max_seq_length with channels_first
+            mask: batch_size * max_seq_length, 0 on padding
+            The output has the same layout as x.
+        '''
         # pdb.set_trace()
         # Shouldn't need because padding is 0
-        # mask_expanded = mask.unsqueeze(2).expand(*x.size())
-        # inp = (x * mask_expanded).expand([0, 2, 1])
-        inp = x.permute([0, 2, 1])
+        inp = x if channels_first else x.transpose(1, 2)
         res = self.conv(inp)
-        res = res.permute([0, 2, 1])
-        res = res * (mask.unsqueeze(2).expand(*res.size()) if mask is not None else 1)
-        return res
+        if mask is not None:
+            # In place and broadcast, the conv output is not needed for backward.
+            res.mul_(mask[:, :res.size(2)].unsqueeze(1))
+        return res if channels_first else res.transpose(1, 2)
 
 class MeanOverTime(torch.nn.Module):
     def __init__(self, *args, **kwargs):
         super(MeanOverTime, self).__init__()
 
     def forward(self, x, mask=None, lens=None, dim=1):
+        '''
+            x: PackedSequence, or Variable batch_size * max_seq_length * dimensionality
+            mask: batch_size * max_seq_length, 0 on padding
+        '''
         # pdb.set_trace()
+        if isinstance(x, PackedSequence):
+            return self.packed_forward(x)
+        if mask is not None:
+            # Don't count on padding being zero (e.g. after dropout).
+            x = x * mask[:, :x.size(dim)].unsqueeze(2)
         if lens is None:
             return x.mean(dim=dim)
         else:
             s = x.sum(dim=dim)
             return s / lens.unsqueeze(1).expand(*s.size()).float()
 
+    def packed_forward(self, x):
+        '''
+            Segment sums over PackedSequence.data, which only holds real
+            time steps, so no padded tensor is built.
+        '''
+        batch_index = packed_batch_index(x.batch_sizes).to(x.data.device)
+        batch_size = int(x.batch_sizes[0])
+        s = x.data.new_zeros(batch_size, x.data.size(1)).index_add_(0, batch_index, x.data)
+        lens = torch.bincount(batch_index, minlength=batch_size).unsqueeze(1).to(s.dtype)
+        s = s / lens
+        if x.unsorted_indices is not None:
+            s = s.index_select(0, x.unsorted_indices)
+        return s
+
     def output_shape(self, input_shape):
         return torch.Size(input_shape[0], input_shape[2])
 
@@ -74,17 +103,33 @@ class Attention(torch.nn.Module):
     def forward(self, x, mask=None, lens=None, dim=1):
         '''
             x: Variable batch_size * max_seq_length * dimensionality
-            mask: batch_size * max_seq_length
+            mask: batch_size * max_seq_length, 0 on padding
+            Only dim=1 (time) pooling is supported.
         '''
-        # batch_size * max_seq_length * input_size
-        temp = self.attention_fn(tensordot(x, self.att_W))
-        # batch_size * max_seq_length * 1
-        w = F.softmax(tensordot(temp, self.att_V), dim=2)  #
-        # batch_size * max_seq_length * input_size
-        w = w.expand(*w.size()[:-1], self.input_size)
-        xw = x * w
-        s = xw.sum(dim=dim)
+        # batch_size * max_seq_length
+        scores = torch.matmul(self.attention_fn(torch.matmul(x, self.att_W)), self.att_V).squeeze(2)
+        if mask is not None:
+            # Padding gets no weight.
+            scores = scores.masked_fill(mask[:, :scores.size(1)] == 0, float('-inf'))
+        w = F.softmax(scores, dim=1)
+        # batch_size * input_size, weighted sum as one batched matmul
+        s = torch.bmm(w.unsqueeze(1), x).squeeze(1)
         if self.op == 'attsum':
             return s
         elif self.op == 'attmean':
             return s / lens.unsqueeze(1).expand(*s.size()).float()
+
+
+def pool_segments(windows: torch.Tensor, segments: torch.Tensor) -> torch.Tensor:
+    '''
+        Mean of the representations of every essay's windows.
+        windows: n_windows * ...
+        segments: LongTensor n_windows, essay (0..n_essays-1) of every window
+        Returns n_essays * ...
+    '''
+    segments = segments.to(windows.device)
+    n_essays = int(segments.max()) + 1
+    pooled = torch.zeros([n_essays] + list(windows.shape[1:]), dtype=windows.dtype, device=windows.device)
+    pooled = pooled.index_add_(0, segments, windows)
+    counts = torch.bincount(segments, minlength=n_essays).to(windows.dtype)
+    return pooled / counts.view([n_essays] + [1] * (windows.dim() - 1))
@@ -10,6 +10,7 @@ __mail__ = 'haroun7@gmail.com'
 # general imports
 import argparse
 import pickle
+import copy
 import os
 import sys
 import pdb
@@ -17,6 +18,7 @@ import numpy as np
 import logging
 import nltk
 import re
+import itertools
 # pytorch imports
 import torch
 import torch.utils.data
@@ -26,26 +28,47 @@ import torch.optim as optim
 from torch.autograd import Variable
 from torch.distributions import Bernoulli
 import operator
-from collections import defaultdict
-
-from nltk.tag.perceptron import PerceptronTagger
-tagger = PerceptronTagger()
+from collections import defaultdict, namedtuple
+# User imports
+from .features import FEATURES, FeatureContext, extract_features, register_feature, pos_distribution_feature
+from .profiling import profiler
+from .tokenizers import get_tokenizer, merge_entities
+from .pos_tagging import pos_tagger
+from .scores import ASAP_RANGES, score_scaler
+from .vocab import Vocabulary, as_vocabulary, num_regex
 
 POS_DICT = defaultdict(lambda: 0)
 
 POS = [     "CC",     "CD",     "DT",     "EX",     "FW",     "IN",     "JJ",     "JJR",     "JJS",     "LS",     "MD",     "NN",     "NNP",     "NNPS",     "NNS",     "PDT",     "POS",     "PRP",     "PRP$",     "RB",     "RBR",     "RBS",     "RP",     "SYM",     "TO",     "UH",     "VB",     "VBD",     "VBG",     "VBN",     "VBP",     "VBZ",     "WDT",     "WP",     "WP$",     "WRB" ]
 
-PUNCTS = '!?.,;'
-
 for i, pos in enumerate(POS):
     POS_DICT[pos] = i
 
 def pos_dim():
     return max(POS_DICT.values())+1
 
+register_feature('pos_dist', dim=pos_dim())(pos_distribution_feature)
+
+# Per batch inputs that are not token indices, in the same order as xs.
+#   rows: dataset index of every essay in the batch
+#   segments: with windows (long_essays='window'), essay of every row of xs
+#       (features, rows, ys and prompts then have a row per essay), else None
+BatchExtras = namedtuple('BatchExtras', ['features', 'pos', 'rows', 'segments'])
+
+LONG_ESSAYS = ('drop', 'truncate', 'window')
+
+
+def long_essays_from_args(args):
+    '''
+        ASAPDataset keyword arguments of --long-essays, --window-size and
+        --window-stride (args of older runs have none of them).
+    '''
+    return {'long_essays': getattr(args, 'long_essays', 'drop'),
+            'window_size': getattr(args, 'window_size', 0),
+            'window_stride': getattr(args, 'window_stride', 0)}
+
 
 logger = logging.getLogger(__name__)
-num_regex = re.compile('^[+-]?[0-9]+\.?[0-9]*$')
 ref_scores_dtype = 'int32'
 if sys.platform in ['win32']:
     print('Detected windows OS')
@@ -56,13 +79,16 @@ else:
     lineneding = '\n'
 
 
+def token_dtype(vocab):
+    '''
+        Smallest numpy int type holding every index of vocab.
+    '''
+    return np.int16 if len(vocab) <= np.iinfo(np.int16).max + 1 else np.int32
+
+
 def is_number(string):
-    # neater than regex really. stack is annoying but eh
-    try:
-        lol = float(string)
-        return True
-    except ValueError:
-        return False
+    # Same strings as float() accepts, without raising for the others.
+    return num_regex.match(string) is not None
 
 
 # unfortunately, torch.utils.data.Dataset isn't great for NLP
@@ -71,81 +97,272 @@ class ASAPDataset:  # (torch.utils.data.Dataset):
     '''
         Attributes:
             tsv_file
+            tokens: every essay's token indices, concatenated (int16, or
+                int32 for vocabs over 32k words)
+            offsets: essay i is tokens[offsets[i]:offsets[i + 1]]
+            tags: (with pos) POS_DICT encoded tags aligned with tokens
+            ids, y, prompts: numpy arrays with an entry per essay
     '''
-    asap_ranges = {
-        0: (0, 60),
-        1: (2, 12),
-        2: (1, 6),
-        3: (0, 3),
-        4: (0, 3),
-        5: (0, 4),
-        6: (0, 4),
-        7: (0, 30),
-        8: (0, 60)
-    }
-
-
-    def __init__(self, tsv_file, maxlen=-1, vocab_size=-1, vocab=None, read_vocab=False, vocab_file=None, prompt_id=-1, pos=False):
+    asap_ranges = ASAP_RANGES  # See src/scores.py
+
+
+    def __init__(self, tsv_file, maxlen=-1, vocab_size=-1, vocab=None, read_vocab=False, vocab_file=None, prompt_id=-1, pos=False, features=(), tokenizer='nltk', pos_workers=1,
+                 long_essays='drop', window_size=0, window_stride=0):
         self.tsv_file = tsv_file
+        self.set_long_essays(maxlen, long_essays, window_size, window_stride)
+        self.pos_workers = pos_workers
+        self.tokenizer = get_tokenizer(tokenizer)  # See src/tokenizers.py
         self.prompt_id = prompt_id  # Need this for evaluation.
+        self.pos = pos
+        self.feature_names = list(features)
         if vocab is None:
             if read_vocab is True:
                 logging.info('Loading vocab from ' + vocab_file)
-                with open(vocab_file, 'rb') as f:
-                    self.vocab = pickle.load(f)
+                self.vocab = Vocabulary.load(vocab_file)
             else:
                 logger.info('Loading vocab from ' + tsv_file)
                 self.vocab = self.create_vocab_from_tsv(tsv_file, pos=pos, vocab_size=vocab_size, prompt_id=prompt_id)
                 if vocab_file is not None:
                     logging.info('Writing vocab to ' + vocab_file)
-                    with open(vocab_file, 'wb') as f:
-                        pickle.dump(self.vocab, f)
+                    self.vocab.save(vocab_file)
         else:
-            self.vocab = vocab
-        self.unique_x = []
-        self.tags_x = []
-        self.punct_x = []
+            self.vocab = as_vocabulary(vocab)
+        self.tags = []
 
-        self.ids, self.x, self.y, self.prompts, self.maxlen = \
+        ids, x, y, prompts, self.maxlen = \
             self.read_tsv(tsv_file, self.vocab, maxlen=maxlen, prompt_id=prompt_id, pos=pos)
+        self._store(ids, x, y, prompts, self.tags if pos else None)
 
         self.prepare_features(pos)
+
+    def _store(self, ids, x, y, prompts, tags=None):
+        '''
+            Packs the encoded essays (lists of token indices, and of tags)
+            into the flat arrays.
+        '''
+        lens = np.fromiter((len(e) for e in x), dtype=np.int64, count=len(x))
+        self.offsets = np.zeros(len(x) + 1, dtype=np.int64)
+        np.cumsum(lens, out=self.offsets[1:])
+        total = int(self.offsets[-1])
+        self.tokens = np.concatenate([np.asarray(e, dtype=np.int32) for e in x] + [np.zeros(0, dtype=np.int32)]).astype(token_dtype(self.vocab))
+        self.tags = None
+        if tags is not None:
+            # Truncated essays keep the tags of their tokens only.
+            self.tags = np.fromiter(itertools.chain.from_iterable(t[:len(e)] for t, e in zip(tags, x)), dtype=np.int8, count=total)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.prompts = np.asarray(prompts, dtype=np.int64)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'long_essays' not in state:
+            self.long_essays, self.window = 'drop', None
+        if 'x' in state:
+            # Pickled before the flat arrays: x is a list of lists and
+            # tags_x a dense one hot tensor (an empty array without pos).
+            x = self.__dict__.pop('x')
+            tags_x = self.__dict__.pop('tags_x', None)
+            if 'pos' not in state:
+                # The original ASAPDataset did not keep pos.
+                self.pos = tags_x is not None and len(tags_x) > 0
+            tags = None
+            if self.pos:
+                tags = [tags_x[i, :len(e)].max(-1)[1].tolist() for i, e in enumerate(x)]
+            self._store(self.ids, x, self.y, self.prompts, tags)
+            self._prompt_views = {}
+            self._prompt_index = None
+        if 'tokenizer' not in state:
+            self.tokenizer = get_tokenizer('nltk')
+            self.pos_workers = 1
+        if 'feature_names' not in state:
+            self._legacy_features()
+
+    def _legacy_features(self):
+        '''
+            The original ASAPDataset computed variety (unique_x) and punct
+            (punct_x) for every essay, they become the features of the same
+            names (see use_features).
+        '''
+        self.feature_names, columns = [], []
+        for name, attr in [('variety', 'unique_x'), ('punct', 'punct_x')]:
+            values = self.__dict__.pop(attr, None)
+            if values is not None and len(values) == len(self) > 0:
+                self.feature_names.append(name)
+                columns.append(torch.as_tensor(np.asarray(values), dtype=torch.float32).view(len(self), -1))
+        self.features = torch.cat(columns, dim=1) if len(columns) > 0 else None
+
+    def use_features(self, names):
+        '''
+            Makes names the essay level features: columns self.features
+            already has are kept (pickled datasets carry theirs), otherwise
+            they are all computed again.
+        '''
+        names = list(names)
+        if names == self.feature_names:
+            return
+        if len(names) > 0 and self.features is not None and all(name in self.feature_names for name in names):
+            starts = dict(zip(self.feature_names, np.cumsum([0] + [FEATURES[name][1] for name in self.feature_names])))
+            columns = [int(starts[name]) + i for name in names for i in range(FEATURES[name][1])]
+            self.features = self.features[:, torch.as_tensor(columns, dtype=torch.long)]
+            self.feature_names = names
+        else:
+            self.feature_names = names
+            self.prepare_features(self.pos)
+
+    def set_long_essays(self, maxlen, long_essays='drop', window_size=0, window_stride=0):
+        '''
+            What happens to essays over maxlen tokens (with maxlen > 0):
+                drop: they are left out
+                truncate: they are cut to their first maxlen tokens
+                window: they are kept whole, batches split every essay over
+                    window_size (default maxlen) tokens into windows
+                    window_stride (default window_size // 2) apart
+        '''
+        if long_essays not in LONG_ESSAYS:
+            raise ValueError('long_essays must be one of %s' % '|'.join(LONG_ESSAYS))
+        self.long_essays = long_essays
+        self.window = None
+        if long_essays == 'window':
+            size = window_size if window_size > 0 else maxlen
+            if size <= 0:
+                raise ValueError('Windows need a window size or a maxlen')
+            stride = window_stride if window_stride > 0 else max(1, size // 2)
+            if stride > size:
+                raise ValueError('A window stride over the window size skips tokens')
+            self.window = (size, stride)
+
+    def _fit_length(self, indices, maxlen):
+        '''
+            indices as stored under the long_essays policy, None to drop them.
+        '''
+        if maxlen <= 0 or len(indices) <= maxlen or self.long_essays == 'window':
+            return indices
+        if self.long_essays == 'truncate':
+            return indices[:maxlen]
+        return None
+
+    @property
+    def lens(self):
+        return np.diff(self.offsets)
+
+    @property
+    def x(self):
+        '''
+            Token arrays of the essays (views of self.tokens)
+        '''
+        return [self.tokens[start:end] for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
     def __len__(self):
         # Number of essays
-        return len(self.x)
+        return len(self.offsets) - 1
 
     def __getitem__(self, idx):
-        return self.x[idx], self.y[idx], self.prompts[idx]
+        if isinstance(idx, slice):
+            return [self.tokens[self.offsets[i]:self.offsets[i + 1]] for i in range(len(self))[idx]], self.y[idx], self.prompts[idx]
+        return self.tokens[self.offsets[idx]:self.offsets[idx + 1]], self.y[idx], self.prompts[idx]
+
+    def collate(self, rows):
+        '''
+            ASAPDataLoader batch of the essays at rows (an int array).
+        '''
+        features = None
+        if self.features is not None:
+            features = self.features[torch.from_numpy(rows)]
+        return collate(self.tokens, self.offsets[rows], self.offsets[rows + 1] - self.offsets[rows], self.y[rows], self.prompts[rows],
+                       features=features, tags=self.tags if self.pos else None, rows=rows, window=self.window)
+
+    def subset(self, indices):
+        '''
+            Dataset of the essays at indices (a slice or a list of
+            positions), sharing the vocab. With a slice tokens, tags and
+            features are views of this dataset's, copies otherwise.
+        '''
+        view = copy.copy(self)
+        if isinstance(indices, slice) and indices.step in (None, 1):
+            start, stop, _ = indices.indices(len(self))
+            stop = max(start, stop)
+            view.offsets = self.offsets[start:stop + 1] - self.offsets[start]
+            tokens = slice(self.offsets[start], self.offsets[stop])
+            pick = lambda seq: seq[indices]
+        else:
+            if isinstance(indices, slice):
+                indices = np.arange(len(self))[indices]
+            indices = np.asarray(indices, dtype=np.int64)
+            lens = self.lens[indices]
+            view.offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+            np.cumsum(lens, out=view.offsets[1:])
+            tokens = np.repeat(self.offsets[indices] - view.offsets[:-1], lens) + np.arange(view.offsets[-1])
+            tensor_indices = torch.from_numpy(indices)
+            pick = lambda seq: seq[tensor_indices] if torch.is_tensor(seq) else seq[indices]
+        view.tokens = self.tokens[tokens]
+        if self.tags is not None:
+            view.tags = self.tags[tokens]
+        # Copies, so rescaling the view's scores leaves this dataset's alone.
+        view.ids, view.y, view.prompts = pick(self.ids).copy(), pick(self.y).copy(), pick(self.prompts).copy()
+        if self.features is not None:
+            view.features = pick(self.features)
+        view.maxlen = int(view.lens.max()) if len(view) > 0 else 0
+        view._prompt_views = {}
+        view._prompt_index = None
+        return view
+
+    def prompt_index(self):
+        '''
+            prompt -> positions of its essays, a slice when they are
+            contiguous (ASAP files are sorted by prompt).
+        '''
+        if getattr(self, '_prompt_index', None) is None:
+            prompts = np.asarray(self.prompts)
+            self._prompt_index = {}
+            for prompt in np.unique(prompts).tolist():
+                positions = np.flatnonzero(prompts == prompt)
+                if positions[-1] - positions[0] + 1 == len(positions):
+                    self._prompt_index[prompt] = slice(int(positions[0]), int(positions[-1]) + 1)
+                else:
+                    self._prompt_index[prompt] = positions
+        return self._prompt_index
+
+    def for_prompt(self, prompt):
+        '''
+            View of the essays of one prompt, without reading the TSV again.
+        '''
+        if getattr(self, '_prompt_views', None) is None:
+            self._prompt_views = {}
+        if prompt not in self._prompt_views:
+            index = self.prompt_index()
+            if prompt not in index:
+                raise KeyError('No essays for prompt %d in %s' % (prompt, self.tsv_file))
+            view = self.subset(index[prompt])
+            view.prompt_id = prompt
+            self._prompt_views[prompt] = view
+        return self._prompt_views[prompt]
 
     def tokenize(self, string, pos=False):
-        tokens = nltk.word_tokenize(string)
-        for index, token in enumerate(tokens):
-            if token == '@' and (index+1) < len(tokens):
-                tokens[index+1] = '@' + re.sub('[0-9]+.*', '', tokens[index+1])
-                tokens.pop(index)
-        return tokens
+        return self.tokenizer.words(string)
 
     def _tokenize(self, text, pos=False):
-        sentences = nltk.sent_tokenize(text)
-        ret = list()
-        part_of_speech = list()
-        for sentence in sentences:
-            tokens = nltk.word_tokenize(sentence)
-            if pos:
-                tagged = list(map(lambda x: x[-1], tagger.tag(tokens)))
-            for index, token in enumerate(tokens):
-                if token == '@' and (index+1) < len(tokens):
-                    tokens[index+1] = '@' + re.sub('[0-9]+.*', '', tokens[index+1])
-                    tokens.pop(index)
-                    if pos:
-                        tagged.pop(index)
-            ret.extend(tokens)
-            if pos:
-                part_of_speech.extend(tagged)
+        sentences = self.tokenizer.sentences(text)
+        ret = self._merged_tokens(sentences)
         if pos:
-            return ret, part_of_speech
+            return ret, self._merged_tags(sentences, pos_tagger.tag_sentences(sentences))
         return ret, None
 
+    def _merged_tokens(self, sentences):
+        ret = list()
+        for tokens in sentences:
+            ret.extend(merge_entities(tokens)[0])
+        return ret
+
+    def _merged_tags(self, sentences, tags):
+        '''
+            The tagger sees the sentences before the @ENTITY merge, tags
+            are merged like the tokens.
+        '''
+        part_of_speech = list()
+        for tokens, tagged in zip(sentences, tags):
+            part_of_speech.extend(merge_entities(tokens, tagged)[1])
+        return part_of_speech
+
     def create_vocab_from_tsv(self, tsv_file, pos=False, vocab_size=-1, maxlen=-1, prompt_id=-1, to_lower=True, tokenize_not_split=True):
         '''
             Reads a tsv_file and constructs a vocabulary (dictionary)
@@ -189,6 +406,14 @@ class ASAPDataset:  # (torch.utils.data.Dataset):
                         total_words += 1
         logger.info('  %i total words, %i unique words' %
                     (total_words, unique_words))
+        return self.vocab_from_freqs(word_freqs, vocab_size)
+
+    @staticmethod
+    def vocab_from_freqs(word_freqs, vocab_size=-1):
+        '''
+            word_freqs: word -> count, in order of first occurrence (ties
+            keep that order).
+        '''
         import operator
         sorted_word_freqs = sorted(word_freqs.items(),
                                    key=operator.itemgetter(1),
@@ -199,18 +424,18 @@ class ASAPDataset:  # (torch.utils.data.Dataset):
             for word, freq in sorted_word_freqs:
                 if freq > 1:
                     vocab_size += 1
-        vocab = {'<pad>': 0, '<unk>': 1, '<num>': 2}
-        vcb_len = len(vocab)
-        index = vcb_len
+        words = ['<pad>', '<unk>', '<num>']
+        vcb_len = len(words)
         # pdb.set_trace()
         for freq_rank, (word, freq) in enumerate(sorted_word_freqs):
+            if word in words[:vcb_len]:
+                continue  # Reserved
             if freq_rank < vocab_size - vcb_len:
-                vocab[word] = index
-                index += 1
+                words.append(word)
             else:
-                vocab.pop(word, None)  # Bye bye word
+                break  # Bye bye words
         # pdb.set_trace()
-        return vocab
+        return Vocabulary(words)
 
     def read_tsv(self, tsv_file, vocab, char_level=False, tokenize_not_split=True, to_lower=False, maxlen=-1, prompt_id=-1, score_index=6, pos=False):
         logging.info('Reading TSV file from ' + tsv_file)
@@ -218,7 +443,8 @@ class ASAPDataset:  # (torch.utils.data.Dataset):
             logger.info('  Removing sequences with more than ' + str(maxlen) +
                         ' words')
         data_ids, data_x, data_y, prompt_ids = [], [], [], []
-        num_hit, unk_hit, total = 0., 0., 0.
+        essay_sentences = []  # With pos, tagged in one go at the end.
+        hits = {'num': 0., 'unk': 0., 'total': 0.}
         maxlen_x = -1
         with open(tsv_file, 'r', encoding=tsv_encoding) as f:
             line_count = 0
@@ -242,85 +468,140 @@ class ASAPDataset:  # (torch.utils.data.Dataset):
                     if char_level:
                         raise NotImplementedError  # TODO
                     else:
-                        data = self._tokenize(content, pos)  # Changed from tokenize -> _tokenize
-                        if pos:
-                            content, tags = data
-                            tag_encoded = [POS_DICT[i] for i in tags]
-
-                        else:
-                            content, _ = data
-                        for word in content:
-                            if is_number(word):
-                                indices.append(vocab['<num>'])
-                                num_hit += 1
-                            elif word in vocab:
-                                indices.append(vocab[word])
-                            else:
-                                indices.append(vocab['<unk>'])
-                                unk_hit += 1
-                            total += 1
+                        with profiler.timer('tokenize'):
+                            sentences = self.tokenizer.sentences(content)
+                            content = self._merged_tokens(sentences)
+                        indices = self._fit_length(vocab.encode(content, hits), maxlen)
                         # print(maxlen)
-                        if len(indices) > maxlen and maxlen > 0:
+                        if indices is None:
                             # print('Filtering')
                             continue
                         if pos:
-                            self.tags_x.append(tag_encoded)
+                            essay_sentences.append(sentences)
                         data_ids.append(essay_id)
                         data_x.append(indices)
-                        self.unique_x.append(len(set(indices)) / len(indices))
-                        self.punct_x.append(len([1 for i in content if i in PUNCTS]))
                         data_y.append(score)
                         prompt_ids.append(essay_set)
                         if len(indices) > maxlen_x:
                             self.maxlen_x_id = essay_id
                         maxlen_x = max(maxlen_x, len(indices))
         self.maxlen_x = maxlen_x  # Gotta remember.
-        self.unique_x = np.array(self.unique_x)
-        self.tags_x = np.array(self.tags_x)
-        self.punct_x = np.array(self.punct_x)
-        logger.info('  <num> hit rate: %.2f%%, <unk> hit rate: %.2f%%' % (100*num_hit/total, 100*unk_hit/total))
+        if pos:
+            self.tags = self.tag_essays(essay_sentences, workers=self.pos_workers)
+        self._log_hits(hits)
         return data_ids, data_x, data_y, prompt_ids, maxlen_x
 
+    def _log_hits(self, hits):
+        total = max(hits['total'], 1)
+        logger.info('  <num> hit rate: %.2f%%, <unk> hit rate: %.2f%%' % (100*hits['num']/total, 100*hits['unk']/total))
+
+    def tag_essays(self, essay_sentences, workers=1, log_stats=True):
+        '''
+            essay_sentences: per essay, its sentences (before the @ENTITY merge)
+            Returns the POS_DICT encoded tags of every essay, every sentence
+            of every essay is tagged in one batch.
+            log_stats: False for callers tagging many small batches
+        '''
+        tags_x = []
+        with profiler.timer('pos_tag'):
+            tags = pos_tagger.tag_sentences([s for sentences in essay_sentences for s in sentences], workers=workers)
+            start = 0
+            for sentences in essay_sentences:
+                tagged = self._merged_tags(sentences, tags[start:start + len(sentences)])
+                start += len(sentences)
+                tags_x.append([POS_DICT[i] for i in tagged])
+        if log_stats:
+            pos_tagger.log_stats()
+        return tags_x
+
+    @classmethod
+    def from_essays(cls, essays, tsv_file, maxlen=-1, vocab_size=-1, vocab=None, prompt_id=-1, pos=False, features=(), tokenizer='nltk',
+                    long_essays='drop', window_size=0, window_stride=0):
+        '''
+            Dataset over already tokenized essays (see src/corpus.py), the
+            same as reading a TSV of them: the vocab (if not given) is built
+            from their lower cased tokens, the maxlen policy is applied.
+            essays: objects with id, prompt, score, vocab_words (tokens of
+                the lower cased text), words and tags (POS_DICT encoded,
+                with pos)
+        '''
+        self = cls.__new__(cls)
+        self.tsv_file = tsv_file
+        self.set_long_essays(maxlen, long_essays, window_size, window_stride)
+        self.pos_workers = 1
+        self.tokenizer = get_tokenizer(tokenizer)
+        self.prompt_id = prompt_id
+        self.pos = pos
+        self.feature_names = list(features)
+        if vocab is None:
+            word_freqs = {}
+            for essay in essays:
+                if essay.prompt == prompt_id or prompt_id <= 0:
+                    for word in essay.vocab_words:
+                        word_freqs[word] = word_freqs.get(word, 0) + 1
+            logger.info('  %i total words, %i unique words' % (sum(word_freqs.values()), len(word_freqs)))
+            vocab = cls.vocab_from_freqs(word_freqs, vocab_size)
+        self.vocab = vocab = as_vocabulary(vocab)
+        tags_x = []
+        ids, x, y, prompts = [], [], [], []
+        hits = {'num': 0., 'unk': 0., 'total': 0.}
+        maxlen_x = -1
+        for essay in essays:
+            if not (essay.prompt == prompt_id or prompt_id < 0):
+                continue
+            indices = self._fit_length(vocab.encode(essay.words, hits), maxlen)
+            if indices is None:
+                continue
+            if pos:
+                if essay.tags is None:
+                    raise RuntimeError('The corpus was built without --pos')
+                tags_x.append(essay.tags)
+            ids.append(essay.id)
+            x.append(indices)
+            y.append(essay.score)
+            prompts.append(essay.prompt)
+            if len(indices) > maxlen_x:
+                self.maxlen_x_id = essay.id
+            maxlen_x = max(maxlen_x, len(indices))
+        self.maxlen_x = self.maxlen = maxlen_x
+        self._log_hits(hits)
+        self._store(ids, x, y, prompts, tags_x if pos else None)
+        self.prepare_features(pos)
+        return self
+
     def make_scores_model_friendly(self):
-        for i in range(len(self.y)):
-            low, high = self.asap_ranges[self.prompts[i]]
-            self.y[i] = (self.y[i] - low) / (high - low)
+        self.y = score_scaler.to_model(self.y, self.prompts)
 
     def make_scores_dataset_friendly(self):
-        for i in range(len(self.y)):
-            low, high = self.asap_ranges[self.prompts[i]]
-            self.y[i] = low + (high - low) * self.y[i]
+        self.y = score_scaler.to_dataset(self.y, self.prompts)
 
     def prepare_features(self, pos=False):
         '''
-            Function messes around with how dataset represents
-            classical features such as unique_x, punct_x, tags_x
-            At the end of the function, all of these need to be FloatTensors
+            Computes the essay level features from the flat arrays.
+            self.features: num_essays * feature_dim(self.feature_names)
+                FloatTensor (None when no features are used)
+            POS tags stay flat (self.tags), batches one hot encode theirs.
         '''
-        if len(self.punct_x) > 0:
-            self.punct_x = torch.autograd.Variable(torch.from_numpy(self.punct_x).float().unsqueeze(1), requires_grad=False)
-        if len(self.unique_x) > 0:
-            self.unique_x = torch.autograd.Variable(torch.from_numpy(self.unique_x).float().unsqueeze(1), requires_grad=False)
-        if pos:
-            n_pos_dim = pos_dim()
-            txo = self.tags_x  # Temporary variable.
-            self.tags_x = np.zeros((len(self.tags_x), self.maxlen_x, n_pos_dim))
-            for i in range(len(txo)):
-                for j in range(len(txo[i])):
-                    k = txo[i][j]
-                    self.tags_x[i, j, k] = 1
-            self.tags_x = torch.autograd.Variable(
-                torch.from_numpy(self.tags_x).float(),
+        self.features = None
+        if len(self.feature_names) > 0:
+            ctx = FeatureContext(self.tokens, self.lens, self.vocab, tags=self.tags if pos else None)
+            self.features = torch.autograd.Variable(
+                torch.from_numpy(extract_features(ctx, self.feature_names)),
                 requires_grad=False
                 )
 
 
 class ASAPDataLoader:
-    def __init__(self, dataset, maxlen, batch_size):
+    def __init__(self, dataset, maxlen, batch_size, indices=None):
+        '''
+            indices: (optional) essays to go over, in order.
+                Used to give each process its shard in distributed training.
+        '''
         self.dataset = dataset
         self.batch_size = batch_size
         self.maxlen = maxlen
-        self.len = len(dataset)
+        self.indices = indices
+        self.len = len(dataset) if indices is None else len(indices)
         self.index = 0
 
     def __iter__(self):
@@ -332,33 +613,76 @@ class ASAPDataLoader:
         lower = self.index
         self.index += self.batch_size
         higher = min(self.index, self.len)
-        xs, ys, prompts = self.dataset[lower:higher]
-        lens = []
-        batch_max_len = max([len(x) for x in xs])
-        for i in range(len(xs)):
-            # pdb.set_trace()
-            x = xs[i]
-            lens.append(len(x))
-            x = x + [0 for i in range(batch_max_len - len(x))]
-            xs[i] = x
-        mask = torch.FloatTensor(
-            [
-                [1]*lens[i] + [0]*(batch_max_len - lens[i])
-                for i in range(len(xs))
-                ]
-            )
-        sorter = np.flip(np.argsort(lens), axis=0).tolist()
-        xs = Variable(torch.LongTensor(xs))
-        ys = Variable(torch.FloatTensor(ys))
-        prompts = Variable(torch.LongTensor(prompts))
-        mask = Variable(mask)
-        lens = Variable(torch.LongTensor(lens))
-        return xs[sorter],\
-            ys[sorter],\
-            prompts[sorter],\
-            mask[sorter],\
-            lens[sorter],\
-            (lower, higher)
+        with profiler.timer('collate'):
+            return self._collate(lower, higher)
+
+    def _collate(self, lower, higher):
+        if self.indices is None:
+            rows = np.arange(lower, higher)
+        else:
+            rows = np.asarray(self.indices[lower:higher], dtype=np.int64)
+        return self.dataset.collate(rows)
+
+
+def split_windows(starts, lens, size, stride):
+    '''
+        Windows of size tokens, stride apart, covering every essay (an
+        essay of up to size tokens is one window).
+        Returns the starts and lens of the windows, and the essay of each.
+    '''
+    n_windows = np.where(lens > size, (lens - size + stride - 1) // stride + 1, 1)
+    segments = np.repeat(np.arange(len(lens)), n_windows)
+    first = np.repeat(np.cumsum(n_windows) - n_windows, n_windows)
+    offsets = (np.arange(len(segments)) - first) * stride
+    return starts[segments] + offsets, np.minimum(size, lens[segments] - offsets), segments
+
+
+def collate(tokens, starts, lens, ys, prompts, features=None, tags=None, rows=None, window=None):
+    '''
+        Pads a batch and sorts it by decreasing length, the way the models
+        expect it.
+        tokens: flat token array, essay i of the batch is
+            tokens[starts[i]:starts[i] + lens[i]]
+        ys, prompts, rows: arrays with an entry per essay (rows: dataset
+            positions, returned sorted in BatchExtras)
+        features: (optional) tensor with a row per essay
+        tags: (optional) POS_DICT tags aligned with tokens, one hot encoded
+            into BatchExtras.pos
+        window: (optional) (size, stride), the rows of xs are then the
+            windows of the essays (see split_windows), sorted by length in
+            turn, and BatchExtras.segments maps them to the essays.
+    '''
+    lens = np.asarray(lens, dtype=np.int64)
+    sorter = np.flip(np.argsort(lens), axis=0).copy()
+    starts, lens = np.asarray(starts, dtype=np.int64)[sorter], lens[sorter]
+    segments = None
+    if window is not None:
+        starts, lens, segments = split_windows(starts, lens, *window)
+        windows = np.flip(np.argsort(lens), axis=0).copy()
+        starts, lens, segments = starts[windows], lens[windows], torch.from_numpy(segments[windows])
+    batch_max_len = int(lens.max()) if len(lens) > 0 else 0
+    positions = np.arange(batch_max_len)
+    mask = positions[None, :] < lens[:, None]
+    gather = (starts[:, None] + positions[None, :])[mask]
+    xs = np.zeros(mask.shape, dtype=np.int64)
+    xs[mask] = tokens[gather]
+    pos = None
+    if tags is not None:
+        pos = np.zeros(mask.shape + (pos_dim(),), dtype=np.float32)
+        batch_rows, columns = np.nonzero(mask)
+        pos[batch_rows, columns, tags[gather]] = 1
+        pos = torch.from_numpy(pos)
+    if features is not None:
+        features = features[torch.from_numpy(sorter)]
+    profiler.count('essays', len(sorter))
+    profiler.count('tokens', int(lens.sum()))
+    profiler.count('padded_tokens', len(lens) * batch_max_len)
+    return torch.from_numpy(xs),\
+        torch.from_numpy(np.asarray(ys, dtype=np.float32)[sorter]),\
+        torch.from_numpy(np.asarray(prompts, dtype=np.int64)[sorter]),\
+        torch.from_numpy(mask.astype(np.float32)),\
+        torch.from_numpy(lens),\
+        BatchExtras(features, pos, np.asarray(rows)[sorter], segments)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,66 @@
+'''
+    Helpers for multi process data parallel training on CPU (gloo).
+    Every process trains on its own shard of the dataset and
+    DistributedDataParallel averages the gradients during backward.
+'''
+
+# general imports
+import os
+import logging
+# pytorch imports
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data.distributed import DistributedSampler
+
+logger = logging.getLogger(__name__)
+
+
+def threads_per_worker(world_size):
+    return max(1, (os.cpu_count() or 1) // world_size)
+
+
+def setup(rank, world_size, port=29500, backend='gloo'):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    # Intra-op threads are split between the processes.
+    torch.set_num_threads(threads_per_worker(world_size))
+
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def shard_indices(dataset, rank, world_size, epoch=0, shuffle=False, seed=0):
+    '''
+        Indices of the essays rank trains on during epoch.
+        Shards are padded to the same length, so every process runs the
+        same number of batches.
+    '''
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle, seed=seed)
+    sampler.set_epoch(epoch)
+    return list(sampler)
+
+
+def all_reduce_mean(value):
+    '''
+        Mean of a scalar (tensor or float) over all processes.
+    '''
+    tensor = torch.tensor(float(value))
+    if dist.is_initialized():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+        tensor /= dist.get_world_size()
+    return tensor.item()
+
+
+def spawn(fn, world_size, *args):
+    '''
+        Runs fn(rank, world_size, *args) in world_size processes.
+    '''
+    mp.spawn(fn, args=(world_size,) + args, nprocs=world_size, join=True)
@@ -0,0 +1,106 @@
+'''
+    Shared helpers to load saved models and score datasets with them.
+'''
+
+# general imports
+import logging
+from time import perf_counter
+import numpy as np
+# pytorch imports
+import torch
+# User imports
+from .dataset import ASAPDataLoader
+from .precision import bf16_autocast
+from .qwk import quadratic_weighted_kappa
+from .scores import score_scaler
+from .vocab import as_vocabulary
+
+logger = logging.getLogger(__name__)
+
+
+def load_model(path, cuda=False):
+    '''
+        Loads a torch.save'd model, out of DataParallel, ready for inference.
+    '''
+    model = torch.load(path, map_location=lambda storage, location: storage)
+    if isinstance(model, torch.nn.DataParallel):
+        model = model.module
+    if cuda:
+        model.cuda()
+    else:
+        model.cpu()
+    set_cuda_flag(model, cuda)
+    model.eval()
+    return model
+
+
+def checkpoint_vocab(paths):
+    '''
+        The vocab the models saved at paths were trained with. Essays are
+        encoded once for all of them, so they have to share it.
+    '''
+    vocab = None
+    for path in paths:
+        model_vocab = as_vocabulary(load_model(path).vocab)
+        if vocab is None:
+            vocab = model_vocab
+        elif model_vocab.words != vocab.words:
+            raise RuntimeError('%s was trained with another vocab than %s' % (path, paths[0]))
+    if vocab is None:
+        raise ValueError('No saved models')
+    return vocab
+
+
+def set_cuda_flag(model, cuda):
+    for module in model.modules():
+        if hasattr(module, 'args') and hasattr(module.args, 'cuda'):
+            module.args.cuda = cuda
+
+
+def predict(model, dataset, batch_size, cuda=False, timings=None, bf16=False):
+    '''
+        Raw (sigmoid) outputs of model for every essay of dataset,
+        as a float32 array in dataset order.
+        timings: (optional) list that gets the seconds spent in each batch
+        bf16: run the model under bfloat16 autocast (CPU, see src/precision.py)
+    '''
+    model.eval()
+    preds = np.zeros(len(dataset), dtype=np.float32)
+    with torch.no_grad():
+        for xs, ys, ps, padding_mask, lens, extras in ASAPDataLoader(dataset, dataset.maxlen, batch_size):
+            features = extras.features
+            if features is not None:
+                features = features.cuda() if cuda else features.cpu()
+            begin = perf_counter()
+            with bf16_autocast(bf16):
+                pred = model(xs,
+                             mask=padding_mask,
+                             lens=lens,
+                             pos=extras.pos,
+                             features=features,
+                             segments=extras.segments)
+            pred = pred.detach().float().view(-1).cpu().numpy()
+            if timings is not None:
+                timings.append(perf_counter() - begin)
+            preds[extras.rows] = pred
+    return preds
+
+
+def prompt_qwks(preds, dataset):
+    '''
+        prompt -> QWK of raw model outputs (in dataset order) on the essays
+        of that prompt, for every prompt of dataset (dataset friendly scores)
+    '''
+    preds = np.asarray(preds)
+    return {prompt: qwk(preds[index], dataset.for_prompt(prompt), prompt)
+            for prompt, index in sorted(dataset.prompt_index().items())}
+
+
+def qwk(preds, dataset, prompt):
+    '''
+        QWK of raw model outputs against dataset's (dataset friendly) scores
+    '''
+    lhs, rhs = score_scaler.range(prompt)
+    pred_ys = score_scaler.to_ratings(np.asarray(preds), prompt)
+    true_ys = np.asarray(dataset.y)
+    return quadratic_weighted_kappa(pred_ys, true_ys, min_rating=lhs, max_rating=rhs)
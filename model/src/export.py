@@ -0,0 +1,149 @@
+'''
+    TorchScript export of the scoring (inference) path of a Model.
+    Every branch that depends on args (CNN or not, RNN type, pooling,
+    POS, features) is resolved when the ScoringModule is built, the
+    scripted module does not need args, the vocab or any python code.
+    The mask is derived from lens and essays don't need to be sorted.
+'''
+
+# general imports
+import logging
+from typing import Optional
+# pytorch imports
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+# User imports
+from .custom_layers import MeanOverTime, Attention, pool_segments
+
+logger = logging.getLogger(__name__)
+
+
+class ScoringModule(nn.Module):
+    __constants__ = ['use_pos', 'has_cnn', 'has_rnn', 'pooling', 'use_features']
+
+    def __init__(self, model):
+        '''
+            model: a trained Model (not DataParallel), in eval mode.
+        '''
+        super(ScoringModule, self).__init__()
+        args = model.args
+        self.use_pos = bool(args.pos)
+        self.has_cnn = hasattr(model, 'cnn_layer')
+        self.has_rnn = hasattr(model, 'rnn_layer')
+        self.use_features = hasattr(model, 'feature_linear')
+        pooling_layer = getattr(model, 'pooling_layer', None)
+        if pooling_layer is None:
+            self.pooling = 'last'
+        elif isinstance(pooling_layer, MeanOverTime):
+            self.pooling = 'mot'
+        elif isinstance(pooling_layer, Attention):
+            self.pooling = pooling_layer.op
+        else:
+            raise NotImplementedError('Cannot export pooling layer ' + type(pooling_layer).__name__)
+
+        self.embedding = model.embedding_layer
+        # Unused parts get placeholders, branches on constants are not compiled.
+        self.conv = model.cnn_layer.conv if self.has_cnn else nn.Identity()
+        self.rnn = model.rnn_layer if self.has_rnn else nn.Identity()
+        if isinstance(pooling_layer, Attention):
+            self.att_W = pooling_layer.att_W
+            self.att_V = pooling_layer.att_V
+        else:
+            self.att_W = nn.Parameter(torch.zeros(0), requires_grad=False)
+            self.att_V = nn.Parameter(torch.zeros(0), requires_grad=False)
+        self.linear = model.linear
+        self.feature_linear = model.feature_linear if self.use_features else nn.Identity()
+
+    def forward(self, x: torch.Tensor, lens: torch.Tensor,
+                features: Optional[torch.Tensor] = None,
+                pos: Optional[torch.Tensor] = None,
+                mask: Optional[torch.Tensor] = None,
+                segments: Optional[torch.Tensor] = None) -> torch.Tensor:
+        '''
+            x: LongTensor batch_size * max_seq_length, padded
+            lens: LongTensor batch_size
+            features: batch_size * feature_dim (if the model uses features)
+            pos: batch_size * >=max_seq_length * pos_dim (if the model uses POS)
+            mask: (optional) batch_size * max_seq_length, derived from lens if not given
+            segments: (optional) essay of every row when the rows are windows
+                (see Model.forward), features then have a row per essay
+            Returns batch_size (essays) * 1 scores in [0, 1]
+        '''
+        max_seq_length = x.size(1)
+        if mask is None:
+            mask = (torch.arange(max_seq_length, device=x.device).unsqueeze(0) < lens.unsqueeze(1)).to(torch.float)
+        else:
+            mask = mask.to(torch.float)
+        current = self.embedding(x)
+        if self.use_pos:
+            if pos is None:
+                raise RuntimeError('This model needs pos')
+            current = torch.cat((current, pos[:, :max_seq_length, :].to(current.dtype)), dim=2)
+        if self.has_cnn:
+            current = self.conv(current.transpose(1, 2))
+            current = (current * mask.unsqueeze(1)).transpose(1, 2)
+        if self.has_rnn:
+            packed = pack_padded_sequence(current, lens.cpu(), batch_first=True, enforce_sorted=False)
+            output, hidden = self.rnn(packed)
+            if self.pooling == 'last':
+                h_n = hidden[0]
+                current = h_n.transpose(0, 1).reshape(h_n.size(1), -1)
+            elif self.pooling == 'mot':
+                current = self._packed_mean(output.data, output.batch_sizes, output.unsorted_indices)
+            else:
+                current, _ = pad_packed_sequence(output, batch_first=True)
+                current = self._attention(current, mask[:, :current.size(1)], lens)
+        else:
+            if self.pooling == 'last':
+                current = current[torch.arange(current.size(0), device=current.device), lens - 1]
+            elif self.pooling == 'mot':
+                current = (current * mask.unsqueeze(2)).sum(dim=1) / lens.unsqueeze(1).to(current.dtype)
+            else:
+                current = self._attention(current, mask, lens)
+        if segments is not None:
+            current = pool_segments(current, segments)
+        current = self.linear(current)
+        if self.use_features:
+            if features is None:
+                raise RuntimeError('This model needs features')
+            current = current + self.feature_linear(features)
+        return torch.sigmoid(current)
+
+    def _packed_mean(self, data: torch.Tensor, batch_sizes: torch.Tensor,
+                     unsorted_indices: Optional[torch.Tensor]) -> torch.Tensor:
+        starts = torch.cumsum(batch_sizes, 0) - batch_sizes
+        batch_index = torch.arange(data.size(0)) - torch.repeat_interleave(starts, batch_sizes)
+        batch_index = batch_index.to(data.device)
+        batch_size = int(batch_sizes[0])
+        s = torch.zeros(batch_size, data.size(1), dtype=data.dtype, device=data.device).index_add_(0, batch_index, data)
+        s = s / torch.bincount(batch_index, minlength=batch_size).unsqueeze(1).to(s.dtype)
+        if unsorted_indices is not None:
+            s = s.index_select(0, unsorted_indices)
+        return s
+
+    def _attention(self, x: torch.Tensor, mask: torch.Tensor, lens: torch.Tensor) -> torch.Tensor:
+        scores = torch.matmul(torch.tanh(torch.matmul(x, self.att_W)), self.att_V).squeeze(2)
+        scores = scores.masked_fill(mask == 0, float('-inf'))
+        w = F.softmax(scores, dim=1)
+        s = torch.bmm(w.unsqueeze(1), x).squeeze(1)
+        if self.pooling == 'attmean':
+            s = s / lens.unsqueeze(1).to(s.dtype)
+        return s
+
+
+def export_model(model, path=None, freeze=True):
+    '''
+        Scripts model's scoring path (optionally frozen, which inlines the
+        weights and lets the JIT fuse ops) and saves it to path.
+        The result is loaded back with torch.jit.load(path).
+    '''
+    model = model.cpu().eval()
+    scripted = torch.jit.script(ScoringModule(model).eval())
+    if freeze:
+        scripted = torch.jit.freeze(scripted)
+    if path is not None:
+        scripted.save(path)
+        logger.info('Saved scripted model to ' + path)
+    return scripted
@@ -0,0 +1,173 @@
+'''
+    Implements the essay-level (hand crafted) features.
+    Features are registered by name and computed in one shot over the
+    whole encoded corpus with numpy, giving a (num_essays, num_columns)
+    matrix that the model consumes through a single dense input.
+'''
+
+# general imports
+import logging
+import itertools
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PUNCTS = '!?.,;'
+SENTENCE_ENDS = ['.', '!', '?']
+
+# name -> (function, number of columns)
+FEATURES = OrderedDict()
+
+
+def register_feature(name, dim=1):
+    '''
+        Decorator adding a feature to the registry.
+        The function gets a FeatureContext and must return an array of
+        shape (num_essays,) or (num_essays, dim).
+    '''
+    def decorator(fn):
+        if name in FEATURES:
+            raise RuntimeError('Feature %s registered twice' % name)
+        FEATURES[name] = (fn, dim)
+        return fn
+    return decorator
+
+
+def feature_dim(names):
+    return sum(FEATURES[name][1] for name in names)
+
+
+def features_from_args(args):
+    '''
+        Resolves the list of features asked for on the command line.
+        --variety and --punct-count are kept as shorthands.
+    '''
+    names = list(getattr(args, 'features', None) or [])
+    if getattr(args, 'variety', False) and 'variety' not in names:
+        names.append('variety')
+    if getattr(args, 'punct', False) and 'punct' not in names:
+        names.append('punct')
+    for name in names:
+        if name not in FEATURES:
+            raise NotImplementedError('Unknown feature ' + name)
+    return names
+
+
+class FeatureContext:
+    '''
+        Flat view of an encoded corpus, shared by all feature functions.
+            tokens: int array, every essay concatenated
+            lens: int array, number of tokens of each essay
+            rows: int array, essay index of each token
+            tags: int array aligned with tokens (None without POS)
+            vocab: word -> index mapping the tokens were encoded with
+    '''
+    def __init__(self, tokens, lens, vocab, tags=None):
+        self.tokens = np.asarray(tokens, dtype=np.int64)
+        self.lens = np.asarray(lens, dtype=np.int64)
+        self.vocab = vocab
+        self.tags = None if tags is None else np.asarray(tags, dtype=np.int64)
+        self.n = len(self.lens)
+        self.rows = np.repeat(np.arange(self.n), self.lens)
+
+    @classmethod
+    def from_lists(cls, x, vocab, tags=None):
+        lens = np.fromiter((len(e) for e in x), dtype=np.int64, count=len(x))
+        total = int(lens.sum())
+        tokens = np.fromiter(itertools.chain.from_iterable(x), dtype=np.int64, count=total)
+        if tags is not None:
+            tags = np.fromiter(itertools.chain.from_iterable(tags), dtype=np.int64, count=total)
+        return cls(tokens, lens, vocab, tags=tags)
+
+    def per_essay_sum(self, values):
+        return np.bincount(self.rows, weights=values, minlength=self.n)
+
+    def per_essay_mean(self, values, mask=None):
+        if mask is None:
+            counts = self.lens
+        else:
+            values = values * mask
+            counts = np.bincount(self.rows, weights=mask, minlength=self.n)
+        return self.per_essay_sum(values) / np.maximum(counts, 1)
+
+    def word_ids(self, predicate):
+        return np.array([index for word, index in self.vocab.items() if predicate(word)], dtype=np.int64)
+
+    def token_mask(self, predicate):
+        return np.isin(self.tokens, self.word_ids(predicate)).astype(np.float64)
+
+
+@register_feature('length')
+def length_feature(ctx):
+    return np.log1p(ctx.lens)
+
+
+@register_feature('variety')
+def variety_feature(ctx):
+    # Number of distinct (essay, token) pairs per essay / essay length.
+    vocab_size = int(ctx.tokens.max()) + 1 if len(ctx.tokens) > 0 else 1
+    pairs = np.unique(ctx.rows * vocab_size + ctx.tokens)
+    unique = np.bincount(pairs // vocab_size, minlength=ctx.n)
+    return unique / np.maximum(ctx.lens, 1)
+
+
+@register_feature('punct')
+def punct_feature(ctx):
+    return ctx.per_essay_sum(ctx.token_mask(lambda w: len(w) > 0 and w in PUNCTS))
+
+
+@register_feature('sentences')
+def sentences_feature(ctx):
+    ends = ctx.per_essay_sum(ctx.token_mask(lambda w: w in SENTENCE_ENDS))
+    return np.log1p(np.maximum(ends, 1))
+
+
+@register_feature('entities')
+def entities_feature(ctx):
+    return ctx.per_essay_sum(ctx.token_mask(lambda w: w.startswith('@')))
+
+
+@register_feature('unk_rate')
+def unk_rate_feature(ctx):
+    return ctx.per_essay_mean((ctx.tokens == ctx.vocab['<unk>']).astype(np.float64))
+
+
+@register_feature('vocab_rank', dim=2)
+def vocab_rank_feature(ctx):
+    '''
+        Mean and standard deviation of the frequency rank of known words.
+        Indices are handed out by decreasing frequency, so index == rank.
+    '''
+    known = (ctx.tokens > ctx.vocab['<num>']).astype(np.float64)
+    ranks = ctx.tokens / float(max(len(ctx.vocab), 1))
+    mean = ctx.per_essay_mean(ranks, mask=known)
+    sq_mean = ctx.per_essay_mean(ranks * ranks, mask=known)
+    std = np.sqrt(np.maximum(sq_mean - mean * mean, 0))
+    return np.stack([mean, std], axis=1)
+
+
+def pos_distribution_feature(ctx):
+    '''
+        Normalized histogram of POS tags. Registered as pos_dist by
+        dataset.py, which owns the tag set.
+    '''
+    if ctx.tags is None:
+        raise RuntimeError('pos_dist needs the dataset to be built with pos=True')
+    n_tags = FEATURES['pos_dist'][1]
+    counts = np.bincount(ctx.rows * n_tags + ctx.tags, minlength=ctx.n * n_tags)
+    return counts.reshape(ctx.n, n_tags) / np.maximum(ctx.lens, 1)[:, None]
+
+
+def extract_features(ctx, names):
+    '''
+        Returns a float32 matrix of shape (num_essays, feature_dim(names))
+    '''
+    columns = []
+    for name in names:
+        fn, dim = FEATURES[name]
+        values = np.asarray(fn(ctx), dtype=np.float32).reshape(ctx.n, dim)
+        columns.append(values)
+    if len(columns) == 0:
+        return np.zeros((ctx.n, 0), dtype=np.float32)
+    return np.concatenate(columns, axis=1)
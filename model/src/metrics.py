@@ -0,0 +1,97 @@
+'''
+    Batched, non blocking logging of training scalars.
+    Per step values are kept as (detached) tensors in a buffer, so logging
+    them does not force a device sync. Every flush_steps steps or
+    flush_secs seconds the buffer is handed to a background thread that
+    converts the values and writes them with log_fn
+    (tensorboard_logger.log_value), using the same tags and steps as
+    logging every batch directly.
+'''
+
+# general imports
+import logging
+import threading
+import queue
+from time import perf_counter
+# pytorch imports
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsLogger:
+    def __init__(self, log_fn, flush_steps=50, flush_secs=10.):
+        self.log_fn = log_fn
+        self.flush_steps = flush_steps
+        self.flush_secs = flush_secs
+        self.buffer = []  # (step, name, value)
+        self.steps = 0
+        self.essays = 0
+        self.last_flush = perf_counter()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def log(self, step, essays=0, **values):
+        '''
+            values: name -> scalar tensor or number, logged at step.
+            essays: number of essays in the step, for throughput.
+        '''
+        for name, value in values.items():
+            if torch.is_tensor(value):
+                value = value.detach()
+            self.buffer.append((step, name, value))
+        self.essays += essays
+        self.steps += 1
+        if self.steps >= self.flush_steps or \
+                perf_counter() - self.last_flush >= self.flush_secs:
+            self.flush(step)
+
+    def scalar(self, name, value, step):
+        '''
+            Logs a single (already aggregated) value right away.
+        '''
+        self.queue.put([(step, name, value)])
+
+    def flush(self, step=None):
+        now = perf_counter()
+        if len(self.buffer) > 0:
+            items = self.buffer
+            if step is not None and self.essays > 0:
+                items.append((step, 'essays_per_sec', self.essays / max(now - self.last_flush, 1e-9)))
+            self.queue.put(items)
+        self.buffer = []
+        self.steps = 0
+        self.essays = 0
+        self.last_flush = now
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _worker(self):
+        while True:
+            items = self.queue.get()
+            if items is None:
+                break
+            try:
+                self._write(items)
+            except Exception:
+                logger.exception('Could not write metrics')
+
+    def _write(self, items):
+        # Stack the buffered tensors so they come off the device in one go.
+        tensors = [value for _, _, value in items if torch.is_tensor(value)]
+        if len(tensors) > 0:
+            host = iter(torch.stack([t.float().reshape(()) for t in tensors]).cpu().tolist())
+        sums = {}
+        for step, name, value in items:
+            if torch.is_tensor(value):
+                value = next(host)
+            self.log_fn(name, value, step)
+            total, count = sums.get(name, (0., 0))
+            sums[name] = (total + value, count + 1)
+        last_step = items[-1][0]
+        logger.info('step %d: ' % last_step + ', '.join(
+            '%s=%f' % (name, total / count) for name, (total, count) in sorted(sums.items())))
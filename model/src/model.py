@@ -8,6 +8,7 @@ __mail__ = 'haroun7@gmail.com'
 
 # general imports
 import argparse
+import copy
 import pickle
 import os
 import sys
@@ -16,6 +17,7 @@ import numpy as np
 import logging
 import nltk
 import re
+from concurrent.futures import ThreadPoolExecutor
 # pytorch imports
 import torch
 import torch.utils.data
@@ -24,11 +26,14 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.autograd import Variable
 from torch.distributions import Bernoulli
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
 # User imports
-from .custom_layers import Conv1DWithMasking, MeanOverTime, Attention
+from .custom_layers import Conv1DWithMasking, MeanOverTime, Attention, pool_segments
 from .embedding_reader import EmbeddingReader
 from .dataset import pos_dim
+from .features import feature_dim
+from .precision import cpu_autocast, cpu_autocast_dtype, match_dtype
+from .profiling import profiler
 
 logger = logging.getLogger(__name__)
 if sys.platform in ['win32']:
@@ -129,22 +134,13 @@ class Model(torch.nn.Module):
             else:
                 raise NotImplementedError
             self.pooling_layer = layers[-1]
-        if args.variety:
-            variety_size = 1
-            # current_dim += 1
-
-        if args.punct:
-            punct_size = 1
-            # current_dim += 1
         self.linear = nn.Linear(current_dim, num_outputs)
         layers.append(self.linear)
 
-        if args.variety:
-            self.variety_linear = nn.Linear(variety_size, num_outputs)
-            layers.append(self.variety_linear)
-        if args.punct:
-            self.punct_linear = nn.Linear(punct_size, num_outputs)
-            layers.append(self.punct_linear)
+        if args.features:
+            # All essay level features go through one dense input.
+            self.feature_linear = nn.Linear(feature_dim(args.features), num_outputs)
+            layers.append(self.feature_linear)
 
         if not args.skip_init_bias:
             layers[-1].bias.data = init_bias_value
@@ -157,6 +153,33 @@ class Model(torch.nn.Module):
             layers[0].weight = emb_reader.get_emb_matrix_given_vocab(vocab, layers[0].weight)
             logger.info('  Done')
 
+    def __setstate__(self, state):
+        super(Model, self).__setstate__(state)
+        if not hasattr(self.args, 'features'):
+            self._upgrade_legacy_features()
+
+    def _upgrade_legacy_features(self):
+        '''
+            Checkpoints from before the feature registry have --variety and
+            --punct args, with a Linear of their own each. They become
+            args.features and the columns of feature_linear, in the order
+            features_from_args gives (the biases add up).
+        '''
+        args = copy.copy(self.args)
+        args.features = [name for name in ('variety', 'punct') if getattr(args, name, False)]
+        self.args = args
+        if len(args.features) == 0:
+            return
+        old = [self._modules.pop(name + '_linear') for name in args.features]
+        linear = nn.Linear(len(old), old[0].out_features).to(old[0].weight.device)
+        with torch.no_grad():
+            linear.weight.copy_(torch.cat([layer.weight for layer in old], dim=1))
+            linear.bias.copy_(sum(layer.bias for layer in old))
+        self.feature_linear = linear
+        self.layers = [linear if layer is old[0] else layer
+                       for layer in self.layers if not any(layer is o for o in old[1:])]
+        logger.info('Old checkpoint: %s layers merged into feature_linear' % '/'.join(args.features))
+
     def _append_count(self, array, current):
         array = np.array(array)
         temp = torch.unsqueeze(torch.from_numpy(array), 1).float()
@@ -183,13 +206,18 @@ class Model(torch.nn.Module):
             return current.cuda()
         else:
             return current
-    def forward(self, x, mask=None, lens=None, punct=None, variety=None, pos=None):
+    def forward(self, x, mask=None, lens=None, features=None, pos=None, segments=None):
         '''
             x: Variable, batch_size * max_seq_length
                 x is assumed to be padded.
                 x should be a LongTensor
             mask: batch_size * max_seq_length
             lens: batch_size LongTensor, lengths of each sequence.
+            features: batch_size * feature_dim(args.features) FloatTensor
+            segments: (optional) batch_size LongTensor, when the rows of x
+                are windows of essays: the essay of every row. The windows
+                of an essay are averaged before the output layer, features
+                (and the output) have a row per essay.
         '''
         if mask is not None and self.args.cuda:
             mask = mask.cuda()
@@ -201,8 +229,14 @@ class Model(torch.nn.Module):
         if self.args.cuda:
             current = current.cuda()
         # pdb.set_trace()
-        current = self.embedding_layer(current)
+        with profiler.timer('embedding'):
+            current = self.embedding_layer(current)
         # current: batch_size * max_seq_length * emb_dim
+        # With a CNN, stay channels first (batch_size * emb_dim * max_seq_length)
+        # up to the RNN, so the conv needs no permutes of its own.
+        channels_first = hasattr(self, 'cnn_layer')
+        if channels_first:
+            current = current.transpose(1, 2)
         if self.args.pos:
             n = pos_dim()
             # size, msl, emb_dim = current.size()
@@ -216,77 +250,427 @@ class Model(torch.nn.Module):
             # var = torch.autograd.Variable(ohe, pos=None, requires_grad=False)
             # var = pos  # TODO
             # Need to do this because pytorch messes with current.size()[1]
-            var = pos[:, :current.size()[1], :]
+            var = pos[:, :max_seq_length, :]
             if self.args.cuda:
                 var = var.cuda()
-            current = torch.cat((current, var), dim=2)
+            if channels_first:
+                current = torch.cat((current, var.transpose(1, 2)), dim=1)
+            else:
+                current = torch.cat((current, var), dim=2)
         if self.args.cuda:
             current = current.cuda()
         # CNN
         if hasattr(self, 'cnn_layer'):
-            current = self.cnn_layer(current, mask=mask)
+            with profiler.timer('cnn'):
+                current = self.cnn_layer(current, mask=mask, channels_first=True)
+            # Back to batch_size * max_seq_length * cnn_dim (a view).
+            current = current.transpose(1, 2)
         # RNN
         if hasattr(self, 'rnn_layer'):
-            seq_lengths = lens.data.cpu().numpy()
-            current = pack_padded_sequence(current,
-                                           seq_lengths,
-                                           batch_first=True)
-            self.rnn_layer.flatten_parameters()
-            current, _ = self.rnn_layer(current)  # (h0, c0)
+            with profiler.timer('pack'):
+                seq_lengths = lens.data.cpu().numpy()
+                current = pack_padded_sequence(match_dtype(current, self.rnn_layer),
+                                               seq_lengths,
+                                               batch_first=True)
+            with profiler.timer('rnn'):
+                if hasattr(self.rnn_layer, 'flatten_parameters'):  # Not on quantized LSTMs.
+                    self.rnn_layer.flatten_parameters()
+                current, hidden = self.rnn_layer(current)  # (h0, c0)
             # current = temp[0]
-            current, seq_lengths = pad_packed_sequence(current,
-                                                       batch_first=True)
+            if not hasattr(self, 'pooling_layer'):
+                # reg/breg: final state of each sequence (both directions
+                # for breg), no need to unpack the outputs.
+                h_n = hidden[0] if isinstance(hidden, tuple) else hidden
+                current = h_n.transpose(0, 1).contiguous().view(batch_size, -1)
+            # Mean over time pools straight from the packed data.
+            elif not isinstance(self.pooling_layer, MeanOverTime):
+                with profiler.timer('unpack'):
+                    current, seq_lengths = pad_packed_sequence(current,
+                                                               batch_first=True)
         # Dropout
         if hasattr(self, 'dropout_layer'):
-            current = self.dropout_layer(current)
+            if isinstance(current, PackedSequence):
+                current = current._replace(data=self.dropout_layer(current.data))
+            else:
+                current = self.dropout_layer(current)
         if self.args.cuda:
             current = current.cuda()
         # Pooling
         if hasattr(self, 'pooling_layer'):
-            current = self.pooling_layer(current, mask=mask, lens=lens, dim=1)
-        else:
-            current = current[lens]
+            with profiler.timer('pooling'):
+                current = self.pooling_layer(current, mask=mask, lens=lens, dim=1)
+        elif current.dim() == 3:
+            # No RNN: last real time step of each sequence.
+            current = current[torch.arange(batch_size, device=current.device), lens - 1]
+        if segments is not None:
+            current = pool_segments(current, segments)
 
         counts = []
         current = self.linear(current)
         #pdb.set_trace()
-        if self.args.variety:
+        if self.args.features:
             if self.args.cuda:
-                current += self.variety_linear(variety.cuda())
+                current += self.feature_linear(features.cuda())
             else:
-                current += self.variety_linear(variety.cpu())
-        if self.args.punct:
-            if self.args.cuda:
-                current += self.punct_linear(punct.cuda())
-            else:
-                current += self.punct_linear(punct.cpu())
+                current += self.feature_linear(features.cpu())
 
         current = self.sigmoid(current)
         return current
+VOTING_STRATEGIES = ('mean', 'median', 'supervisor')
+
+
+def vote(predictions, strategy='mean'):
+    '''
+        Combines the members' predictions (a list of batch_size * 1, or a
+        batch_size * n_members tensor) into batch_size * 1, whatever the strategy.
+    '''
+    concat_preds = torch.cat(predictions, dim=1) if isinstance(predictions, (list, tuple)) else predictions
+    if strategy == "mean":
+        return concat_preds.mean(dim=1, keepdim=True)
+    elif strategy == "median":
+        return concat_preds.median(dim=1, keepdim=True)[0]
+    elif strategy == 'supervisor':
+        first, second, supervisor = concat_preds[:, 0:1], concat_preds[:, 1:2], concat_preds[:, 2:3]
+        sign = torch.sign(torch.abs(second - first))
+        return supervisor * sign + 0.5*(first + second)*(1 - sign)
+    else:
+        raise Exception("Invalid voting strategy")
+
+
 class EnsembleModel(torch.nn.Module):
-    def __init__(self, models, _type="mean"):
+    def __init__(self, models, _type="mean", parallel=True):
+        '''
+            models: paths of torch.save'd models
+            _type: voting strategy, one of VOTING_STRATEGIES
+            parallel: run the members in threads (torch releases the GIL in
+                its ops), so latency is closer to the slowest member than
+                to the sum of them.
+        '''
         super(EnsembleModel, self).__init__()
-        models = [torch.load(model, map_location=lambda storage, location: storage) for model in models]
-        # Move stuff to CPU and out of DataParallel.
-        for i in range(len(models)):
-            if type(models[i]) is torch.nn.DataParallel:
-                models[i] = models[i].module
-            models[i].cpu()
+        if _type not in VOTING_STRATEGIES:
+            raise Exception("Invalid voting strategy")
+        models = [_load_member(model) for model in models]
 
         self.models = torch.nn.ModuleList(models)
         self.voting_strategy = _type
+        self.parallel = parallel
+        self._pool = None
         if _type == 'supervisor':
             if len(models) != 3:
                 raise RuntimeError('Must be a supervisor with 3')
-    def forward(self, x, *args, **kwargs):
-        predictions = [model(x, *args, **kwargs) for model in self.models]
-        concat_preds = torch.cat(predictions, dim=1)
-        if self.voting_strategy == "mean":
-            return concat_preds.mean(dim=1)
-        elif self.voting_strategy == "median":
-            return torch.median(concat_preds, dim=1)
-        elif self.voting_strategy == 'supervisor':
-            sign = torch.sign(torch.abs(predictions[1] - predictions[0]))
-            return predictions[2] * sign + 0.5*(predictions[0] + predictions[1])*(1 - sign)
+
+    def __getstate__(self):
+        # Thread pools can't be pickled (torch.save, deepcopy).
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def forward(self, x, mask=None, lens=None, features=None, pos=None, segments=None):
+        '''
+            Same inputs as Model.forward, returns batch_size * 1.
+        '''
+        inputs = self.shared_inputs(x, mask, lens, features, pos, segments)
+        if getattr(self, 'parallel', True) and len(self.models) > 1:
+            # Grad mode and autocast are thread local, carry the caller's over.
+            grad_enabled = torch.is_grad_enabled()
+            autocast_dtype = cpu_autocast_dtype()
+            if getattr(self, '_pool', None) is None:
+                self._pool = ThreadPoolExecutor(max_workers=len(self.models))
+            futures = [self._pool.submit(_run_member, model, inputs, grad_enabled, autocast_dtype) for model in self.models]
+            predictions = [future.result() for future in futures]
         else:
+            predictions = [model(**inputs) for model in self.models]
+        return vote(predictions, self.voting_strategy)
+
+    def shared_inputs(self, x, mask=None, lens=None, features=None, pos=None, segments=None):
+        '''
+            Moves the batch to the members' device and trims the POS one-hots
+            once, instead of once per member.
+        '''
+        param = next(self.parameters(), None)
+        device = param.device if param is not None else torch.device('cpu')
+        x = x.long().to(device)
+        if mask is not None:
+            mask = mask.to(device)
+        if lens is not None:
+            lens = lens.to(device)
+        if features is not None:
+            features = features.to(device)
+        if pos is not None:
+            pos = pos[:, :x.size(1), :].to(device)
+        if segments is not None:
+            segments = segments.to(device)
+        return dict(x=x, mask=mask, lens=lens, features=features, pos=pos, segments=segments)
+
+
+def _run_member(model, inputs, grad_enabled, autocast_dtype=None):
+    with torch.set_grad_enabled(grad_enabled), cpu_autocast(autocast_dtype):
+        return model(**inputs)
+
+
+def _load_member(model):
+    '''
+        model: a Model or the path of a torch.save'd one.
+        Returns it on CPU and out of DataParallel.
+    '''
+    if isinstance(model, str):
+        model = torch.load(model, map_location=lambda storage, location: storage)
+    if type(model) is torch.nn.DataParallel:
+        model = model.module
+    return model.cpu()
+
+
+def _frozen(tensor):
+    return nn.Parameter(tensor.detach().clone(), requires_grad=False)
+
+
+def _lstm_steps(gates_x, weight_hh, valid, reverse: bool):
+    '''
+        The recurrence of one StackedLSTM direction.
+        gates_x: max_seq_length * n * batch_size * 4hidden input projections
+        weight_hh: n * hidden * 4hidden
+        valid: max_seq_length * 1 * batch_size * 1 bool
+        Returns the outputs, n * batch_size * max_seq_length * hidden with
+        zeros on padding, and the final states, n * batch_size * hidden.
+    '''
+    max_seq_length = gates_x.size(0)
+    h = weight_hh.new_zeros(gates_x.size(1), gates_x.size(2), weight_hh.size(1))
+    c = torch.zeros_like(h)
+    steps = []
+    for s in range(max_seq_length):
+        t = max_seq_length - 1 - s if reverse else s
+        gates = gates_x[t] + torch.bmm(h, weight_hh)
+        i, f, g, o = gates.chunk(4, dim=2)
+        c_t = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        h_t = torch.sigmoid(o) * torch.tanh(c_t)
+        # Padding leaves the state alone, so the backward direction
+        # starts from zeros at every essay's last token.
+        c = torch.where(valid[t], c_t, c)
+        h = torch.where(valid[t], h_t, h)
+        steps.append(h * valid[t])
+    outputs = torch.stack(steps, dim=2)
+    if reverse:
+        outputs = outputs.flip(2)
+    return outputs, h
+
+
+_scripted_lstm_steps = None
+
+
+def _step_loop():
+    '''
+        _lstm_steps compiled with TorchScript (on first use), so the time
+        steps do not go through the interpreter op by op. The eager
+        function under autocast, which TorchScript does not follow on CPU.
+    '''
+    global _scripted_lstm_steps
+    if cpu_autocast_dtype() is not None:
+        return _lstm_steps
+    if _scripted_lstm_steps is None:
+        _scripted_lstm_steps = torch.jit.script(_lstm_steps)
+    return _scripted_lstm_steps
+
+
+class StackedLSTM(nn.Module):
+    def __init__(self, rnns):
+        '''
+            Single layer LSTMs of the same shape run side by side, for
+            inference: their weights are stacked along a member dimension
+            and every time step is one batched matmul over the members, so
+            no work goes into cross member (zero) blocks. The step loop
+            runs TorchScript compiled (see _step_loop).
+        '''
+        super(StackedLSTM, self).__init__()
+        first = rnns[0]
+        for rnn in rnns:
+            if not isinstance(rnn, nn.LSTM) or rnn.num_layers != 1 or not rnn.bias:
+                raise RuntimeError('Can only stack single layer float LSTMs')
+        self.n, self.hidden_size = len(rnns), first.hidden_size
+        self.directions = 2 if first.bidirectional else 1
+        suffixes = ['_l0', '_l0_reverse'][:self.directions]
+        # Per direction: n * 4hidden * input_size, n * hidden * 4hidden, n * 4hidden
+        self.weight_ih = nn.ParameterList([_frozen(torch.stack([getattr(rnn, 'weight_ih' + suffix) for rnn in rnns]))
+                                           for suffix in suffixes])
+        self.weight_hh = nn.ParameterList([_frozen(torch.stack([getattr(rnn, 'weight_hh' + suffix).t() for rnn in rnns]))
+                                           for suffix in suffixes])
+        self.bias = nn.ParameterList([_frozen(torch.stack([getattr(rnn, 'bias_ih' + suffix) + getattr(rnn, 'bias_hh' + suffix) for rnn in rnns]))
+                                      for suffix in suffixes])
+
+    def forward(self, x, lens):
+        '''
+            x: batch_size * max_seq_length * (n * input_size), padded, the
+                members' inputs side by side
+            lens: batch_size LongTensor
+            Returns the outputs, batch_size * max_seq_length * n *
+            (directions * hidden) with zeros on padding, and the final
+            states, batch_size * n * (directions * hidden), each member's
+            laid out like its own LSTM's (forward then backward).
+        '''
+        batch_size, max_seq_length = x.size(0), x.size(1)
+        x = x.view(batch_size, max_seq_length, self.n, -1)
+        # max_seq_length * 1 * batch_size * 1
+        valid = torch.arange(max_seq_length, device=x.device).view(-1, 1) < lens.to(x.device).view(1, -1)
+        valid = valid.view(max_seq_length, 1, batch_size, 1)
+        outputs, finals = [], []
+        steps = _step_loop()
+        for d in range(self.directions):
+            # Input projections of every step at once: max_seq_length * n * batch_size * 4hidden
+            gates_x = torch.einsum('btni,ngi->tnbg', x, self.weight_ih[d]) + self.bias[d].unsqueeze(1)
+            output, final = steps(gates_x, self.weight_hh[d], valid, d == 1)
+            outputs.append(output)  # n * batch_size * max_seq_length * hidden
+            finals.append(final)
+        return torch.cat(outputs, dim=3).permute(1, 2, 0, 3), torch.cat(finals, dim=2).transpose(0, 1)
+
+
+class StackedEnsemble(torch.nn.Module):
+    def __init__(self, models, _type="mean"):
+        '''
+            N members of the same architecture (e.g. seeds of one bregp
+            config) fused into one module, for inference only:
+            one embedding lookup in the concatenated tables, a grouped conv
+            (groups=N), an LSTM recurrence batched over the members
+            (StackedLSTM) and stacked attention and output weights
+            evaluated with einsum.
+            models: Models or paths of torch.save'd ones
+            _type: voting strategy, one of VOTING_STRATEGIES
+        '''
+        super(StackedEnsemble, self).__init__()
+        if _type not in VOTING_STRATEGIES:
             raise Exception("Invalid voting strategy")
+        models = [_load_member(model) for model in models]
+        if _type == 'supervisor' and len(models) != 3:
+            raise RuntimeError('Must be a supervisor with 3')
+        first = models[0]
+        shapes = [(k, v.shape) for k, v in first.state_dict().items()]
+        for model in models[1:]:
+            if [(k, v.shape) for k, v in model.state_dict().items()] != shapes or \
+                    type(getattr(model, 'pooling_layer', None)) is not type(getattr(first, 'pooling_layer', None)) or \
+                    bool(model.args.pos) != bool(first.args.pos):
+                raise RuntimeError('Can only stack members of the same architecture')
+            # Feature sets of the same dimension have the same shapes.
+            if list(getattr(model.args, 'features', [])) != list(getattr(first.args, 'features', [])):
+                raise RuntimeError('Can only stack members with the same features')
+        self.args = first.args
+        self.n = len(models)
+        self.voting_strategy = _type
+        self.use_pos = bool(first.args.pos)
+
+        self.embedding = nn.Embedding.from_pretrained(
+            torch.cat([model.embedding_layer.weight.detach() for model in models], dim=1), freeze=True)
+        if hasattr(first, 'cnn_layer'):
+            conv = first.cnn_layer.conv
+            self.conv = nn.Conv1d(conv.in_channels * self.n,
+                                  conv.out_channels * self.n,
+                                  conv.kernel_size[0],
+                                  padding=conv.padding[0],
+                                  groups=self.n)
+            self.conv.weight = _frozen(torch.cat([model.cnn_layer.conv.weight for model in models], dim=0))
+            self.conv.bias = _frozen(torch.cat([model.cnn_layer.conv.bias for model in models], dim=0))
+        else:
+            self.conv = None
+        if hasattr(first, 'rnn_layer'):
+            self.rnn = StackedLSTM([model.rnn_layer for model in models])
+            self.directions = self.rnn.directions
+        else:
+            self.rnn = None
+            self.directions = 1
+
+        pooling_layer = getattr(first, 'pooling_layer', None)
+        if pooling_layer is None:
+            self.pooling = 'last'
+        elif isinstance(pooling_layer, MeanOverTime):
+            self.pooling = 'mot'
+            self.pooling_layer = MeanOverTime()
+        elif isinstance(pooling_layer, Attention):
+            self.pooling = pooling_layer.op
+            # n * hidden * hidden, n * hidden
+            self.att_W = _frozen(torch.stack([model.pooling_layer.att_W for model in models]))
+            self.att_V = _frozen(torch.stack([model.pooling_layer.att_V.squeeze(1) for model in models]))
+        else:
+            raise NotImplementedError
+        # n * num_outputs * hidden, n * num_outputs
+        self.linear_weight = _frozen(torch.stack([model.linear.weight for model in models]))
+        self.linear_bias = _frozen(torch.stack([model.linear.bias for model in models]))
+        if hasattr(first, 'feature_linear'):
+            self.feature_weight = _frozen(torch.stack([model.feature_linear.weight for model in models]))
+            self.feature_bias = _frozen(torch.stack([model.feature_linear.bias for model in models]))
+
+    def forward(self, x, mask=None, lens=None, features=None, pos=None, segments=None):
+        '''
+            Same inputs as Model.forward, returns batch_size * 1.
+        '''
+        preds = self.member_predictions(x, mask=mask, lens=lens, features=features, pos=pos, segments=segments)
+        return vote(preds.squeeze(2), self.voting_strategy)
+
+    def member_predictions(self, x, mask=None, lens=None, features=None, pos=None, segments=None):
+        '''
+            Returns batch_size * n_members * num_outputs, what every member
+            would have output on its own.
+        '''
+        n = self.n
+        batch_size, max_seq_length = x.size(0), x.size(1)
+        x = x.long()
+        if lens is None:
+            lens = torch.full((batch_size,), max_seq_length, dtype=torch.long)
+        lens = lens.to(x.device)
+        if mask is None:
+            mask = torch.arange(max_seq_length, device=x.device).unsqueeze(0) < lens.unsqueeze(1)
+        mask = mask[:, :max_seq_length].float().to(x.device)
+        # batch_size * max_seq_length * (n * emb_dim)
+        current = self.embedding(x)
+        if self.use_pos:
+            # Every member gets [its embedding, pos], like Model does.
+            var = pos[:, :max_seq_length, :].to(device=current.device, dtype=current.dtype)
+            current = torch.cat((current.view(batch_size, max_seq_length, n, -1),
+                                 var.unsqueeze(2).expand(-1, -1, n, -1)), dim=3)
+            current = current.view(batch_size, max_seq_length, -1)
+        if self.conv is not None:
+            current = self.conv(current.transpose(1, 2)) * mask.unsqueeze(1)
+            current = current.transpose(1, 2)
+        if self.rnn is not None:
+            # batch_size * max_seq_length * n * (directions * hidden), batch_size * n * (directions * hidden)
+            outputs, last = self.rnn(current, lens)
+            if self.pooling == 'last':
+                current = last
+            elif self.pooling == 'mot':
+                # Padding outputs are zeros.
+                current = outputs.sum(dim=1) / lens.view(-1, 1, 1).to(outputs.dtype)
+            else:
+                current = self._attention(outputs, mask, lens)
+        elif self.pooling == 'last':
+            current = self._per_member(current[torch.arange(batch_size, device=current.device), lens - 1])
+        elif self.pooling == 'mot':
+            current = self._per_member(self.pooling_layer(current, mask=mask, lens=lens))
+        else:
+            current = self._attention(self._per_member(current), mask, lens)
+        if segments is not None:
+            current = pool_segments(current, segments)
+        # batch_size * n * num_outputs
+        current = torch.einsum('bnh,noh->bno', current, self.linear_weight) + self.linear_bias
+        if hasattr(self, 'feature_weight'):
+            features = features.to(device=current.device, dtype=current.dtype)
+            current = current + torch.einsum('bf,nof->bno', features, self.feature_weight) + self.feature_bias
+        return torch.sigmoid(current)
+
+    def _per_member(self, current):
+        '''
+            ... * (directions * n * hidden) -> ... * n * (directions * hidden),
+            in the order each member lays out its own features.
+        '''
+        shape = current.size()[:-1]
+        current = current.view(*shape, self.directions, self.n, -1).transpose(-3, -2)
+        return current.reshape(*shape, self.n, -1)
+
+    def _attention(self, x, mask, lens):
+        '''
+            x: batch_size * max_seq_length * n * hidden
+            Returns batch_size * n * hidden
+        '''
+        scores = torch.einsum('btnh,nhk->btnk', x, self.att_W)
+        scores = torch.einsum('btnk,nk->btn', torch.tanh(scores), self.att_V)
+        scores = scores.masked_fill(mask[:, :x.size(1)].unsqueeze(2) == 0, float('-inf'))
+        w = F.softmax(scores, dim=1)
+        s = torch.einsum('btn,btnh->bnh', w, x)
+        if self.pooling == 'attmean':
+            s = s / lens.view(-1, 1, 1).float()
+        return s
@@ -0,0 +1,108 @@
+'''
+    Part of speech tagging of many sentences at once, with the same output
+    as calling NLTK's PerceptronTagger.tag on every sentence:
+        - sentences are deduplicated and memoized (essays on a prompt
+          repeat a lot of them),
+        - sentences whose tokens are all in the tagger's tagdict are tagged
+          by lookup (the perceptron is never consulted for those words, and
+          the tags of other words are not involved),
+        - the rest go through the perceptron, in a process pool if asked.
+'''
+
+# general imports
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+_worker_tagger = None
+
+
+def _perceptron_tagger():
+    from nltk.tag.perceptron import PerceptronTagger
+    return PerceptronTagger()
+
+
+def _init_worker():
+    global _worker_tagger
+    _worker_tagger = _perceptron_tagger()
+
+
+def _tag_in_worker(sentences):
+    return [[tag for _, tag in _worker_tagger.tag(list(sentence))] for sentence in sentences]
+
+
+class POSTagger:
+    def __init__(self, workers=1, max_cache=500000, chunk_size=256):
+        '''
+            workers: processes for the perceptron, 1 tags in this process.
+            max_cache: sentences memoized at most.
+        '''
+        self.workers = workers
+        self.max_cache = max_cache
+        self.chunk_size = chunk_size
+        self.cache = {}
+        self.stats = {'sentences': 0, 'cached': 0, 'lexicon': 0, 'tagged': 0}
+        self._tagger = None
+
+    @property
+    def tagger(self):
+        if self._tagger is None:
+            self._tagger = _perceptron_tagger()
+        return self._tagger
+
+    def tag(self, tokens):
+        '''
+            Tags of one sentence (a list of tokens).
+        '''
+        return self.tag_sentences([tokens])[0]
+
+    def tag_sentences(self, sentences, workers=None):
+        '''
+            sentences: list of lists of tokens
+            workers: (optional) overrides self.workers
+            Returns the list of tags of every sentence.
+        '''
+        tagdict = self.tagger.tagdict
+        keys = [tuple(sentence) for sentence in sentences]
+        self.stats['sentences'] += len(keys)
+        results = {}
+        todo = []
+        for key in keys:
+            if key in results:
+                self.stats['cached'] += 1
+                continue
+            if key in self.cache:
+                results[key] = self.cache[key]
+                self.stats['cached'] += 1
+            elif all(token in tagdict for token in key):
+                results[key] = [tagdict[token] for token in key]
+                self.stats['lexicon'] += 1
+            else:
+                results[key] = None
+                todo.append(key)
+        self.stats['tagged'] += len(todo)
+        for key, tags in zip(todo, self._tag_with_perceptron(todo, self.workers if workers is None else workers)):
+            results[key] = tags
+        for key, tags in results.items():
+            if len(self.cache) >= self.max_cache:
+                break
+            self.cache[key] = tags
+        return [list(results[key]) for key in keys]
+
+    def _tag_with_perceptron(self, sentences, workers):
+        if workers <= 1 or len(sentences) < 2 * self.chunk_size:
+            return [[tag for _, tag in self.tagger.tag(list(sentence))] for sentence in sentences]
+        chunks = [sentences[i:i + self.chunk_size] for i in range(0, len(sentences), self.chunk_size)]
+        with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+            return [tags for chunk in pool.map(_tag_in_worker, chunks) for tags in chunk]
+
+    def log_stats(self):
+        total = max(self.stats['sentences'], 1)
+        logger.info('  POS tagging: %d sentences, %.1f%% memoized, %.1f%% by lexicon, %.1f%% by the perceptron' % (
+            self.stats['sentences'], 100. * self.stats['cached'] / total,
+            100. * self.stats['lexicon'] / total, 100. * self.stats['tagged'] / total))
+
+
+# Shared by every dataset, so dev/test reuse the training set's sentences.
+pos_tagger = POSTagger()
@@ -0,0 +1,60 @@
+'''
+    bfloat16 mixed precision on CPU. The weights stay float32 and autocast
+    runs the matmul heavy ops (linear, conv, LSTM, attention) in bfloat16;
+    embeddings, masks and reductions keep their dtype. bfloat16 has
+    float32's exponent range, so there is no loss scaling like float16
+    needs: a step whose gradients still come out non finite is skipped.
+'''
+
+# general imports
+import contextlib
+# pytorch imports
+import torch
+
+
+def bf16_autocast(enabled=True):
+    '''
+        Context running what is called in it in bfloat16 on CPU, a no-op
+        when not enabled.
+    '''
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast('cpu', dtype=torch.bfloat16)
+
+
+def cpu_autocast_dtype():
+    '''
+        dtype the calling thread autocasts CPU ops to, None without
+        autocast. Autocast is thread local, threads that run model code
+        for the caller have to enter it again (see EnsembleModel.forward).
+    '''
+    if hasattr(torch, 'get_autocast_dtype'):  # torch >= 2.4
+        return torch.get_autocast_dtype('cpu') if torch.is_autocast_enabled('cpu') else None
+    return torch.get_autocast_cpu_dtype() if torch.is_autocast_cpu_enabled() else None
+
+
+def cpu_autocast(dtype):
+    '''
+        Context autocasting CPU ops to dtype, a no-op for None.
+    '''
+    return torch.autocast('cpu', dtype=dtype, enabled=dtype is not None)
+
+
+def match_dtype(x, module):
+    '''
+        x in the dtype of module's float parameters: under autocast, a
+        bfloat16 conv output going into an op autocast leaves alone (the
+        LSTM on older torch) would not match its float32 weights.
+        x itself when module has none (e.g. quantized modules).
+    '''
+    for param in module.parameters():
+        if param.is_floating_point():
+            return x if x.dtype == param.dtype else x.to(param.dtype)
+    return x
+
+
+def finite(tensor):
+    '''
+        Whether every element of tensor (e.g. a gradient norm) is finite.
+    '''
+    return bool(torch.isfinite(tensor).all())
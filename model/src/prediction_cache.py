@@ -0,0 +1,105 @@
+'''
+    On disk cache of raw (sigmoid) model outputs, keyed by the hash of the
+    checkpoint file and the hash of the encoded dataset. Every entry is one
+    float32 .npy array in dataset order, so scoring the same checkpoints
+    on the same folds again (rankings, ensemble strategies, distillation
+    teachers) does not run the models.
+'''
+
+# general imports
+import os
+import hashlib
+import logging
+import numpy as np
+# User imports
+from .evaluation import load_model, predict
+
+logger = logging.getLogger(__name__)
+
+_CHUNK = 1 << 20
+_file_hashes = {}
+
+
+def checkpoint_hash(path):
+    '''
+        sha1 of the checkpoint's bytes, memoized on (path, size, mtime).
+    '''
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_CHUNK), b''):
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def dataset_hash(dataset):
+    '''
+        sha1 of what a model sees of dataset: the TSV (POS tags come from
+        the raw text), the encoded essays (vocab, maxlen, long essay mode
+        and prompt filtering) and the essay level features.
+    '''
+    h = hashlib.sha1()
+    # Corpus datasets are named <tsv>#fold_k/<split>, the name goes in the repr below.
+    with open(dataset.tsv_file.split('#')[0], 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b''):
+            h.update(chunk)
+    h.update(repr((dataset.tsv_file, dataset.prompt_id, bool(dataset.pos), list(dataset.feature_names), dataset.tokenizer.name)).encode())
+    # Only windowed datasets hash their windows, other keys are unchanged.
+    if getattr(dataset, 'window', None) is not None:
+        h.update(repr(('window', dataset.window)).encode())
+    for x in dataset.x:
+        h.update(np.asarray(x, dtype=np.int64).tobytes())
+        h.update(b'|')
+    if dataset.features is not None:
+        h.update(np.ascontiguousarray(dataset.features.data.cpu().numpy()).tobytes())
+    return h.hexdigest()
+
+
+class PredictionCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._dataset_hashes = {}
+
+    def path(self, checkpoint, dataset):
+        return os.path.join(self.cache_dir, '%s_%s.npy' % (checkpoint_hash(checkpoint)[:20], self._dataset_hash(dataset)[:20]))
+
+    def get(self, checkpoint, dataset):
+        '''
+            Cached outputs of checkpoint on dataset, or None.
+        '''
+        path = self.path(checkpoint, dataset)
+        if not os.path.exists(path):
+            return None
+        preds = np.load(path)
+        if len(preds) != len(dataset):
+            logger.warning('Ignoring %s: %d predictions for %d essays' % (path, len(preds), len(dataset)))
+            return None
+        return preds
+
+    def put(self, checkpoint, dataset, preds):
+        path = self.path(checkpoint, dataset)
+        # Write then rename, so readers never see half an array.
+        tmp = path + '.tmp.%d.npy' % os.getpid()
+        np.save(tmp, np.asarray(preds, dtype=np.float32))
+        os.replace(tmp, path)
+
+    def predictions(self, checkpoint, dataset, batch_size, cuda=False):
+        '''
+            Outputs of checkpoint on dataset, from the cache or by running
+            the model (and caching them).
+        '''
+        preds = self.get(checkpoint, dataset)
+        if preds is None:
+            logger.info('Running ' + checkpoint)
+            preds = predict(load_model(checkpoint, cuda=cuda), dataset, batch_size, cuda=cuda)
+            self.put(checkpoint, dataset, preds)
+        return preds
+
+    def _dataset_hash(self, dataset):
+        if id(dataset) not in self._dataset_hashes:
+            self._dataset_hashes[id(dataset)] = (dataset, dataset_hash(dataset))
+        return self._dataset_hashes[id(dataset)][1]
@@ -0,0 +1,119 @@
+'''
+    Lightweight timing/counting instrumentation.
+    A single module level `profiler` is shared by the dataloader, the model
+    and the training loop. It is off by default, in which case timer()
+    hands back a no-op context manager.
+'''
+
+# general imports
+import logging
+import contextlib
+from collections import defaultdict
+from time import perf_counter
+# pytorch imports
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.synchronize = False  # Set when timing cuda kernels.
+        self.record_functions = False  # Also label phases in torch.profiler traces.
+        self._noop = contextlib.nullcontext()
+        self.reset()
+
+    def enable(self, synchronize=False, record_functions=False):
+        self.enabled = True
+        self.synchronize = synchronize
+        self.record_functions = record_functions
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(float)
+        self.start = perf_counter()
+
+    def timer(self, name):
+        if not self.enabled:
+            return self._noop
+        return self._timer(name)
+
+    @contextlib.contextmanager
+    def _timer(self, name):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        if self.record_functions:
+            label = torch.autograd.profiler.record_function(name)
+            label.__enter__()
+        begin = perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.times[name] += perf_counter() - begin
+            self.calls[name] += 1
+            if self.record_functions:
+                label.__exit__(None, None, None)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def summary(self):
+        '''
+            Returns a dict of
+                <phase>_ms: average milliseconds per call of the phase
+                <phase>_total_s: seconds spent in the phase
+                tokens_per_sec, essays_per_sec, padding_fraction
+            over everything recorded since the last reset()
+        '''
+        wall = max(perf_counter() - self.start, 1e-9)
+        stats = {'wall_s': wall}
+        for name, seconds in self.times.items():
+            stats[name + '_ms'] = 1000. * seconds / max(self.calls[name], 1)
+            stats[name + '_total_s'] = seconds
+        stats['tokens_per_sec'] = self.counters['tokens'] / wall
+        stats['essays_per_sec'] = self.counters['essays'] / wall
+        if self.counters['padded_tokens'] > 0:
+            stats['padding_fraction'] = 1. - self.counters['tokens'] / self.counters['padded_tokens']
+        return stats
+
+    def report(self, step, log_fn=None, prefix='profile/'):
+        '''
+            Logs the summary and sends every value to log_fn(name, value, step)
+            (tensorboard_logger.log_value), then starts a new window.
+        '''
+        if not self.enabled:
+            return {}
+        stats = self.summary()
+        logger.info('Profile for step %d:' % step)
+        for name in sorted(stats.keys()):
+            logger.info('  %s: %.3f' % (name, stats[name]))
+            if log_fn is not None:
+                log_fn(prefix + name, stats[name], step)
+        self.reset()
+        return stats
+
+
+profiler = Profiler()
+
+
+def trace_profiler(trace_dir, wait=1, warmup=1, active=5):
+    '''
+        torch.profiler session writing tensorboard traces to trace_dir.
+        Call .step() once per batch.
+    '''
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+        record_shapes=True,
+        profile_memory=True
+        )
@@ -0,0 +1,46 @@
+'''
+    Post training dynamic int8 quantization for CPU inference.
+    LSTM and Linear weights are stored as int8 and activations are
+    quantized on the fly, the embedding table can optionally be int8 too.
+    Works on Model and EnsembleModel (every member gets quantized).
+'''
+
+# general imports
+import io
+import copy
+import logging
+# pytorch imports
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, float_qparams_weight_only_qconfig
+# User imports
+from .evaluation import set_cuda_flag
+
+logger = logging.getLogger(__name__)
+
+
+def quantize_model(model, embeddings=False):
+    '''
+        Returns an int8 copy of model, on CPU and in eval mode.
+        embeddings: also store nn.Embedding weights in 8 bits.
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    set_cuda_flag(model, False)
+    qconfig_spec = {
+        nn.LSTM: default_dynamic_qconfig,
+        nn.Linear: default_dynamic_qconfig
+        }
+    if embeddings:
+        qconfig_spec[nn.Embedding] = float_qparams_weight_only_qconfig
+    qmodel = quantize_dynamic(model, qconfig_spec=qconfig_spec, dtype=torch.qint8)
+    logger.info('Quantized model: %.2f MB -> %.2f MB' % (model_size(model) / 2**20, model_size(qmodel) / 2**20))
+    return qmodel
+
+
+def model_size(model):
+    '''
+        Bytes taken by the serialized state_dict.
+    '''
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
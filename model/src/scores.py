@@ -0,0 +1,101 @@
+'''
+    Scaling between ASAP scores and the [0, 1] range the models are
+    trained on. The score range of every prompt is held in lookup arrays
+    indexed by prompt, so a whole array (or tensor) of scores of mixed
+    prompts is scaled, or rounded back to ratings, in one operation.
+'''
+
+# general imports
+import numpy as np
+# pytorch imports
+import torch
+
+# prompt -> (lowest, highest) score
+ASAP_RANGES = {
+    0: (0, 60),
+    1: (2, 12),
+    2: (1, 6),
+    3: (0, 3),
+    4: (0, 3),
+    5: (0, 4),
+    6: (0, 4),
+    7: (0, 30),
+    8: (0, 60)
+}
+
+
+class ScoreScaler:
+    def __init__(self, ranges=ASAP_RANGES):
+        n_prompts = max(ranges) + 1
+        self.low = np.zeros(n_prompts, dtype=np.float64)
+        self.high = np.ones(n_prompts, dtype=np.float64)
+        self.known = np.zeros(n_prompts, dtype=bool)
+        for prompt, (low, high) in ranges.items():
+            if prompt < 0:
+                raise ValueError('Prompts are non negative, got %d' % prompt)
+            self.low[prompt], self.high[prompt] = low, high
+            self.known[prompt] = True
+        self._tensors = {}  # (device, dtype) -> (low, high)
+
+    def range(self, prompt):
+        self._check(prompt)
+        return int(self.low[prompt]), int(self.high[prompt])
+
+    def _check(self, prompts):
+        '''
+            Raises KeyError for prompts without a range, negative ones
+            included (numpy indexing would wrap them around).
+        '''
+        values = prompts.detach().cpu().numpy() if torch.is_tensor(prompts) else np.asarray(prompts)
+        values = values.ravel().astype(np.int64)
+        if values.size == 0:
+            return
+        if values.min() < 0 or values.max() >= len(self.known) or not self.known[values].all():
+            unknown = sorted(set(values.tolist()) - set(np.flatnonzero(self.known).tolist()))
+            raise KeyError('No score range for prompt(s) %s' % unknown)
+
+    def _bounds(self, prompts, like):
+        '''
+            low and high of prompts (an int, or an array/tensor of ints),
+            as tensors on like's device when like is a tensor.
+        '''
+        self._check(prompts)
+        if not torch.is_tensor(like):
+            return self.low[prompts], self.high[prompts]
+        key = (like.device, like.dtype)
+        if key not in self._tensors:
+            self._tensors[key] = (torch.tensor(self.low, dtype=like.dtype, device=like.device),
+                                  torch.tensor(self.high, dtype=like.dtype, device=like.device))
+        low, high = self._tensors[key]
+        if torch.is_tensor(prompts):
+            prompts = prompts.to(like.device).long()
+        return low[prompts], high[prompts]
+
+    def to_model(self, scores, prompts):
+        '''
+            ASAP scores -> [0, 1]
+        '''
+        low, high = self._bounds(prompts, scores)
+        return (scores - low) / (high - low)
+
+    def to_dataset(self, scores, prompts):
+        '''
+            [0, 1] -> ASAP scores (not rounded)
+        '''
+        low, high = self._bounds(prompts, scores)
+        return low + (high - low) * scores
+
+    def to_ratings(self, scores, prompts):
+        '''
+            [0, 1] -> integer ASAP ratings, rounded half to even and
+            clipped to the prompt's range.
+        '''
+        low, high = self._bounds(prompts, scores)
+        ratings = low + (high - low) * scores
+        if torch.is_tensor(ratings):
+            return torch.max(torch.min(torch.round(ratings), high), low).long()
+        return np.clip(np.rint(ratings), low, high).astype(np.int64)
+
+
+# Shared by the datasets and the evaluation code.
+score_scaler = ScoreScaler()
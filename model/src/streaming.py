@@ -0,0 +1,191 @@
+'''
+    Streaming version of ASAPDataset, for training files that do not fit
+    in memory: the TSV is read chunk_size essays at a time, each chunk is
+    tokenized, (POS tagged,) encoded with a fixed vocab and its features
+    computed, then the essays go through a shuffle buffer and out as
+    batches shaped like ASAPDataLoader's. At most chunk_size +
+    shuffle_buffer essays are held at once.
+'''
+
+# general imports
+import random
+import logging
+from collections import namedtuple
+import numpy as np
+import torch
+# User imports
+from .dataset import ASAPDataset, collate, token_dtype, tsv_encoding
+from .features import FeatureContext, extract_features
+from .pos_tagging import pos_tagger
+from .profiling import profiler
+from .scores import score_scaler
+from .tokenizers import get_tokenizer
+from .vocab import as_vocabulary
+
+logger = logging.getLogger(__name__)
+
+#   row: ordinal of the essay in the stream (after filtering)
+#   x: token indices (numpy, the dtype ASAPDataset.tokens would have)
+#   tags: POS_DICT encoded tags (int8 numpy), None without pos
+#   features: row of the feature matrix, None without features
+StreamedEssay = namedtuple('StreamedEssay', ['row', 'id', 'prompt', 'y', 'x', 'tags', 'features'])
+
+
+class StreamingASAPDataset:
+    def __init__(self, tsv_file, vocab, maxlen=-1, prompt_id=-1, pos=False, features=(), tokenizer='nltk',
+                 chunk_size=1000, shuffle_buffer=10000, score_index=6, model_friendly=True, pos_workers=1,
+                 long_essays='drop', window_size=0, window_stride=0):
+        '''
+            vocab: fixed vocab (see ASAPDataset.create_vocab_from_tsv, which
+                only keeps word counts in memory)
+            long_essays, window_size, window_stride: see ASAPDataset.set_long_essays
+            shuffle_buffer: essays to sample batches from, 0 keeps the file order
+            model_friendly: scores scaled to [0, 1] like make_scores_model_friendly
+        '''
+        self.tsv_file = tsv_file
+        self.vocab = as_vocabulary(vocab)
+        self.maxlen = maxlen
+        self.prompt_id = prompt_id
+        self.pos = pos
+        self.feature_names = list(features)
+        self.chunk_size = chunk_size
+        self.shuffle_buffer = shuffle_buffer
+        self.score_index = score_index
+        self.model_friendly = model_friendly
+        self.pos_workers = pos_workers
+        # Only the tokenizing/encoding helpers of ASAPDataset are used.
+        self._helper = ASAPDataset.__new__(ASAPDataset)
+        self._helper.tokenizer = get_tokenizer(tokenizer)
+        self._helper.set_long_essays(maxlen, long_essays, window_size, window_stride)
+        self.tokenizer = self._helper.tokenizer
+        self.window = self._helper.window
+
+    def _rows(self):
+        '''
+            (id, prompt, score, content) of the essays of the prompt, in file order.
+        '''
+        with open(self.tsv_file, 'r', encoding=tsv_encoding) as f:
+            next(f)  # Header
+            for line in f:
+                tokens = line.strip('\r\n').split('\t')
+                essay_set = int(tokens[1])
+                if essay_set == self.prompt_id or self.prompt_id < 0:
+                    yield int(tokens[0]), essay_set, float(tokens[self.score_index]), tokens[2]
+
+    def _score(self, prompt, score):
+        if not self.model_friendly:
+            return score
+        return float(score_scaler.to_model(score, prompt))
+
+    def mean_score(self):
+        '''
+            Mean (scaled) score, for the initial output bias. Reads the
+            score column only, so the maxlen filter is not applied.
+        '''
+        total, count = 0., 0
+        for _, prompt, score, _ in self._rows():
+            total += self._score(prompt, score)
+            count += 1
+        return total / max(count, 1)
+
+    def _encode_chunk(self, chunk, hits):
+        helper = self._helper
+        encoded, essay_sentences = [], []
+        for essay_id, prompt, score, content in chunk:
+            with profiler.timer('tokenize'):
+                sentences = helper.tokenizer.sentences(content)
+                words = helper._merged_tokens(sentences)
+            indices = helper._fit_length(self.vocab.encode(words, hits), self.maxlen)
+            if indices is None:
+                continue
+            encoded.append((essay_id, prompt, self._score(prompt, score), np.asarray(indices, dtype=token_dtype(self.vocab))))
+            if self.pos:
+                essay_sentences.append(sentences)
+        tags = None
+        if self.pos:
+            tags = helper.tag_essays(essay_sentences, workers=self.pos_workers, log_stats=False)
+            # Truncated essays keep the tags of their tokens only.
+            tags = [tagged[:len(e[3])] for tagged, e in zip(tags, encoded)]
+        features = None
+        if len(self.feature_names) > 0 and len(encoded) > 0:
+            ctx = FeatureContext.from_lists([e[3] for e in encoded], self.vocab, tags=tags)
+            features = extract_features(ctx, self.feature_names)
+        return [(essay_id, prompt, y, indices,
+                 np.asarray(tags[i], dtype=np.int8) if tags is not None else None,
+                 features[i] if features is not None else None)
+                for i, (essay_id, prompt, y, indices) in enumerate(encoded)]
+
+    def essays(self):
+        '''
+            StreamedEssay of every essay, in file order.
+        '''
+        logger.info('Streaming TSV file from ' + self.tsv_file)
+        hits = {'num': 0., 'unk': 0., 'total': 0.}
+        row = 0
+        chunk = []
+        rows = self._rows()
+        while True:
+            chunk.clear()
+            for essay in rows:
+                chunk.append(essay)
+                if len(chunk) >= self.chunk_size:
+                    break
+            if len(chunk) == 0:
+                break
+            for essay in self._encode_chunk(chunk, hits):
+                yield StreamedEssay(row, *essay)
+                row += 1
+        self._helper._log_hits(hits)
+        if self.pos:
+            pos_tagger.log_stats()
+
+    def shuffled(self, seed=None):
+        '''
+            essays() through a shuffle buffer: every essay replaces a
+            random one of the buffer, which is emitted.
+        '''
+        if self.shuffle_buffer <= 0:
+            yield from self.essays()
+            return
+        rng = random.Random(seed)
+        buffer = []
+        for essay in self.essays():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(essay)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = essay
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def batches(self, batch_size, seed=None):
+        '''
+            Batches of shuffled(seed), the same tuples ASAPDataLoader
+            gives, BatchExtras.rows being the essays' rows in the stream.
+        '''
+        batch = []
+        for essay in self.shuffled(seed):
+            batch.append(essay)
+            if len(batch) == batch_size:
+                yield self._collate(batch)
+                batch = []
+        if len(batch) > 0:
+            yield self._collate(batch)
+
+    def _collate(self, batch):
+        with profiler.timer('collate'):
+            lens = np.asarray([len(essay.x) for essay in batch], dtype=np.int64)
+            starts = np.concatenate([[0], np.cumsum(lens)[:-1]])
+            features = None
+            if len(self.feature_names) > 0:
+                features = torch.from_numpy(np.stack([essay.features for essay in batch]))
+            tags = None
+            if self.pos:
+                tags = np.concatenate([essay.tags for essay in batch])
+            return collate(np.concatenate([essay.x for essay in batch]), starts, lens,
+                           [essay.y for essay in batch],
+                           [essay.prompt for essay in batch],
+                           features=features, tags=tags,
+                           rows=np.asarray([essay.row for essay in batch], dtype=np.int64),
+                           window=self.window)
@@ -0,0 +1,136 @@
+'''
+    Generates synthetic essays in the ASAP TSV format.
+    Used by benchmark.py when the real data is not around. Essay lengths
+    follow the per prompt length statistics of the ASAP training set, and
+    scores are correlated with length so models have something to learn.
+'''
+
+# general imports
+import os
+import numpy as np
+
+from .dataset import tsv_encoding, lineneding
+from .scores import score_scaler
+
+ASAP_COLUMNS = [
+    'essay_id', 'essay_set', 'essay',
+    'rater1_domain1', 'rater2_domain1', 'rater3_domain1', 'domain1_score',
+    'rater1_domain2', 'rater2_domain2', 'domain2_score',
+    'rater1_trait1', 'rater1_trait2', 'rater1_trait3', 'rater1_trait4', 'rater1_trait5', 'rater1_trait6',
+    'rater2_trait1', 'rater2_trait2', 'rater2_trait3', 'rater2_trait4', 'rater2_trait5', 'rater2_trait6',
+    'rater3_trait1', 'rater3_trait2', 'rater3_trait3', 'rater3_trait4', 'rater3_trait5', 'rater3_trait6'
+]
+
+# prompt -> (mean, stdev) of essay length in words, from training_set_rel3.tsv
+ASAP_LENGTHS = {
+    1: (366, 120),
+    2: (381, 156),
+    3: (108, 53),
+    4: (94, 51),
+    5: (122, 57),
+    6: (153, 55),
+    7: (171, 86),
+    8: (622, 197)
+}
+
+# Share of the 12976 training essays written for each prompt.
+ASAP_PROMPT_SHARES = {1: 1783, 2: 1800, 3: 1726, 4: 1770, 5: 1805, 6: 1800, 7: 1569, 8: 723}
+
+ENTITIES = ['@PERSON', '@ORGANIZATION', '@LOCATION', '@DATE', '@TIME', '@MONEY', '@PERCENT', '@CAPS', '@NUM', '@CITY', '@STATE']
+
+_ONSETS = ['b', 'c', 'd', 'f', 'g', 'h', 'l', 'm', 'n', 'p', 'r', 's', 't', 'w', 'st', 'br', 'ch', 'th']
+_VOWELS = ['a', 'e', 'i', 'o', 'u', 'ea', 'ou']
+_CODAS = ['', 'n', 'r', 's', 't', 'ng', 'ck', 'll']
+
+
+def make_lexicon(size, rng):
+    words = set()
+    while len(words) < size:
+        n_syllables = rng.randint(1, 4)
+        words.add(''.join(rng.choice(_ONSETS) + rng.choice(_VOWELS) + rng.choice(_CODAS)
+                          for _ in range(n_syllables)))
+    return sorted(words)
+
+
+class SyntheticASAP:
+    def __init__(self, lexicon_size=8000, zipf_exponent=1.1, seed=1234):
+        self.rng = np.random.RandomState(seed)
+        self.lexicon = make_lexicon(lexicon_size, self.rng)
+        ranks = np.arange(1, lexicon_size + 1, dtype=np.float64)
+        self.word_probs = ranks ** -zipf_exponent
+        self.word_probs /= self.word_probs.sum()
+        self.next_id = 1
+
+    def essay(self, n_words):
+        rng = self.rng
+        words = [self.lexicon[i] for i in rng.choice(len(self.lexicon), size=n_words, p=self.word_probs)]
+        pieces = []
+        sentence_left = 0
+        for word in words:
+            if sentence_left == 0:
+                sentence_left = rng.randint(6, 26)
+                word = word.capitalize()
+            draw = rng.rand()
+            if draw < 0.01:
+                word = rng.choice(ENTITIES) + str(rng.randint(1, 4))
+            elif draw < 0.02:
+                word = str(rng.randint(1, 1000))
+            pieces.append(word)
+            sentence_left -= 1
+            if sentence_left == 0:
+                pieces[-1] += rng.choice(['.', '.', '.', '!', '?'])
+            elif rng.rand() < 0.06:
+                pieces[-1] += ','
+        if sentence_left > 0:
+            pieces[-1] += '.'
+        return ' '.join(pieces)
+
+    def rows(self, n_essays, prompts=None):
+        '''
+            Generates n_essays rows (lists of column values) with prompts
+            drawn with the ASAP proportions.
+        '''
+        rng = self.rng
+        if prompts is None:
+            prompts = sorted(ASAP_PROMPT_SHARES.keys())
+        shares = np.array([ASAP_PROMPT_SHARES[p] for p in prompts], dtype=np.float64)
+        drawn = rng.choice(prompts, size=n_essays, p=shares / shares.sum())
+        rows = []
+        for prompt in drawn:
+            essay_id = self.next_id
+            self.next_id += 1
+            prompt = int(prompt)
+            mean, std = ASAP_LENGTHS[prompt]
+            n_words = int(max(10, rng.normal(mean, std)))
+            low, high = score_scaler.range(prompt)
+            # Longer essays score higher, with some noise.
+            quality = np.clip((n_words - mean) / (4. * std) + 0.5 + rng.normal(0, 0.15), 0, 1)
+            score = int(round(low + (high - low) * quality))
+            row = [''] * len(ASAP_COLUMNS)
+            row[0] = str(essay_id)
+            row[1] = str(prompt)
+            row[2] = self.essay(n_words)
+            row[3] = row[4] = row[6] = str(score)
+            rows.append(row)
+        return rows
+
+    def write_tsv(self, filename, n_essays, prompts=None):
+        lines = ['\t'.join(ASAP_COLUMNS)]
+        lines.extend('\t'.join(row) for row in self.rows(n_essays, prompts))
+        with open(filename, 'w', encoding=tsv_encoding) as f:
+            f.write(lineneding.join(lines))
+        return filename
+
+    def write_fold(self, out_dir, n_train, n_dev=None, n_test=None, prompts=None):
+        '''
+            Writes train.tsv, dev.tsv and test.tsv (60-20-20 by default)
+            into out_dir and returns their paths.
+        '''
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        n_dev = n_train // 3 if n_dev is None else n_dev
+        n_test = n_train // 3 if n_test is None else n_test
+        paths = {}
+        for name, n in [('train', n_train), ('dev', n_dev), ('test', n_test)]:
+            paths[name] = self.write_tsv(os.path.join(out_dir, name + '.tsv'), n, prompts)
+        return paths
@@ -0,0 +1,155 @@
+'''
+    Tokenizers for ASAP essays.
+    A tokenizer splits an essay into sentences of tokens, ASAP's
+    anonymization placeholders (@PERSON1, @CAPS3, ...) end up as one
+    token without the number (@PERSON, @CAPS), like the original
+    NLTK + pop() code did.
+        nltk: Punkt sentences + Treebank words (the reference)
+        regex: compiled regexes that mimic the Treebank conventions, several
+               times faster, see the tokenize suite of benchmark.py for the
+               agreement with nltk.
+'''
+
+# general imports
+import re
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_ENTITY_SUFFIX = re.compile('[0-9]+.*')
+
+
+def merge_entities(tokens, tags=None):
+    '''
+        Merges every '@' with the token after it, without the number
+        ('@', 'PERSON1' -> '@PERSON'). The tag of the merged token is the
+        tag of the name. Linear version of popping the '@' while walking
+        the list (the name was skipped, so '@', '@' gives '@@').
+        Returns tokens, tags (None if tags is None)
+    '''
+    if '@' not in tokens:
+        return tokens, tags
+    merged, merged_tags = [], ([] if tags is not None else None)
+    i, n = 0, len(tokens)
+    while i < n:
+        if tokens[i] == '@' and i + 1 < n:
+            merged.append('@' + _ENTITY_SUFFIX.sub('', tokens[i + 1]))
+            if tags is not None:
+                merged_tags.append(tags[i + 1])
+            i += 2
+        else:
+            merged.append(tokens[i])
+            if tags is not None:
+                merged_tags.append(tags[i])
+            i += 1
+    return merged, merged_tags
+
+
+class Tokenizer:
+    name = None
+
+    def sentences(self, text):
+        '''
+            List of sentences, each a list of tokens, before merge_entities
+            (a tagger should see the sentence as is).
+        '''
+        raise NotImplementedError
+
+    def words(self, text):
+        '''
+            Flat list of tokens of text, entities merged.
+        '''
+        return merge_entities([token for sentence in self.sentences(text) for token in sentence])[0]
+
+
+class NLTKTokenizer(Tokenizer):
+    name = 'nltk'
+
+    def sentences(self, text):
+        import nltk
+        return [nltk.word_tokenize(sentence) for sentence in nltk.sent_tokenize(text)]
+
+    def words(self, text):
+        import nltk
+        # Same as before: one word_tokenize over the whole text.
+        return merge_entities(nltk.word_tokenize(text))[0]
+
+
+class RegexTokenizer(Tokenizer):
+    '''
+        Sentences end at [.!?] followed by white space (unless the word
+        before is a common abbreviation), words follow the Treebank
+        conventions: clitics and n't split off, "" turned into `` and '',
+        punctuation split except inside numbers and abbreviations, the
+        period of the last word of a sentence split. @NAME123 becomes
+        @NAME right away.
+    '''
+    name = 'regex'
+
+    ABBREVIATIONS = frozenset(['mr', 'mrs', 'ms', 'dr', 'st', 'jr', 'sr', 'vs', 'prof', 'mt', 'ft', 'no', 'etc',
+                               'e.g', 'i.e', 'a.m', 'p.m', 'u.s', 'jan', 'feb', 'aug', 'sept', 'oct', 'nov', 'dec'])
+    _SENTENCE_END = re.compile(r'''[.!?]+["')\]]*\s+''')
+    _LAST_WORD = re.compile(r'(\S+?)[.!?]+["\')\]]*\s*$')
+    _TOKEN = re.compile(r'''
+          (?P<entity>@[A-Za-z]+)\d\w*                     # @PERSON1 -> @PERSON
+        | (?P<ellipsis>\.\.\.)
+        | (?P<dash>--)
+        | (?P<quote>"|``|'')
+        | (?P<word>[A-Za-z]+(?=n't\b)|n't\b)              # do n't, ca n't
+        | (?P<clitic>'(?:s|m|d|ll|re|ve)\b)
+        | (?P<token>\w+(?:(?:[-./&]|(?<=\d)[,:](?=\d))\w+)*(?:\.(?![.\w]))?)
+        | (?P<other>\S)
+        ''', re.VERBOSE | re.IGNORECASE)
+
+    def split_sentences(self, text):
+        sentences, start = [], 0
+        for match in self._SENTENCE_END.finditer(text):
+            last = self._LAST_WORD.search(text, start, match.end())
+            if last is not None and last.group(1).lower().lstrip('("\'') in self.ABBREVIATIONS:
+                continue
+            sentences.append(text[start:match.end()])
+            start = match.end()
+        if start < len(text) and not text[start:].isspace():
+            sentences.append(text[start:])
+        return sentences
+
+    def tokenize_sentence(self, sentence):
+        tokens = []
+        for match in self._TOKEN.finditer(sentence):
+            kind = match.lastgroup
+            if kind == 'entity':
+                tokens.append(match.group('entity'))
+            elif kind == 'quote':
+                if match.group() == '"':
+                    opening = match.start() == 0 or sentence[match.start() - 1] in ' \t\n([{<'
+                    tokens.append('``' if opening else "''")
+                else:
+                    tokens.append(match.group())
+            else:
+                tokens.append(match.group())
+        # Only the sentence's last period is split off.
+        for i in range(len(tokens) - 1, -1, -1):
+            if tokens[i] in ("''", "'", ')', ']', '}'):
+                continue
+            if len(tokens[i]) > 1 and tokens[i].endswith('.') and not tokens[i].endswith('..'):
+                tokens[i:i + 1] = [tokens[i][:-1], '.']
+            break
+        return tokens
+
+    def sentences(self, text):
+        return [self.tokenize_sentence(sentence) for sentence in self.split_sentences(text)]
+
+
+TOKENIZERS = OrderedDict([
+    (NLTKTokenizer.name, NLTKTokenizer),
+    (RegexTokenizer.name, RegexTokenizer),
+])
+
+
+def get_tokenizer(name='nltk'):
+    if isinstance(name, Tokenizer):
+        return name
+    if name not in TOKENIZERS:
+        raise ValueError('Unknown tokenizer %s, choose from %s' % (name, '|'.join(TOKENIZERS.keys())))
+    return TOKENIZERS[name]()
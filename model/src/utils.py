@@ -41,6 +41,16 @@ def tensordot(x, y):
     return x.contiguous().view(-1, common_dim).mm(y.view(common_dim, -1)).view(outshape)
 
 
+def packed_batch_index(batch_sizes):
+    '''
+        batch_sizes: LongTensor from a PackedSequence
+        Returns the (sorted) batch index of every row of PackedSequence.data
+        Time step t holds rows for batch elements 0 .. batch_sizes[t]-1.
+    '''
+    starts = torch.cumsum(batch_sizes, 0) - batch_sizes
+    return torch.arange(int(batch_sizes.sum())) - torch.repeat_interleave(starts, batch_sizes)
+
+
 def set_logger(out_dir=None):
     console_format = BColors.OKBLUE + '[%(levelname)s]' + BColors.ENDC + ' (%(name)s) %(message)s'
     # datefmt='%Y-%m-%d %Hh-%Mm-%Ss'
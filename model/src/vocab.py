@@ -0,0 +1,142 @@
+'''
+    The word -> index mapping essays are encoded with.
+    Vocabulary reads like the dict the code has always passed around
+    (vocab[word], word in vocab, len, items), and encodes whole token
+    lists at once: every distinct word is classified (<num>, known or
+    <unk>) once and its index cached. Vocabularies are saved as text, a
+    word per line in index order; pickled dicts still load.
+'''
+
+# general imports
+import re
+import pickle
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Exactly the strings float() accepts, which is what decided <num> so far
+# (nan, inf, 1e5, 1_000 and unicode digits included).
+_DIGITS = r'\d(?:_?\d)*'
+num_regex = re.compile(r'\s*[+-]?(?:(?:{d}(?:\.(?:{d})?)?|\.{d})(?:[eE][+-]?{d})?|inf(?:inity)?|nan)\s*\Z'.format(d=_DIGITS),
+                       re.IGNORECASE)
+
+RESERVED = ('<pad>', '<unk>', '<num>')
+_MAGIC = '#vocab 1'
+
+
+class Vocabulary:
+    def __init__(self, words=RESERVED, max_cache=1000000):
+        '''
+            words: the words, in index order (starting with RESERVED)
+            max_cache: distinct words whose index is cached at most
+        '''
+        self.words = list(words)
+        self.index = {word: i for i, word in enumerate(self.words)}
+        if len(self.index) != len(self.words):
+            raise ValueError('Duplicate words in the vocabulary')
+        self.max_cache = max_cache
+        self._cache = {}
+
+    @classmethod
+    def from_dict(cls, vocab):
+        '''
+            Vocabulary of a word -> index dict (indices 0..len-1).
+        '''
+        words = sorted(vocab, key=vocab.get)
+        if [vocab[word] for word in words] != list(range(len(words))):
+            raise ValueError('Vocabulary indices must be 0..%d' % (len(words) - 1))
+        return cls(words)
+
+    def __getstate__(self):
+        # Models keep their vocab, only the words go in checkpoints.
+        return {'words': self.words, 'max_cache': self.max_cache}
+
+    def __setstate__(self, state):
+        self.__init__(state['words'], state.get('max_cache', 1000000))
+
+    # dict interface
+    def __getitem__(self, word):
+        return self.index[word]
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def get(self, word, default=None):
+        return self.index.get(word, default)
+
+    def keys(self):
+        return self.index.keys()
+
+    def values(self):
+        return self.index.values()
+
+    def items(self):
+        return self.index.items()
+
+    def lookup(self, word):
+        '''
+            Index word is encoded with: <num> for numbers (even the ones
+            in the vocabulary), its own index, or <unk>.
+        '''
+        if num_regex.match(word):
+            return self.index['<num>']
+        return self.index.get(word, self.index['<unk>'])
+
+    def encode(self, words, hits=None):
+        '''
+            words: list of tokens
+            hits: (optional) dict whose 'num', 'unk' and 'total' counts
+                are incremented
+            Returns an int32 array of indices.
+        '''
+        cache = self._cache
+        indices = [cache.get(word) for word in words]
+        if None in indices:
+            for i, index in enumerate(indices):
+                if index is None:
+                    index = indices[i] = self.lookup(words[i])
+                    if len(cache) < self.max_cache:
+                        cache[words[i]] = index
+        indices = np.array(indices, dtype=np.int32)
+        if hits is not None:
+            hits['num'] += int(np.count_nonzero(indices == self.index['<num>']))
+            hits['unk'] += int(np.count_nonzero(indices == self.index['<unk>']))
+            hits['total'] += len(indices)
+        return indices
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(_MAGIC + '\n')
+            for word in self.words:
+                f.write(word + '\n')
+
+    @classmethod
+    def load(cls, path):
+        '''
+            Reads a vocabulary written by save(), or a pickled dict (what
+            the scripts wrote before).
+        '''
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC.encode():
+                f.seek(0)
+                logger.info('  %s is a pickled vocab' % path)
+                return as_vocabulary(pickle.load(f))
+        with open(path, 'r', encoding='utf-8', newline='\n') as f:
+            next(f)  # Header
+            return cls([line[:-1] for line in f])
+
+
+def as_vocabulary(vocab):
+    '''
+        vocab as a Vocabulary (dicts are converted).
+    '''
+    if isinstance(vocab, Vocabulary):
+        return vocab
+    return Vocabulary.from_dict(vocab)
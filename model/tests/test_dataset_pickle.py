@@ -0,0 +1,92 @@
+'''
+    Datasets pickled by the original ASAPDataset (--compressed_datasets)
+    still load: x lists, tags_x one hots, unique_x/punct_x and no pos,
+    features, tokenizer or pos_workers attributes.
+'''
+
+import os
+import sys
+import pickle
+import unittest
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.dataset import ASAPDataset, pos_dim  # noqa: E402
+
+VOCAB = {'<pad>': 0, '<unk>': 1, '<num>': 2, 'the': 3, 'cat': 4, '.': 5}
+X = [[3, 4, 5], [3, 1, 4, 4, 5], [2, 5]]
+
+
+def baseline_state(pos=False):
+    '''
+        __dict__ of an original ASAPDataset after prepare_features(pos).
+    '''
+    maxlen_x = max(len(e) for e in X)
+    if pos:
+        tags_x = torch.zeros(len(X), maxlen_x, pos_dim())
+        for i, e in enumerate(X):
+            for j in range(len(e)):
+                tags_x[i, j, (i + j) % pos_dim()] = 1
+    else:
+        tags_x = np.array([])
+    return {
+        'tsv_file': 'train.tsv',
+        'prompt_id': -1,
+        'vocab': dict(VOCAB),
+        'ids': [10, 11, 12],
+        'x': [list(e) for e in X],
+        'y': [2., 3., 4.],
+        'prompts': [1, 1, 2],
+        'maxlen': maxlen_x,
+        'maxlen_x': maxlen_x,
+        'maxlen_x_id': 11,
+        'unique_x': torch.tensor([[1.], [0.8], [1.]]),
+        'punct_x': torch.tensor([[1.], [1.], [1.]]),
+        'tags_x': tags_x,
+    }
+
+
+def unpickle(state):
+    dataset = ASAPDataset.__new__(ASAPDataset)
+    dataset.__dict__.update(state)
+    return pickle.loads(pickle.dumps(dataset))
+
+
+class BaselinePickleTest(unittest.TestCase):
+    def test_essays(self):
+        dataset = unpickle(baseline_state())
+        self.assertEqual(len(dataset), 3)
+        self.assertEqual([e.tolist() for e in dataset.x], X)
+        self.assertEqual(dataset.ids.tolist(), [10, 11, 12])
+        self.assertFalse(dataset.pos)
+        self.assertIsNone(dataset.tags)
+        self.assertEqual(dataset.tokenizer.name, 'nltk')
+        self.assertFalse(hasattr(dataset, 'unique_x'))
+
+    def test_features(self):
+        dataset = unpickle(baseline_state())
+        self.assertEqual(dataset.feature_names, ['variety', 'punct'])
+        self.assertTrue(np.allclose(dataset.features[:, 0].numpy(), [1., 0.8, 1.]))
+        dataset.use_features(['punct'])
+        self.assertEqual(dataset.feature_names, ['punct'])
+        self.assertEqual(dataset.features.shape, (3, 1))
+        dataset.use_features([])
+        self.assertIsNone(dataset.features)
+
+    def test_pos(self):
+        dataset = unpickle(baseline_state(pos=True))
+        self.assertTrue(dataset.pos)
+        self.assertEqual(dataset.tags.tolist(), [(i + j) % pos_dim() for i, e in enumerate(X) for j in range(len(e))])
+
+    def test_batches(self):
+        dataset = unpickle(baseline_state(pos=True))
+        xs, ys, ps, mask, lens, extras = dataset.collate(np.arange(len(dataset)))
+        self.assertEqual(lens.tolist(), [5, 3, 2])
+        self.assertEqual(extras.features.shape, (3, 2))
+        self.assertEqual(extras.pos.shape[:2], (3, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+'''
+    merge_entities against the original NLTK + pop() loop, and the
+    Treebank conventions RegexTokenizer has to follow to stand in for
+    nltk.word_tokenize.
+'''
+
+import os
+import re
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.tokenizers import RegexTokenizer, merge_entities  # noqa: E402
+
+
+def pop_loop(tokens, tags=None):
+    '''
+        The original ASAPDataset._tokenize loop, on copies.
+    '''
+    tokens = list(tokens)
+    tags = list(tags) if tags is not None else None
+    for index, token in enumerate(tokens):
+        if token == '@' and (index+1) < len(tokens):
+            tokens[index+1] = '@' + re.sub('[0-9]+.*', '', tokens[index+1])
+            tokens.pop(index)
+            if tags is not None:
+                tags.pop(index)
+    return tokens, tags
+
+
+class MergeEntitiesTest(unittest.TestCase):
+    CASES = [
+        [],
+        ['no', 'entity', '.'],
+        ['@', 'PERSON1', 'went', 'to', '@', 'LOCATION2', '.'],
+        ['@', 'CAPS3', "'s", 'dog'],
+        ['@', '@', 'PERSON1'],
+        ['@', '@', '@'],
+        ['hi', '@'],
+        ['@'],
+        ['@', 'NUM1.5', 'and', '@', '12'],
+    ]
+
+    def check(self, tokens):
+        tags = ['T%d' % i for i in range(len(tokens))]
+        self.assertEqual(merge_entities(tokens), (pop_loop(tokens)[0], None), tokens)
+        self.assertEqual(merge_entities(tokens, tags), pop_loop(tokens, tags), tokens)
+
+    def test_cases(self):
+        for tokens in self.CASES:
+            self.check(tokens)
+
+    def test_double_at(self):
+        self.assertEqual(merge_entities(['@', '@', 'PERSON1'])[0], ['@@', 'PERSON1'])
+
+    def test_random(self):
+        rng = random.Random(0)
+        words = ['@', '@', 'PERSON1', 'CAPS12', 'the', '.', '7']
+        for _ in range(2000):
+            self.check([rng.choice(words) for _ in range(rng.randint(0, 8))])
+
+
+class RegexTokenizerTest(unittest.TestCase):
+    # text -> nltk.word_tokenize(text) with merge_entities
+    CASES = [
+        ("I can't go.", ['I', 'ca', "n't", 'go', '.']),
+        ("Don't do that", ['Do', "n't", 'do', 'that']),
+        ("He's sure I'm late, we'll see if they'd wait or you've left and they're gone",
+         ['He', "'s", 'sure', 'I', "'m", 'late', ',', 'we', "'ll", 'see', 'if', 'they', "'d", 'wait', 'or',
+          'you', "'ve", 'left', 'and', 'they', "'re", 'gone']),
+        ('"Hello," she said.', ['``', 'Hello', ',', "''", 'she', 'said', '.']),
+        ("``Hello'' is a word", ['``', 'Hello', "''", 'is', 'a', 'word']),
+        ('The end.', ['The', 'end', '.']),
+        ('I went to the U.S. last year', ['I', 'went', 'to', 'the', 'U.S.', 'last', 'year']),
+        ('I live in the U.S.', ['I', 'live', 'in', 'the', 'U.S', '.']),
+        ('It costs 1,000 dollars', ['It', 'costs', '1,000', 'dollars']),
+        ("@PERSON1's dog barked", ['@PERSON', "'s", 'dog', 'barked']),
+        ('Ask @CAPS2 and @PERSON1.', ['Ask', '@CAPS', 'and', '@PERSON', '.']),
+    ]
+
+    def test_words(self):
+        tokenizer = RegexTokenizer()
+        for text, expected in self.CASES:
+            self.assertEqual(tokenizer.words(text), expected, text)
+
+    def test_sentences(self):
+        tokenizer = RegexTokenizer()
+        self.assertEqual(tokenizer.sentences('Mr. Smith left. He was late! Was he?'),
+                         [['Mr.', 'Smith', 'left', '.'], ['He', 'was', 'late', '!'], ['Was', 'he', '?']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 
 import os
 import argparse
+import contextlib
 import logging
 import numpy as np
 import scipy
@@ -18,9 +19,21 @@ import torch.optim as optim
 from torch.autograd import Variable
 from torch.distributions import Bernoulli
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.parallel import DistributedDataParallel
 # User imports
-from src.model import Model, EnsembleModel
-from src.dataset import ASAPDataset, ASAPDataLoader
+from src.model import Model, EnsembleModel, vote
+from src.dataset import ASAPDataset, ASAPDataLoader, LONG_ESSAYS, long_essays_from_args
+from src.corpus import ASAPCorpus
+from src.streaming import StreamingASAPDataset
+from src.tokenizers import get_tokenizer
+from src.vocab import Vocabulary, as_vocabulary
+from src.features import FEATURES, features_from_args
+from src.profiling import profiler, trace_profiler
+from src.metrics import MetricsLogger
+from src.evaluation import load_model, predict, prompt_qwks, set_cuda_flag
+from src.prediction_cache import PredictionCache
+from src.precision import bf16_autocast, finite
+import src.distributed as D
 import src.utils as U
 from tensorboard_logger import configure, log_value
 
@@ -33,9 +46,14 @@ parser.add_argument('--compressed_datasets', type=str, default='', help='pkl fil
 parser.add_argument('--nm', type=str, default='new', help='Name to save logs')
 parser.add_argument("--ensembles", dest="ensemble_models", type=str, nargs='+', metavar='<str>', default=None, help="List of torch.save models to use in ensemble")
 parser.add_argument("--ensemble-method", dest="ensemble_method", type=str, metavar='<str>', default='mean', help="Method to ensemble (default=mean)")
-parser.add_argument("-tr", "--train", dest="train_path", type=str, metavar='<str>', required=True, help="The path to the training set")
-parser.add_argument("-tu", "--tune", dest="dev_path", type=str, metavar='<str>', required=True, help="The path to the development set")
-parser.add_argument("-ts", "--test", dest="test_path", type=str, metavar='<str>', required=True, help="The path to the test set")
+parser.add_argument("-tr", "--train", dest="train_path", type=str, metavar='<str>', help="The path to the training set (required without --corpus)")
+parser.add_argument("-tu", "--tune", dest="dev_path", type=str, metavar='<str>', help="The path to the development set (required without --corpus)")
+parser.add_argument("-ts", "--test", dest="test_path", type=str, metavar='<str>', help="The path to the test set (required without --corpus)")
+parser.add_argument("--corpus", dest="corpus", type=str, metavar='<str>', default=None, help="(Optional) Corpus from build_corpus.py to take the --fold splits from, instead of -tr/-tu/-ts")
+parser.add_argument("--fold", dest="fold", type=int, metavar='<int>', default=0, help="Fold of --corpus to train on (default=0)")
+parser.add_argument("--stream", dest="stream", action='store_true', help="Stream the training set from -tr in chunks instead of loading it (for training files larger than memory)")
+parser.add_argument("--stream-chunk", dest="stream_chunk", type=int, metavar='<int>', default=1000, help="Essays read and encoded at a time with --stream (default=1000)")
+parser.add_argument("--shuffle-buffer", dest="shuffle_buffer", type=int, metavar='<int>', default=10000, help="Essays batches are sampled from with --stream, 0 keeps the file order (default=10000)")
 parser.add_argument("-o", "--out-dir", dest="out_dir_path", type=str, metavar='<str>', required=True, help="The path to the output directory")
 parser.add_argument("-p", "--prompt", dest="prompt_id", type=int, metavar='<int>', required=False, help="Promp ID for ASAP dataset. '0' means all prompts.")
 parser.add_argument("-t", "--type", dest="model_type", type=str, metavar='<str>', default='regp', help="Model type (reg|regp|breg|bregp) (default=regp)")
@@ -55,71 +73,118 @@ parser.add_argument("--skip-init-bias", dest="skip_init_bias", action='store_tru
 parser.add_argument("--emb", dest="emb_path", type=str, metavar='<str>', help="The path to the word embeddings file (Word2Vec format)")
 parser.add_argument("--epochs", dest="epochs", type=int, metavar='<int>', default=50, help="Number of epochs (default=50)")
 parser.add_argument("--maxlen", dest="maxlen", type=int, metavar='<int>', default=5000, help="Maximum allowed number of words during training. '0' means no limit (default=0)")
+parser.add_argument("--long-essays", dest="long_essays", type=str, metavar='<str>', default='drop', choices=LONG_ESSAYS, help="What to do with essays over --maxlen words: drop them, truncate them, or split them into overlapping windows whose outputs are averaged (drop|truncate|window) (default=drop)")
+parser.add_argument("--window-size", dest="window_size", type=int, metavar='<int>', default=0, help="Words per window with --long-essays window. '0' means --maxlen (default=0)")
+parser.add_argument("--window-stride", dest="window_stride", type=int, metavar='<int>', default=0, help="Words between window starts with --long-essays window. '0' means half a window (default=0)")
 parser.add_argument("--seed", dest="seed", type=int, metavar='<int>', default=1234, help="Random seed (default=1234)")
 parser.add_argument("--clip_norm", dest="clip_norm", type=float, metavar='<float>', default=10.0, help="Threshold to clip gradients")
 parser.add_argument("--pos", dest="pos", action='store_true', help="Use part of speech tagging in the training")
 parser.add_argument("--variety", dest="variety", action='store_true', help="Variety of words in output layer")
 parser.add_argument("--punct-count", dest="punct", action='store_true', help="Variety of words in output layer")
+parser.add_argument("--features", dest="features", type=str, nargs='*', metavar='<str>', default=[], help="Essay level features fed to the output layer (%s)" % '|'.join(FEATURES.keys()))
+parser.add_argument("--pos-workers", dest="pos_workers", type=int, metavar='<int>', default=1, help="Processes for POS tagging with --pos (default=1)")
+parser.add_argument("--tokenizer", dest="tokenizer", type=str, metavar='<str>', default='nltk', help="Tokenizer backend (nltk|regex), must match the one used in training (default=nltk)")
 parser.add_argument('--cuda', dest='cuda', action='store_true', help='provide if you want to try using cuda')
-args = parser.parse_args()
-
-args.cuda = args.cuda and torch.cuda.is_available()
-
-out_dir = args.out_dir_path.strip('\r\n')
-model_save = os.path.join(out_dir,
-                          'models/modelbgrepproper.pt')
-
-U.mkdir_p(out_dir + '/preds')
-U.mkdir_p(out_dir + '/models/')
-U.mkdir_p(out_dir + '/logs/')
-
-configure(os.path.join(out_dir,
-                       'logs/'+args.nm),
-          flush_secs=5)
-
-U.set_logger(out_dir)
-U.print_args(args)
+parser.add_argument('--bf16', dest='bf16', action='store_true', help='Train (and evaluate) in bfloat16 mixed precision with CPU autocast, the weights stay float32. Steps with non finite gradients are skipped')
+parser.add_argument('--log-every', dest='log_every', type=int, metavar='<int>', default=50, help='Flush buffered training metrics every this many batches (default=50)')
+parser.add_argument('--log-secs', dest='log_secs', type=float, metavar='<float>', default=10.0, help='... or every this many seconds (default=10)')
+parser.add_argument('--profile', dest='profile', action='store_true', help='Time data loading/forward/backward/optimizer phases and log a per epoch breakdown')
+parser.add_argument('--profile-trace', dest='profile_trace', action='store_true', help='Also record a torch.profiler trace of the first few batches into the log directory')
+parser.add_argument('--workers', dest='workers', type=int, metavar='<int>', default=1, help='Number of local CPU processes for distributed data parallel training (gloo). 1 means a single process (default=1)')
+parser.add_argument('--dist-port', dest='dist_port', type=int, metavar='<int>', default=29500, help='Port used to set up the process group with --workers (default=29500)')
+parser.add_argument('--distill-from', dest='distill_from', type=str, nargs='+', metavar='<str>', default=None, help='torch.save models of a teacher ensemble (voting with --ensemble-method) to distill into the model being trained')
+parser.add_argument('--prediction-cache', dest='prediction_cache', type=str, metavar='<str>', default=None, help='(Optional) Prediction cache directory for the --distill-from teachers')
+parser.add_argument('--distill-alpha', dest='distill_alpha', type=float, metavar='<float>', default=1.0, help='Weight of the teacher (soft) targets in the loss, the gold scores get the rest (default=1.0)')
 
 DEFAULT_COMPRESSED_DATASET = 'datasets-pickled.pkl'
 
 
-np.random.seed(args.seed)
-torch.manual_seed(args.seed)
-torch.cuda.manual_seed_all(args.seed)
-
-if args.compressed_datasets == '':
-    # train
-    train_dataset = ASAPDataset(args.train_path, maxlen=args.maxlen, vocab_size=args.vocab_size, vocab_file=out_dir + '/vocab.pkl', pos=args.pos, read_vocab=(args.vocab_path is not None))
-    vocab = train_dataset.vocab
-    train_dataset.make_scores_model_friendly()
-    # test
-    test_dataset = ASAPDataset(args.test_path, maxlen=args.maxlen, vocab=vocab, pos=args.pos)
-    test_dataset.make_scores_model_friendly()
-    # dev
-    dev_dataset = ASAPDataset(args.dev_path, maxlen=args.maxlen, vocab=vocab, pos=args.pos)
-    dev_dataset.make_scores_model_friendly()
-
-    max_seq_length = max(train_dataset.maxlen,
-                         test_dataset.maxlen,
-                         dev_dataset.maxlen)
-    # Dump it!
-    print('Dumping to', DEFAULT_COMPRESSED_DATASET)
-    with open(DEFAULT_COMPRESSED_DATASET, 'wb') as f:
-        stuff = {}
-        stuff['train'] = train_dataset
-        stuff['vocab'] = vocab
-        stuff['test'] = test_dataset
-        stuff['dev'] = dev_dataset
-        stuff['msl'] = max_seq_length
-        pk.dump(stuff, f)
-else:
-    with open(args.compressed_datasets, 'rb') as f:
-        stuff = pk.load(f)
-        train_dataset = stuff['train']
-        vocab = stuff['vocab']
-        test_dataset = stuff['test']
-        dev_dataset = stuff['dev']
-        max_seq_length = stuff['msl']
+def load_datasets(args, out_dir):
+    if args.stream:
+        if args.vocab_path is not None:
+            vocab = Vocabulary.load(args.vocab_path)
+        else:
+            # One pass over the file, only the word counts are kept.
+            helper = ASAPDataset.__new__(ASAPDataset)
+            helper.tokenizer = get_tokenizer(args.tokenizer)
+            logger.info('Loading vocab from ' + args.train_path)
+            vocab = helper.create_vocab_from_tsv(args.train_path, vocab_size=args.vocab_size)
+        vocab.save(out_dir + '/vocab.pkl')
+        # train
+        train_dataset = StreamingASAPDataset(args.train_path, vocab, maxlen=args.maxlen, pos=args.pos, features=args.features, tokenizer=args.tokenizer,
+                                             chunk_size=args.stream_chunk, shuffle_buffer=args.shuffle_buffer, pos_workers=args.pos_workers, **long_essays_from_args(args))
+        # test
+        test_dataset = ASAPDataset(args.test_path, maxlen=args.maxlen, vocab=vocab, pos=args.pos, features=args.features, tokenizer=args.tokenizer, pos_workers=args.pos_workers, **long_essays_from_args(args))
+        test_dataset.make_scores_model_friendly()
+        # dev
+        dev_dataset = ASAPDataset(args.dev_path, maxlen=args.maxlen, vocab=vocab, pos=args.pos, features=args.features, tokenizer=args.tokenizer, pos_workers=args.pos_workers, **long_essays_from_args(args))
+        dev_dataset.make_scores_model_friendly()
+        max_seq_length = max(args.maxlen,
+                             test_dataset.maxlen,
+                             dev_dataset.maxlen)
+    elif args.compressed_datasets == '' and args.corpus is not None:
+        corpus = ASAPCorpus.load(args.corpus)
+        if corpus.tokenizer_name != get_tokenizer(args.tokenizer).name:
+            raise RuntimeError('%s was tokenized with %s, not --tokenizer %s' % (args.corpus, corpus.tokenizer_name, args.tokenizer))
+        vocab = None
+        if args.vocab_path is not None:
+            vocab = Vocabulary.load(args.vocab_path)
+        # train
+        train_dataset = corpus.dataset(args.fold, 'train', vocab=vocab, vocab_size=args.vocab_size, maxlen=args.maxlen, pos=args.pos, features=args.features, **long_essays_from_args(args))
+        vocab = train_dataset.vocab
+        vocab.save(out_dir + '/vocab.pkl')
+        train_dataset.make_scores_model_friendly()
+        # test
+        test_dataset = corpus.dataset(args.fold, 'test', vocab=vocab, maxlen=args.maxlen, pos=args.pos, features=args.features, **long_essays_from_args(args))
+        test_dataset.make_scores_model_friendly()
+        # dev
+        dev_dataset = corpus.dataset(args.fold, 'dev', vocab=vocab, maxlen=args.maxlen, pos=args.pos, features=args.features, **long_essays_from_args(args))
+        dev_dataset.make_scores_model_friendly()
+        max_seq_length = max(train_dataset.maxlen,
+                             test_dataset.maxlen,
+                             dev_dataset.maxlen)
+    elif args.compressed_datasets == '':
+        vocab = None
+        if args.vocab_path is not None:
+            vocab = Vocabulary.load(args.vocab_path)
+        # train
+        train_dataset = ASAPDataset(args.train_path, maxlen=args.maxlen, vocab_size=args.vocab_size, vocab=vocab, pos=args.pos, features=args.features, tokenizer=args.tokenizer, pos_workers=args.pos_workers, **long_essays_from_args(args))
+        vocab = train_dataset.vocab
+        vocab.save(out_dir + '/vocab.pkl')
+        train_dataset.make_scores_model_friendly()
+        # test
+        test_dataset = ASAPDataset(args.test_path, maxlen=args.maxlen, vocab=vocab, pos=args.pos, features=args.features, tokenizer=args.tokenizer, pos_workers=args.pos_workers, **long_essays_from_args(args))
+        test_dataset.make_scores_model_friendly()
+        # dev
+        dev_dataset = ASAPDataset(args.dev_path, maxlen=args.maxlen, vocab=vocab, pos=args.pos, features=args.features, tokenizer=args.tokenizer, pos_workers=args.pos_workers, **long_essays_from_args(args))
+        dev_dataset.make_scores_model_friendly()
+
+        max_seq_length = max(train_dataset.maxlen,
+                             test_dataset.maxlen,
+                             dev_dataset.maxlen)
+        # Dump it!
+        print('Dumping to', DEFAULT_COMPRESSED_DATASET)
+        with open(DEFAULT_COMPRESSED_DATASET, 'wb') as f:
+            stuff = {}
+            stuff['train'] = train_dataset
+            stuff['vocab'] = vocab
+            stuff['test'] = test_dataset
+            stuff['dev'] = dev_dataset
+            stuff['msl'] = max_seq_length
+            pk.dump(stuff, f)
+        profiler.report(0, prefix='preprocess/')
+    else:
+        with open(args.compressed_datasets, 'rb') as f:
+            stuff = pk.load(f)
+            train_dataset = stuff['train']
+            vocab = stuff['vocab']
+            test_dataset = stuff['test']
+            dev_dataset = stuff['dev']
+            max_seq_length = stuff['msl']
+        # Older pickles carry other (or no) features than asked for.
+        for dataset in (train_dataset, test_dataset, dev_dataset):
+            dataset.use_features(args.features)
+    return train_dataset, vocab, test_dataset, dev_dataset, max_seq_length
 
 
 def mean0(ls):
@@ -144,65 +209,269 @@ def mean0(ls):
     return mean
 
 
-imv = mean0(train_dataset.y)
-if args.ensemble_models is None:
-    model = Model(args, vocab, imv)
-else:
-    model_name = args.ensemble_models
-    model = EnsembleModel(model_name, args.ensemble_method)
-if args.cuda:
-    model.cuda()
-    model = torch.nn.DataParallel(model)
-    print('Model is on GPU')
-torch.save(model, model_save)
-optimizable_parameters = model.parameters()
-loss_fn = F.mse_loss if args.loss == 'mse' else F.l1_loss
-optimizer = U.get_optimizer(args, optimizable_parameters)
-
-lcount = 0
-model.train()
-for epoch in range(args.epochs):
-    losses = []
-    batch_idx = -1
-    # pdb.set_trace()
-    loader = ASAPDataLoader(train_dataset, train_dataset.maxlen, args.batch_size)
-    for xs, ys, ps, padding_mask, lens, (lhs, rhs) in loader:
-        batch_idx += 1
-        print('Starting batch %d' % batch_idx)
-        if args.pos:
-            indexes = train_dataset.tags_x[lhs:rhs]
-        else:
-            indexes = None
-        if args.variety:
-            variety = train_dataset.unique_x[lhs:rhs]
-        else:
-            variety = None
-        if args.punct:
-            punct = train_dataset.punct_x[lhs:rhs]
-        else:
-            punct = None
-        if args.cuda:
-            ys = ys.cuda()
-        youts = model(xs,
-                      mask=padding_mask,
-                      lens=lens,
-                      pos=indexes,
-                      variety=variety,
-                      punct=punct)
-        loss = 0
-        loss = loss_fn(youts, ys)
-        losses.append(loss.data[0])
-        optimizer.zero_grad()
-        loss.backward()
-        torch.nn.utils.clip_grad_norm(optimizable_parameters, args.clip_norm)
-        optimizer.step()
-        print('\tloss=%f' % (losses[-1]))
-        # logger.info(
-        #     'Epoch=%d batch=%d loss=%f' % (epoch, batch_idx, losses[-1])
-        #     )
-        log_value('loss', loss.data[0], lcount)
-        lcount += 1
-    torch.save(model, model_save[:-3]+'.' + str(epoch)+'.pt')
-    log_value('epoch_loss', sum(losses), epoch)
-    print('Epoch %d: average loss=%f' % (epoch, sum(losses) / len(losses)))
-torch.save(model, model_save)
+def build_model(args, vocab, imv):
+    if args.ensemble_models is None:
+        model = Model(args, vocab, imv)
+    else:
+        model_name = args.ensemble_models
+        model = EnsembleModel(model_name, args.ensemble_method)
+    if args.cuda:
+        model.cuda()
+        model = torch.nn.DataParallel(model)
+        print('Model is on GPU')
+    return model
+
+
+def load_teacher(args, vocab):
+    teacher = EnsembleModel(args.distill_from, args.ensemble_method)
+    check_teacher(args, teacher, vocab)
+    if args.cuda:
+        teacher.cuda()
+    set_cuda_flag(teacher, args.cuda)
+    teacher.eval()
+    return teacher
+
+
+def check_teacher(args, teacher, vocab):
+    '''
+        The members score the student's training set, encoded with the
+        student's vocab, tokenizer, --pos and --features: they must be the
+        ones every member was trained with.
+    '''
+    words = as_vocabulary(vocab).words
+    for path, member in zip(args.distill_from, teacher.models):
+        mismatches = []
+        if as_vocabulary(member.vocab).words != words:
+            mismatches.append('vocab')
+        if getattr(member.args, 'tokenizer', 'nltk') != args.tokenizer:
+            mismatches.append('--tokenizer')
+        if bool(member.args.pos) != bool(args.pos):
+            mismatches.append('--pos')
+        if list(getattr(member.args, 'features', [])) != list(args.features):
+            mismatches.append('--features')
+        if len(mismatches) > 0:
+            raise RuntimeError('Teacher %s was trained with another %s than the student, its soft targets would be wrong'
+                               % (path, ', '.join(mismatches)))
+
+
+def teacher_predictions(args, out_dir, teacher, train_dataset):
+    '''
+        Teacher outputs for every training essay, computed once (in
+        dataset order) and saved next to the models.
+        With --prediction-cache, members that already scored this training
+        set are not run again and their cached outputs are voted here.
+    '''
+    start = time()
+    if args.prediction_cache is not None:
+        cache = PredictionCache(args.prediction_cache)
+        member_preds = [cache.predictions(path, train_dataset, args.batch_size, cuda=args.cuda) for path in args.distill_from]
+        preds = vote(torch.from_numpy(np.stack(member_preds, axis=1)), args.ensemble_method).view(-1).numpy()
+    else:
+        preds = predict(teacher, train_dataset, args.batch_size, cuda=args.cuda, bf16=args.bf16)
+    np.save(os.path.join(out_dir, 'preds/teacher_train.npy'), preds)
+    logger.info('Teacher predictions for %d training essays in %.1fs' % (len(preds), time() - start))
+    return preds
+
+
+def distillation_report(args, model_path, teacher, test_dataset):
+    '''
+        Student vs teacher on the test set. test_dataset scores must be
+        dataset friendly.
+    '''
+    student = load_model(model_path, cuda=args.cuda)
+    results = {}
+    for name, model in [('teacher', teacher), ('student', student)]:
+        predict(model, test_dataset, args.batch_size, cuda=args.cuda, bf16=args.bf16)  # Warm up.
+        timings = []
+        preds = predict(model, test_dataset, args.batch_size, cuda=args.cuda, timings=timings, bf16=args.bf16)
+        results[name] = (preds, len(test_dataset) / sum(timings))
+    for name, (preds, speed) in results.items():
+        # test_dataset has every prompt of the test file, QWK is per prompt.
+        qwks = prompt_qwks(preds, test_dataset)
+        logger.info('%s: mean test QWK %.4f (%s), %.1f essays/sec' % (
+            name, np.mean(list(qwks.values())), ', '.join('prompt %d: %.4f' % item for item in qwks.items()), speed))
+    logger.info('Student speedup x%.2f, mean |student - teacher| %.4f' % (
+        results['student'][1] / results['teacher'][1],
+        np.abs(results['student'][0] - results['teacher'][0]).mean()))
+
+
+def train(rank, world_size, args, out_dir, train_dataset, vocab, teacher_preds=None):
+    '''
+        Training loop. With world_size > 1 this runs in each of the
+        world_size processes, on rank's shard of train_dataset.
+        teacher_preds: (optional) teacher outputs per training essay,
+            trained towards with weight args.distill_alpha.
+    '''
+    distributed = world_size > 1
+    main_process = rank == 0
+    if distributed:
+        D.setup(rank, world_size, args.dist_port)
+        if main_process:
+            U.set_logger()
+    if args.profile or args.profile_trace:
+        profiler.enable(synchronize=args.cuda, record_functions=args.profile_trace)
+    model_save = os.path.join(out_dir,
+                              'models/modelbgrepproper.pt')
+    if main_process:
+        configure(os.path.join(out_dir,
+                               'logs/'+args.nm),
+                  flush_secs=5)
+
+    # Same initial weights in every process.
+    torch.manual_seed(args.seed)
+    if args.stream:
+        imv = [train_dataset.mean_score()]
+    else:
+        imv = mean0(train_dataset.y)
+    model = build_model(args, vocab, imv)
+    to_save = model
+    if distributed:
+        model = DistributedDataParallel(model)
+    if main_process:
+        torch.save(to_save, model_save)
+    optimizable_parameters = list(model.parameters())
+    loss_fn = F.mse_loss if args.loss == 'mse' else F.l1_loss
+    optimizer = U.get_optimizer(args, optimizable_parameters)
+
+    lcount = 0
+    metrics = MetricsLogger(log_value if main_process else (lambda name, value, step: None),
+                            flush_steps=args.log_every, flush_secs=args.log_secs)
+    model.train()
+    if args.profile_trace and main_process:
+        trace = trace_profiler(os.path.join(out_dir, 'logs/' + args.nm + '/trace'))
+    else:
+        trace = contextlib.nullcontext()
+    profiler.reset()
+    with trace:
+        for epoch in range(args.epochs):
+            epoch_start = time()
+            epoch_loss = 0.
+            epoch_essays = 0
+            skipped_steps = 0
+            batch_idx = -1
+            # pdb.set_trace()
+            if args.stream:
+                loader = train_dataset.batches(args.batch_size, seed=args.seed + epoch)
+            else:
+                indices = D.shard_indices(train_dataset, rank, world_size, epoch) if distributed else None
+                loader = ASAPDataLoader(train_dataset, train_dataset.maxlen, args.batch_size, indices=indices)
+            for xs, ys, ps, padding_mask, lens, extras in loader:
+                batch_idx += 1
+                epoch_essays += len(ys)  # Essays, xs has a row per window with --long-essays window
+                ys = ys.view(-1, 1)  # Same shape as the outputs, no broadcasting in the loss.
+                if teacher_preds is not None:
+                    soft_ys = torch.from_numpy(teacher_preds[extras.rows]).view(-1, 1)
+                if args.cuda:
+                    ys = ys.cuda()
+                    if teacher_preds is not None:
+                        soft_ys = soft_ys.cuda()
+                with profiler.timer('forward'):
+                    with bf16_autocast(args.bf16):
+                        youts = model(xs,
+                                      mask=padding_mask,
+                                      lens=lens,
+                                      pos=extras.pos,
+                                      features=extras.features,
+                                      segments=extras.segments)
+                    # The loss (and its gradient) in float32 whatever the model ran in.
+                    youts = youts.float()
+                    loss = 0
+                    loss = loss_fn(youts, ys)
+                    if teacher_preds is not None:
+                        loss = args.distill_alpha * loss_fn(youts, soft_ys) + (1 - args.distill_alpha) * loss
+                # Stays on device, read back once per epoch.
+                epoch_loss = epoch_loss + loss.detach()
+                optimizer.zero_grad()
+                with profiler.timer('backward'):
+                    # DistributedDataParallel averages the gradients here,
+                    # so every process clips the same gradients below.
+                    loss.backward()
+                with profiler.timer('clip_grad_norm'):
+                    grad_norm = torch.nn.utils.clip_grad_norm_(optimizable_parameters, args.clip_norm)
+                # bfloat16 has float32's range so there is no loss scaling,
+                # an overflow left in the gradients skips the step instead.
+                # Every process sees the same averaged gradients and skips alike.
+                if args.bf16 and not finite(grad_norm):
+                    skipped_steps += 1
+                else:
+                    with profiler.timer('optimizer'):
+                        optimizer.step()
+                metrics.log(lcount, essays=len(ys) * world_size, loss=loss)
+                lcount += 1
+                if args.profile_trace and main_process:
+                    trace.step()
+            epoch_loss = float(epoch_loss) / (batch_idx + 1)
+            epoch_time = time() - epoch_start
+            if distributed:
+                epoch_loss = D.all_reduce_mean(epoch_loss)
+            if main_process:
+                with profiler.timer('save'):
+                    torch.save(to_save, model_save[:-3]+'.' + str(epoch)+'.pt')
+                metrics.flush(lcount - 1)
+                metrics.scalar('epoch_loss', epoch_loss * (batch_idx + 1), epoch)
+                metrics.scalar('epoch_essays_per_sec', epoch_essays * world_size / epoch_time, epoch)
+                if args.bf16:
+                    metrics.scalar('epoch_skipped_steps', skipped_steps, epoch)
+                    if skipped_steps > 0:
+                        logger.warning('Epoch %d: skipped %d steps with non finite gradients' % (epoch, skipped_steps))
+                print('Epoch %d: average loss=%f' % (epoch, epoch_loss))
+                profiler.report(epoch, log_fn=metrics.scalar)
+    if main_process:
+        torch.save(to_save, model_save)
+    metrics.close()
+    if distributed:
+        D.cleanup()
+
+
+def main(args):
+    args.cuda = args.cuda and torch.cuda.is_available()
+    args.features = features_from_args(args)
+    if args.workers > 1 and args.cuda:
+        raise RuntimeError('--workers is CPU data parallel training, use --cuda alone for DataParallel')
+    if args.bf16 and args.cuda:
+        raise RuntimeError('--bf16 is the CPU autocast path, drop --cuda')
+    if args.corpus is None and args.compressed_datasets == '' and None in (args.train_path, args.dev_path, args.test_path):
+        raise RuntimeError('-tr, -tu and -ts are needed without --corpus')
+    if args.distill_from is not None and args.ensemble_models is not None:
+        raise RuntimeError('--distill-from trains a single student Model, drop --ensembles')
+    if args.stream and (args.corpus is not None or args.compressed_datasets != ''):
+        raise RuntimeError('--stream reads -tr, drop --corpus/--compressed_datasets')
+    if args.stream and (args.workers > 1 or args.distill_from is not None):
+        raise RuntimeError('--stream does not support --workers or --distill-from, they index the training set')
+
+    out_dir = args.out_dir_path.strip('\r\n')
+
+    U.mkdir_p(out_dir + '/preds')
+    U.mkdir_p(out_dir + '/models/')
+    U.mkdir_p(out_dir + '/logs/')
+
+    U.set_logger(out_dir)
+    U.print_args(args)
+
+    if args.profile or args.profile_trace:
+        profiler.enable(synchronize=args.cuda)
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.cuda.manual_seed_all(args.seed)
+
+    train_dataset, vocab, test_dataset, dev_dataset, max_seq_length = load_datasets(args, out_dir)
+
+    teacher, teacher_preds = None, None
+    if args.distill_from is not None:
+        teacher = load_teacher(args, vocab)
+        teacher_preds = teacher_predictions(args, out_dir, teacher, train_dataset)
+
+    if args.workers > 1:
+        D.spawn(train, args.workers, args, out_dir, train_dataset, vocab, teacher_preds)
+    else:
+        train(0, 1, args, out_dir, train_dataset, vocab, teacher_preds)
+
+    if teacher is not None:
+        test_dataset.make_scores_dataset_friendly()
+        distillation_report(args, os.path.join(out_dir, 'models/modelbgrepproper.pt'), teacher, test_dataset)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)